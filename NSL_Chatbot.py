@@ -1,19 +1,348 @@
 # %%
-def main():
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="NSL Stats Chatbot")
+    parser.add_argument('--serve', action='store_true', help="run the multi-session chat server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--max-sessions', type=int, default=256,
+                        help="maximum number of concurrently active chat sessions")
+    parser.add_argument('--idle-timeout', type=float, default=CHAT_IDLE_TIMEOUT,
+                        help="seconds a client may take to reply before its session is closed")
+    parser.add_argument('--profile-startup', action='store_true',
+                        help="report how long startup and each heavy import take, then exit")
+    parser.add_argument('--import-teams', metavar='CSV', help="load teams from a created_teams.csv export")
+    parser.add_argument('--export-teams', metavar='CSV', help="write all teams to a created_teams.csv export")
+    parser.add_argument('--rebuild-teams', action='store_true',
+                        help="replace the players who left the roster in every saved team, then exit")
+    parser.add_argument('--workers', type=int, help="processes used by --rebuild-teams (default: all cores)")
+    parser.add_argument('--dry-run', action='store_true', help="with --rebuild-teams, report without saving")
+    parser.add_argument('--build-snapshot', action='store_true',
+                        help="compile the datasets into a binary snapshot for fast warm starts, then exit")
+    parser.add_argument('--metrics-file', metavar='PATH',
+                        help="enable metrics and keep a Prometheus text file of them up to date")
+    parser.add_argument('--metrics-port', type=int, help="enable metrics and serve them at /metrics on this port")
+    parser.add_argument('--trace-dir', metavar='DIR', help="enable metrics and dump each session's trace here as JSON")
+    # parse_known_args so notebook kernels can pass their own arguments
+    args, _ = parser.parse_known_args(argv)
+
+    if args.profile_startup:
+        profile_startup()
+        return
+
+    if args.metrics_file or args.metrics_port or args.trace_dir:
+        METRICS.enable(args.metrics_file, args.trace_dir)
+        if args.metrics_port:
+            METRICS.serve_http(args.metrics_port, args.host)
+        atexit.register(METRICS.write_prometheus)
+
+    if args.import_teams or args.export_teams:
+        get_data_store().flush_writes()
+        team_store = get_data_store().team_store()
+        if args.import_teams:
+            print(f"Imported {team_store.import_csv(args.import_teams)} team rows.")
+        if args.export_teams:
+            team_store.export_csv(args.export_teams)
+        return
+
+    if args.build_snapshot:
+        print(f"Snapshot written to {build_snapshot()}")
+        return
+
+    if args.rebuild_teams:
+        summary = rebuild_all_teams(args.workers, args.dry_run)
+        print(f"Checked {summary['teams']} teams ({summary['stale']} with players no longer on the roster) "
+              f"with {summary['workers']} workers in {summary['seconds']:.1f} s "
+              f"({summary['teams_per_second']:.0f} teams/s): {summary['changed']} changed"
+              f"{' (dry run, nothing saved)' if args.dry_run else ''}, {summary['failed']} could not be rebuilt.")
+        return
+
+    if args.serve:
+        run_chat_server(args.host, args.port, args.max_sessions, args.idle_timeout)
+        return
 
     # Initiate Code
-    welcome_phase()
-
-if __name__ == '__main__':
-  main()
+    run_session()
 
 # %% [markdown]
 # \# 1. Configuration & Initial Data Import
 # 
 
 # %%
-import pandas as pd
+import time
+
+# Timestamp of the start of the module body, for --profile-startup
+_MODULE_START = time.perf_counter()
+
+import atexit
+import codecs
+import contextvars
+import functools
+import getpass
+import hashlib
+import heapq
+import importlib
+import itertools
 import json
+import os
+import queue
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unicodedata
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter, defaultdict
+from types import MappingProxyType
+
+class LazyModule:
+    """
+    Placeholder for a heavy dependency that is imported on first attribute access.
+    Once imported, the real module replaces the placeholder in this module's globals,
+    so later lookups cost nothing extra.
+    """
+
+    def __init__(self, module_name, alias):
+        self._module_name = module_name
+        self._alias = alias
+
+    def __getattr__(self, attribute):
+        module = importlib.import_module(self._module_name)
+        globals()[self._alias] = module
+        return getattr(module, attribute)
+
+# Heavy dependencies load only when a feature first needs them: pandas/numpy with the
+# datasets and plotly with the country map.
+pd = LazyModule('pandas', 'pd')
+np = LazyModule('numpy', 'np')
+
+# %%
+# Optional instrumentation of the hot paths. Functions wrapped with @timed(name)
+# report their latency into a histogram, and METRICS.count() bumps event counters.
+# Both return straight away while metrics are disabled (the default), so the only
+# cost is one attribute check per call. Enable with NSL_METRICS=1 or the --metrics-*
+# options; time a session spends waiting for the user's typing is not counted.
+_SESSION_TRACE = contextvars.ContextVar('session_trace', default=None)
+
+class Metrics:
+    """
+    Process-wide counters and latency histograms, exported in the Prometheus text format.
+    """
+
+    # Histogram bucket upper bounds, in seconds
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.metrics_file = None
+        self.trace_dir = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.counters = defaultdict(int)
+        self.gauges = {}      # gauge name -> last value
+        self.histograms = {}  # span name -> [bucket counts..., +Inf count, sum]
+
+    def enable(self, metrics_file=None, trace_dir=None):
+        self.enabled = True
+        self.metrics_file = metrics_file or self.metrics_file
+        self.trace_dir = trace_dir or self.trace_dir
+
+    def count(self, event, value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[event] += value
+
+    def gauge(self, name, value):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, span, seconds):
+        with self._lock:
+            histogram = self.histograms.get(span)
+            if histogram is None:
+                histogram = self.histograms[span] = [0] * (len(self.BUCKETS) + 1) + [0.0]
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += seconds
+
+    def waited(self):
+        """
+        Seconds this thread has spent blocked on user input so far.
+        """
+        return getattr(self._local, 'waited', 0.0)
+
+    def add_wait(self, seconds):
+        self._local.waited = self.waited() + seconds
+
+    def to_prometheus(self):
+        """
+        Returns all counters, gauges and histograms in the Prometheus text exposition format.
+        """
+        with self._lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = {span: list(histogram) for span, histogram in self.histograms.items()}
+
+        lines = ['# HELP nsl_events_total Chatbot events (logins, registrations, recommendations, searches).',
+                 '# TYPE nsl_events_total counter']
+        for event, value in sorted(counters.items()):
+            lines.append(f'nsl_events_total{{event="{event}"}} {value}')
+        for name, value in sorted(gauges.items()):
+            lines += [f'# TYPE nsl_{name} gauge', f'nsl_{name} {value}']
+        lines += ['# HELP nsl_span_seconds Time spent in instrumented chatbot functions.',
+                  '# TYPE nsl_span_seconds histogram']
+        for span, histogram in sorted(histograms.items()):
+            for bound, bucket_count in zip(self.BUCKETS, histogram):
+                lines.append(f'nsl_span_seconds_bucket{{span="{span}",le="{bound}"}} {bucket_count}')
+            lines.append(f'nsl_span_seconds_bucket{{span="{span}",le="+Inf"}} {histogram[-2]}')
+            lines.append(f'nsl_span_seconds_sum{{span="{span}"}} {histogram[-1]:.6f}')
+            lines.append(f'nsl_span_seconds_count{{span="{span}"}} {histogram[-2]}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path=None):
+        """
+        Atomically writes the metrics to a text file (e.g. for node_exporter's textfile collector).
+        """
+        path = path or self.metrics_file
+        if not path:
+            return
+        try:
+            with open(path + '.tmp', mode='w', encoding='utf-8') as outfile:
+                outfile.write(self.to_prometheus())
+            os.replace(path + '.tmp', path)
+        except OSError as error:
+            print(f"Error: Could not write the metrics file '{path}': {error}")
+
+    def serve_http(self, port, host='127.0.0.1'):
+        """
+        Serves the metrics at http://host:port/metrics from a background thread.
+        """
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+        return server
+
+
+METRICS = Metrics(enabled=os.environ.get('NSL_METRICS') == '1')
+
+
+class SessionTrace:
+    """
+    Timeline of one chat session: the phases it went through and every span it recorded.
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.phases = []
+        self.spans = []
+
+    def add_phase(self, phase):
+        self.phases.append({'phase': phase, 'at_ms': round((time.perf_counter() - self.start) * 1000, 3)})
+
+    def add_span(self, name, start, elapsed, waited):
+        self.spans.append({
+            'span': name,
+            'start_ms': round((start - self.start) * 1000, 3),
+            'duration_ms': round(elapsed * 1000, 3),
+            'input_wait_ms': round(waited * 1000, 3)
+        })
+
+    def to_dict(self, session=None):
+        return {
+            'started_at': self.started_at,
+            'duration_ms': round((time.perf_counter() - self.start) * 1000, 3),
+            'session': session.snapshot() if session is not None else None,
+            'phases': self.phases,
+            'spans': self.spans
+        }
+
+    def dump(self, path, session=None):
+        """
+        Writes the trace to a JSON file.
+        """
+        try:
+            with open(path, mode='w', encoding='utf-8') as outfile:
+                json.dump(self.to_dict(session), outfile, indent=1, default=str)
+        except OSError as error:
+            print(f"Error: Could not write the session trace '{path}': {error}")
+
+
+def record_span(name, start, waited_before):
+    """
+    Records a finished span in the histograms and in the running session's trace.
+    """
+    elapsed = time.perf_counter() - start
+    waited = METRICS.waited() - waited_before
+    METRICS.observe(name, elapsed - waited)
+    trace = _SESSION_TRACE.get()
+    if trace is not None:
+        trace.add_span(name, start, elapsed, waited)
+
+
+def timed(name):
+    """
+    Decorator that records each call of a function as a span named name (when metrics are enabled).
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not METRICS.enabled:
+                return function(*args, **kwargs)
+            start, waited_before = time.perf_counter(), METRICS.waited()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record_span(name, start, waited_before)
+        return wrapper
+    return decorator
+
+
+class span:
+    """
+    Context manager version of @timed for a block inside a function.
+    """
+    __slots__ = ('name', 'start', 'waited_before')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        if METRICS.enabled:
+            self.start, self.waited_before = time.perf_counter(), METRICS.waited()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start is not None:
+            record_span(self.name, self.start, self.waited_before)
+        return False
+
+# %%
 
 #Loading appropriate dictionarries for each team
 TEAMS_DICT = {
@@ -76,97 +405,1265 @@ TEAMS_INFO = {
     }
 }
 
-# Utility function to load CSV files with defensive programming.
-# Returns an empty DataFrame instead of raising an exception,
-# ensuring downstream code can still execute without breaking.
+# Utility functions to load CSV files with defensive programming.
+# Files are streamed in bounded chunks with declared column types; rows that fail
+# validation are reported and skipped, and a missing or unreadable file yields an
+# empty DataFrame instead of an exception, so downstream code can still execute.
+
+# Rows per chunk when streaming a CSV: bounds the memory used on top of the loaded data
+CSV_CHUNK_ROWS = 50_000
+
+# Declared column types. 'int' columns must hold whole numbers (nullable), 'category'
+# columns are stored as categoricals and 'str' columns stay text (pins keep leading zeros).
+ROSTER_DTYPES = {'team_id': 'int', 'team': 'category', 'position': 'category', 'jersey': 'int',
+                 'name': 'str', 'nationality': 'category', 'fact': 'str', 'attributes': 'str'}
+ROSTER_REQUIRED = ('name', 'position')
+ACCOUNT_DTYPES = {'customer_id': 'str', 'email': 'str', 'name': 'str', 'pin': 'str'}
+ACCOUNT_REQUIRED = ('customer_id', 'email')
+CREATED_TEAM_DTYPES = {'customer_id': 'str', 'position': 'category', 'playername': 'str', 'qualities': 'category'}
+CREATED_TEAM_REQUIRED = ('customer_id', 'position', 'playername')
+
+
+def legacy_bytes_fallback(error):
+    """
+    Decoding error handler for UTF-8 files with some legacy bytes (e.g. a latin-1 export
+    edited in a UTF-8 tool): the bytes that are not valid UTF-8 are read as cp1252.
+    """
+    bad_bytes = error.object[error.start:error.end]
+    try:
+        return bad_bytes.decode('cp1252'), error.end
+    except UnicodeDecodeError:
+        return bad_bytes.decode('latin-1'), error.end
+
+codecs.register_error('nsl-legacy', legacy_bytes_fallback)
+
+
+def detect_encoding(path, sample_size=1 << 20):
+    """
+    Returns (encoding, errors) for reading a CSV: a BOM decides when present; otherwise the file
+    is UTF-8, read strictly when it all decodes as UTF-8 and with the cp1252 fallback for
+    stray legacy bytes otherwise (pure latin-1 files included). Only the first
+    sample_size bytes are checked; larger files always keep the fallback.
+    """
+    with open(path, 'rb') as infile:
+        sample = infile.read(sample_size)
+        is_whole_file = not infile.read(1)
+    if sample.startswith(codecs.BOM_UTF16_LE) or sample.startswith(codecs.BOM_UTF16_BE):
+        return 'utf-16', 'strict'
+    encoding = 'utf-8-sig' if sample.startswith(codecs.BOM_UTF8) else 'utf-8'
+    try:
+        codecs.getincrementaldecoder(encoding)().decode(sample, final=is_whole_file)
+    except UnicodeDecodeError:
+        return encoding, 'nsl-legacy'
+    return encoding, 'strict' if is_whole_file else 'nsl-legacy'
+
+
+class IngestReport:
+    """
+    Outcome of streaming one CSV: the encoding used, rows loaded and rows rejected (with examples).
+    """
+    MAX_EXAMPLES = 20
+
+    def __init__(self, path, encoding):
+        self.path = path
+        self.encoding = encoding
+        self.rows = 0
+        self.bad_rows = 0
+        self.examples = []
+
+    def reject(self, where, reason):
+        self.bad_rows += 1
+        if len(self.examples) < self.MAX_EXAMPLES:
+            self.examples.append(f"{where}: {reason}")
 
-def read_csv_safe(path, encoding):
+    def print_summary(self):
+        if self.bad_rows:
+            print(f"Warning: Skipped {self.bad_rows} bad rows in '{self.path}' ({self.rows} rows loaded).")
+            for example in self.examples[:5]:
+                print(f"  - {example}")
+
+# Report of the last ingest of each path
+INGEST_REPORTS = {}
+
+
+def validate_chunk(chunk, dtypes, required, report):
     """
-    Reads a CSV file into a Pandas DataFrame with error handling.
+    Drops and reports the rows of a chunk that miss a required value or hold a malformed
+    integer, then converts the columns to their declared types.
+    """
+    bad = pd.Series(False, index=chunk.index)
+    for column in required:
+        missing = chunk[column].isna() | (chunk[column].astype(object).str.strip() == '')
+        for line in chunk.index[missing & ~bad]:
+            report.reject(f"line {line}", f"missing {column}")
+        bad |= missing
+
+    converted = {}
+    for column, kind in dtypes.items():
+        if kind == 'int' and column in chunk.columns:
+            numbers = pd.to_numeric(chunk[column], errors='coerce')
+            invalid = (chunk[column].notna() & numbers.isna()) | (numbers.notna() & (numbers % 1 != 0))
+            for line in chunk.index[invalid & ~bad]:
+                report.reject(f"line {line}", f"{column} is not a whole number ({chunk.at[line, column]!r})")
+            bad |= invalid
+            converted[column] = numbers
+
+    if bad.any():
+        chunk = chunk[~bad]
+    for column, kind in dtypes.items():
+        if column not in chunk.columns:
+            continue
+        if kind == 'int':
+            chunk[column] = converted[column][~bad].astype('Int64')
+        elif kind == 'category':
+            chunk[column] = chunk[column].astype('category')
+    report.rows += len(chunk)
+    return chunk
 
+
+def iter_csv_chunks(path, dtypes=None, required=(), chunksize=CSV_CHUNK_ROWS, encoding=None):
+    """
+    Streams a CSV as validated DataFrame chunks of at most chunksize rows, indexed by line
+    number. Lines with the wrong number of fields and invalid rows are skipped and recorded
+    in INGEST_REPORTS[path]; a missing or unreadable file just yields nothing.
     """
+    import csv
+
+    dtypes = dtypes or {}
     try:
-        return pd.read_csv(path, encoding=encoding)
+        encoding, errors = (encoding, 'strict') if encoding else detect_encoding(path)
+        label = encoding if errors == 'strict' else f"{encoding} with cp1252 fallback"
+        report = INGEST_REPORTS[path] = IngestReport(path, label)
+        with open(path, encoding=encoding, errors=errors, newline='') as infile:
+            reader = csv.reader(infile)
+            header = next(reader, None)
+            if not header:
+                print(f"Error: The file '{path}' is empty.")
+                return
+            missing_columns = [column for column in required if column not in header]
+            if missing_columns:
+                print(f"Error: '{path}' has no {', '.join(missing_columns)} column.")
+                return
+
+            def make_chunk(rows, lines):
+                # Empty fields are missing values, as with pd.read_csv
+                chunk = pd.DataFrame(rows, columns=header, index=lines, dtype=str)
+                return validate_chunk(chunk.where(chunk != '', None), dtypes, required, report)
+
+            rows, lines = [], []
+            for fields in reader:
+                if not fields:
+                    continue
+                if len(fields) != len(header):
+                    report.reject(f"line {reader.line_num}", f"expected {len(header)} fields, saw {len(fields)}")
+                    continue
+                rows.append(fields)
+                lines.append(reader.line_num)
+                if len(rows) == chunksize:
+                    yield make_chunk(rows, lines)
+                    rows, lines = [], []
+            if rows or not report.rows:
+                yield make_chunk(rows, lines)
+        report.print_summary()
     except FileNotFoundError:
         # If the file path is invalid or missing
         print(f"Error: The file '{path}' was not found.")
     except UnicodeDecodeError:
         # If the encoding does not match file format
         print(f"Error: Could not decode '{path}' with encoding '{encoding}'.")
-    # Return an empty DataFrame so the program doesn't crash
-    return pd.DataFrame()
+    except csv.Error as error:
+        print(f"Error: Could not parse '{path}': {error}")
+
+
+def concat_chunks(chunks):
+    """
+    Concatenates streamed chunks, merging the categories of categorical columns.
+    """
+    if not chunks:
+        return pd.DataFrame()
+    for column in chunks[0].columns:
+        if isinstance(chunks[0][column].dtype, pd.CategoricalDtype) and len(chunks) > 1:
+            categories = pd.unique(np.concatenate([chunk[column].cat.categories.to_numpy() for chunk in chunks]))
+            for chunk in chunks:
+                chunk[column] = chunk[column].cat.set_categories(categories)
+    return pd.concat(chunks, ignore_index=True)
+
+
+@timed('read_csv_safe')
+def read_csv_safe(path, encoding=None, dtypes=None, required=(), chunksize=CSV_CHUNK_ROWS):
+    """
+    Reads a CSV file into a Pandas DataFrame chunk by chunk, with declared column types
+    and error handling (see iter_csv_chunks). The encoding is detected unless given.
+    """
+    return concat_chunks(list(iter_csv_chunks(path, dtypes, required, chunksize, encoding)))
+
+# %%
+# Folder holding the CSVs and the files derived from them; override with NSL_DATA_DIR
+DATA_DIR = os.environ.get("NSL_DATA_DIR", ".")
+
+def data_path(filename):
+    """
+    Returns the path of a file inside the configured data directory.
+    """
+    return os.path.join(DATA_DIR, filename)
+
+# Process-wide, load-once cache of the chatbot datasets.
+# Each CSV is parsed a single time and only re-read when its size or
+# modification time changes on disk, so looping through the menus does
+# not re-parse the roster on every phase.
+
+def file_signature(path):
+    """
+    Returns a cheap (mtime, size) fingerprint of a file, or None if it is missing.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
 
-# Main data-loading function.
-# Aggregates static dictionaries and external CSV data into a single
-# cohesive dictionary for centralized access by other functions.
-def import_files():
-    # Load primary datasets from disk using a safe loader
-    team_roster_df = read_csv_safe("all_players.csv", "latin-1")   # Player roster
-    account_df = read_csv_safe("customer_database.csv", "utf-8")  # User accounts
-    created_teams_df = read_csv_safe("created_teams.csv", "utf-8")  # User-generated fantasy teams
 
-    # Initialize account dictionary
+def build_account_dict(account_df):
+    """
+    Converts the accounts DataFrame into a {customer_id: read-only record} dictionary.
+    """
     account_dict = {}
 
     # If account data loaded successfully, convert it to a dict for faster lookups
     if not account_df.empty and "customer_id" in account_df.columns:
-        account_dict = account_df.set_index('customer_id').to_dict('index')
+        # Column lists zipped row by row: much faster than DataFrame.to_dict('index')
+        fields = [column for column in account_df.columns if column != 'customer_id']
+        columns = [account_df[column].tolist() for column in fields]
+        for customer_id, *values in zip(account_df['customer_id'].tolist(), *columns):
+            account_dict[customer_id] = MappingProxyType(dict(zip(fields, values)))
+    return account_dict
+
+
+def email_key(email):
+    """
+    Case-folded, whitespace-trimmed form of an email address used for lookups.
+    """
+    return str(email).strip().casefold()
+
+
+def customer_number(customer_id):
+    """
+    Returns N for a "customerN" id, or 0 if the id does not follow that pattern.
+    """
+    digits = str(customer_id)[len("customer"):]
+    return int(digits) if str(customer_id).startswith("customer") and digits.isdigit() else 0
+
+
+class AccountIndex:
+    """
+    Case-insensitive email index plus customer_id index over the accounts, updated
+    incrementally as accounts are added. New customer ids come from a counter.
+    """
+
+    def __init__(self, account_dict):
+        self.by_email = {}   # case-folded email -> customer_id
+        self.by_id = {}      # customer_id -> record
+        self._next_number = 1
+        for customer_id, record in account_dict.items():
+            self.add(customer_id, record)
+
+    def add(self, customer_id, record):
+        self.by_id[customer_id] = record
+        # The first account registered with an email keeps it, as with the old linear scan
+        self.by_email.setdefault(email_key(record['email']), customer_id)
+        self._next_number = max(self._next_number, customer_number(customer_id) + 1)
+
+    def find_by_email(self, email):
+        """
+        Returns (customer_id, record) for an email address, or None if it is not registered.
+        """
+        customer_id = self.by_email.get(email_key(email))
+        if customer_id is None:
+            return None
+        return customer_id, self.by_id[customer_id]
+
+    def next_customer_id(self):
+        """
+        Reserves and returns the next unused "customerN" id.
+        """
+        customer_id = f"customer{self._next_number}"
+        self._next_number += 1
+        return customer_id
+
+
+# Roster rows are matched across file versions on (team_id, name)
+ROSTER_KEY = ['team_id', 'name']
+
+# Seconds between two checks of the roster file by the background watcher
+ROSTER_POLL_INTERVAL = 2.0
+
+class RosterDelta:
+    """
+    Row-level change between two roster versions. remap[old_row] is the row's id in the
+    new roster (-1 once removed); stale_rows are old rows whose index entries must go
+    (removed or changed players) and dirty_rows new rows to index (changed or added).
+    """
+    __slots__ = ('remap', 'stale_rows', 'dirty_rows', 'removed', 'changed', 'added')
+
+    def __init__(self, remap, stale_rows, dirty_rows, removed, changed, added):
+        self.remap = remap
+        self.stale_rows = stale_rows
+        self.dirty_rows = dirty_rows
+        self.removed = removed
+        self.changed = changed
+        self.added = added
+
+    def is_empty(self):
+        return not (self.removed or self.changed or self.added)
+
+
+def diff_rosters(old_df, new_df):
+    """
+    Matches a freshly read roster against the previous one. Returns (roster, RosterDelta),
+    where roster keeps the previous row order (removed players dropped, changed ones
+    updated in place, new ones appended), or None when the two cannot be matched row by
+    row (different columns, missing or duplicate keys) and a full reload is needed.
+    """
+    if old_df.empty or new_df.empty or list(old_df.columns) != list(new_df.columns) or \
+            not set(ROSTER_KEY).issubset(new_df.columns):
+        return None
+    old_keys = pd.MultiIndex.from_frame(old_df[ROSTER_KEY])
+    new_keys = pd.MultiIndex.from_frame(new_df[ROSTER_KEY])
+    if not old_keys.is_unique or not new_keys.is_unique:
+        return None
+
+    new_of_old = new_keys.get_indexer(old_keys)
+    kept_old = np.flatnonzero(new_of_old >= 0)
+    added_new = np.flatnonzero(old_keys.get_indexer(new_keys) < 0)
+
+    # Compare the players present in both versions column by column (missing equals missing)
+    changed = np.zeros(len(kept_old), dtype=bool)
+    for column in old_df.columns:
+        before = old_df[column].to_numpy()[kept_old]
+        after = new_df[column].to_numpy()[new_of_old[kept_old]]
+        changed |= ~((before == after) | (pd.isna(before) & pd.isna(after)))
+
+    remap = np.full(len(old_df), -1, dtype=np.intp)
+    remap[kept_old] = np.arange(len(kept_old))
+    delta = RosterDelta(
+        remap=remap,
+        stale_rows=np.concatenate([np.flatnonzero(new_of_old < 0), kept_old[changed]]),
+        dirty_rows=np.concatenate([np.flatnonzero(changed), len(kept_old) + np.arange(len(added_new))]),
+        removed=len(old_df) - len(kept_old),
+        changed=int(changed.sum()),
+        added=len(added_new)
+    )
+    if delta.is_empty():
+        return old_df, delta
+    roster = new_df.iloc[np.concatenate([new_of_old[kept_old], added_new])].reset_index(drop=True)
+    return roster, delta
+
+
+class ReadOnlyIndexer:
+    """
+    Wraps a .loc/.iloc/.at/.iat indexer: reads go through, assignments raise.
+    """
+
+    def __init__(self, indexer):
+        self._indexer = indexer
+
+    def __getitem__(self, key):
+        return self._indexer[key]
+
+    def __setitem__(self, key, value):
+        raise TypeError("The shared roster is read-only; edit a .copy() of it instead")
+
+
+# Created by read_only_frame() on first use, so that defining it does not import pandas at startup
+ReadOnlyFrame = None
+
+def define_read_only_frame():
+    class ReadOnlyFrame(pd.DataFrame):
+        """
+        The roster shared by every session: a DataFrame whose in-place edits (item and indexer
+        assignment, deleting or inserting columns, inplace=True methods) raise TypeError.
+        Anything derived from it (.copy(), slices, query results) is an ordinary DataFrame.
+        """
+
+        @property
+        def _constructor(self):
+            return pd.DataFrame
+
+        def _read_only(self, *args, **kwargs):
+            raise TypeError("The shared roster is read-only; edit a .copy() of it instead")
+
+        __setitem__ = __delitem__ = insert = pop = _update_inplace = _read_only
+
+        @property
+        def loc(self):
+            return ReadOnlyIndexer(super().loc)
+
+        @property
+        def iloc(self):
+            return ReadOnlyIndexer(super().iloc)
+
+        @property
+        def at(self):
+            return ReadOnlyIndexer(super().at)
+
+        @property
+        def iat(self):
+            return ReadOnlyIndexer(super().iat)
+
+        def __reduce__(self):
+            # Unpickled through read_only_frame(), as the class only exists once it was first used
+            return read_only_frame, (pd.DataFrame(self),)
+
+    ReadOnlyFrame.__qualname__ = 'ReadOnlyFrame'
+    return ReadOnlyFrame
+
+
+def read_only_frame(df):
+    """
+    Returns a DataFrame as a ReadOnlyFrame sharing its data (itself if it already is one).
+    """
+    global ReadOnlyFrame
+    if ReadOnlyFrame is None:
+        ReadOnlyFrame = define_read_only_frame()
+    return df if isinstance(df, ReadOnlyFrame) else ReadOnlyFrame(df)
+
+
+class DataStore:
+    """
+    Holds the roster and customer accounts in memory and hands out read-only views of
+    them (the roster as a ReadOnlyFrame). Created teams live in the SQLite TeamStore it opens.
+    A dataset is reloaded only when its file changes; a changed roster is applied as a
+    row-level delta, to the roster and to the indexes derived from it.
+    When the snapshot folder exists, tables and derived matrices are loaded from it
+    while their source files are unchanged.
+    """
+
+    def __init__(self, roster_path=None, accounts_path=None, created_teams_path=None, snapshot_path=None):
+        roster_path = roster_path or data_path("all_players.csv")
+        accounts_path = accounts_path or data_path("customer_database.csv")
+        created_teams_path = created_teams_path or data_path("created_teams.csv")
+        snapshot_path = snapshot_path or snapshot_dir()
+        self.snapshot = Snapshot(snapshot_path) if os.path.isdir(snapshot_path) else None
+
+        # Accounts = CSV snapshot + append-only journal of the changes made since
+        self.account_journal = AccountJournal(accounts_path)
+
+        # dataset name -> (files whose signature decides a reload, loader)
+        self._sources = {
+            "team_roster_df": ((roster_path,), self._load_roster),
+            "account_dict": (self.account_journal.paths(), self._load_accounts),
+        }
+        self._roster_path = roster_path
+        self._entries = {}   # dataset name -> (file signature, loaded value, version)
+        self._versions = {name: 0 for name in self._sources}
+        self._derived = {}   # (derived name, roster version) -> value
+        self._builders = {}  # derived name -> builder, to refresh it after a roster change
+        self._rosters = {}   # roster version -> roster, for the current and previous version
+        self._roster_deltas = {}  # roster version -> RosterDelta from the version before
+        self._roster_digests = {}  # roster version -> source digest, while rows are in file order
+        self._watcher = None
+        self._account_index = (0, None)   # (accounts version, AccountIndex)
+        self._created_teams_path = created_teams_path
+        self._team_store = None
+        self._writer = None
+        self._leaderboard = None
+        self._leaderboard_teams_version = None   # TeamStore.data_version() the board was read at
+        self._leaderboard_lock = threading.Lock()
+        self._lock = threading.RLock()
+
+    def _signature(self, name):
+        return tuple(file_signature(path) for path in self._sources[name][0])
+
+    def _get(self, name):
+        return self._get_entry(name)[1]
+
+    def _get_entry(self, name):
+        """
+        Returns the current (signature, value, version) of a dataset, reloading it if its files changed.
+        The value and its version are swapped in together, so readers never see them mismatched.
+        """
+        signature = self._signature(name)
+        entry = self._entries.get(name)
+        if entry is not None and entry[0] == signature:
+            return entry
+
+        with self._lock:
+            # Another thread may have reloaded the file while we waited for the lock
+            entry = self._entries.get(name)
+            if entry is not None and entry[0] == signature:
+                return entry
+            version = self._versions[name] + 1
+            value = self._sources[name][1](version)
+            entry = (signature, value, version)
+            self._entries[name] = entry
+            self._versions[name] = version
+            return entry
+
+    def _mark_synced(self, name):
+        """
+        Records our own write to a dataset's files so it does not trigger a reload.
+        """
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None:
+                self._entries[name] = (self._signature(name), entry[1], entry[2])
+
+    def _read_table(self, name, path, dtypes, required):
+        """
+        Returns (DataFrame, source digest) of a CSV: from the snapshot while the file is
+        unchanged, otherwise via read_csv_safe(), refreshing the snapshot on the way.
+        """
+        if self.snapshot is None:
+            return read_csv_safe(path, dtypes=dtypes, required=required), None
+        schema = {'dtypes': dtypes, 'required': list(required)}
+        digest = self.snapshot.digest([path])
+        if digest is not None:
+            table = self.snapshot.load_table(name, digest, schema)
+            if table is not None:
+                return table, digest
+        table = read_csv_safe(path, dtypes=dtypes, required=required)
+        # Only snapshot what was read if the file did not change meanwhile
+        if digest is not None and not table.empty and self.snapshot.digest([path]) == digest:
+            self.snapshot.save_table(name, digest, table, schema)
+        return table, digest
+
+    def _build(self, name, builder, roster, version):
+        """
+        Returns builder(roster), loaded from the snapshot when the builder supports it
+        (from_snapshot / to_snapshot) and the roster rows are still in file order.
+        """
+        digest = self._roster_digests.get(version)
+        if self.snapshot is None or digest is None or not hasattr(builder, 'from_snapshot'):
+            return builder(roster)
+        saved = self.snapshot.load_arrays(name, digest)
+        value = builder.from_snapshot(roster, *saved) if saved is not None else None
+        if value is None:
+            value = builder(roster)
+            saved = value.to_snapshot()
+            if saved is not None:
+                self.snapshot.save_arrays(name, digest, *saved)
+        return value
+
+    def _load_roster(self, version):
+        roster, digest = self._read_table("team_roster_df", self._roster_path, ROSTER_DTYPES, ROSTER_REQUIRED)
+        previous = self._entries.get("team_roster_df")
+        if previous is not None:
+            # Apply the file as a row-level delta when the players can be matched up
+            update = diff_rosters(previous[1], roster)
+            if update is not None:
+                roster, self._roster_deltas[version] = update
+                digest = None
+        # Shared by every session, so in-place edits must fail instead of leaking between them
+        roster = read_only_frame(roster)
+        self._rosters[version] = roster
+        if digest is not None:
+            self._roster_digests[version] = digest
+        # In-flight sessions may still hold the previous version; older ones are dropped
+        for old_version in [old for old in self._rosters if old < version - 1]:
+            del self._rosters[old_version]
+            self._roster_deltas.pop(old_version, None)
+            self._roster_digests.pop(old_version, None)
+        return roster
+
+    def _load_accounts(self, version=None):
+        account_dict = build_account_dict(self._read_table(
+            "account_df", self.account_journal.snapshot_path, ACCOUNT_DTYPES, ACCOUNT_REQUIRED)[0])
+        # Replay the inserts/updates journaled since the last compaction
+        for customer_id, record in self.account_journal.replay():
+            account_dict[customer_id] = MappingProxyType(record)
+        # ...and the registrations still waiting for the background writer
+        if self._writer is not None:
+            for customer_id, record in self._writer.pending('account'):
+                account_dict[customer_id] = record
+        return account_dict
+
+    def version(self, name):
+        """
+        Returns how many times a dataset has been (re)loaded; derived data is keyed on it.
+        """
+        return self._get_entry(name)[2]
+
+    def roster_version(self, team_roster_df):
+        """
+        Returns the version of a roster DataFrame handed out by this store (current or previous), or None.
+        """
+        entry = self._get_entry("team_roster_df")
+        if team_roster_df is entry[1]:
+            return entry[2]
+        for version, roster in list(self._rosters.items()):
+            if roster is team_roster_df:
+                return version
+        return None
+
+    def roster(self):
+        """
+        Returns the shared player roster as a ReadOnlyFrame; edit a .copy() of it instead.
+        """
+        return self._get("team_roster_df")
+
+    def accounts(self):
+        """
+        Returns a read-only view of the {customer_id: record} account dictionary.
+        """
+        return MappingProxyType(self._get("account_dict"))
+
+    def add_account(self, customer_id, record):
+        """
+        Registers a new account and returns the updated read-only view. The account is
+        visible straight away; the background writer appends it to the journal.
+        """
+        with self._lock:
+            record = MappingProxyType(dict(record))
+            self.account_index().add(customer_id, record)
+            self._get("account_dict")[customer_id] = record
+        self.writer().put('account', customer_id, record)
+        return self.accounts()
+
+    def _write_accounts(self, changes):
+        """
+        Write-behind handler: journals a batch of account changes with one fsync.
+        """
+        with self._lock:
+            self.account_journal.append_many(changes)
+            self._mark_synced("account_dict")
+        self.account_journal.request_compaction(self.compact_accounts)
+
+    @timed('persist.compact_accounts')
+    def compact_accounts(self):
+        """
+        Folds the account journal into a fresh customer_database.csv snapshot.
+        """
+        with self._lock:
+            # New appends go to a fresh journal while the snapshot is written. The accounts in
+            # memory are already current, so moving the journal must not make readers reload them
+            accounts = dict(self._get("account_dict"))
+            self.account_journal.rotate()
+            self._mark_synced("account_dict")
+        self.account_journal.write_snapshot(accounts)
+        self._mark_synced("account_dict")
+
+    def account_index(self):
+        """
+        Returns the AccountIndex of the current accounts, rebuilt only when the file is reloaded.
+        """
+        account_dict = self._get("account_dict")
+        version, index = self._account_index
+        if index is None or version != self._versions["account_dict"]:
+            with self._lock:
+                version, index = self._account_index
+                if index is None or version != self._versions["account_dict"]:
+                    index = AccountIndex(account_dict)
+                    self._account_index = (self._versions["account_dict"], index)
+        return index
+
+    def new_customer_id(self):
+        """
+        Allocates a customer id that is never reused, even after deletions.
+        """
+        with self._lock:
+            return self.account_index().next_customer_id()
+
+    def team_store(self):
+        """
+        Returns the SQLite store of created teams, seeded from created_teams.csv on first use.
+        """
+        if self._team_store is None:
+            with self._lock:
+                if self._team_store is None:
+                    self._team_store = TeamStore(data_path("created_teams.sqlite3"), self._created_teams_path)
+        return self._team_store
+
+    def writer(self):
+        """
+        Returns the background writer of account and team saves, started on first use.
+        """
+        if self._writer is None:
+            with self._lock:
+                if self._writer is None:
+                    self._writer = WriteBehindQueue({
+                        'account': self._write_accounts,
+                        'team': lambda teams: self.team_store().replace_teams(dict(teams)),
+                    })
+        return self._writer
+
+    def flush_writes(self):
+        """
+        Waits until every save made so far is on disk.
+        """
+        if self._writer is not None:
+            self._writer.flush()
+
+    def save_team(self, customer_id, team_rows):
+        """
+        Queues a customer's team for the background writer and updates the leaderboard.
+        """
+        team_rows = list(team_rows)
+        self.writer().put('team', customer_id, team_rows)
+        # Waits for a leaderboard being built, which may or may not have read this save
+        with self._leaderboard_lock:
+            board = self._leaderboard
+        if board is not None:
+            board.update_team(customer_id, team_rows)
+
+    def replace_teams(self, teams):
+        """
+        Writes {customer_id: team rows} to the team store in bulk and updates the leaderboard.
+        """
+        self.flush_writes()
+        self.team_store().replace_teams(teams)
+        with self._leaderboard_lock:
+            board = self._leaderboard
+        if board is not None:
+            for customer_id, team_rows in teams.items():
+                board.update_team(customer_id, team_rows)
+
+    def leaderboard(self):
+        """
+        Returns the fantasy leaderboard: scored from every saved team on first use, then
+        kept up to date as teams are saved and the roster changes. It is scored again
+        when another process (e.g. --rebuild-teams or --import-teams) writes to the team store.
+        """
+        roster, version = self._get_entry("team_roster_df")[1:]
+        teams_version = self.team_store().data_version()
+        board = self._leaderboard
+        if board is not None and board.version == version and self._leaderboard_teams_version == teams_version:
+            return board
+        # Own lock rather than the store's, so registrations go on while the board is built
+        with self._leaderboard_lock:
+            board = self._leaderboard
+            engine = self.derived('recommender', RecommenderEngine, version)
+            if board is None or self._leaderboard_teams_version != teams_version:
+                # Build from the database, including the saves still queued
+                self.flush_writes()
+                board = Leaderboard(roster, engine, self.team_store().iter_teams(), version)
+                self._leaderboard_teams_version = teams_version
+            elif board.version != version:
+                delta = self._roster_deltas.get(version) if board.version == version - 1 else None
+                board.apply_roster(roster, engine, version, delta)
+            self._leaderboard = board
+        return board
+
+    def load_team(self, customer_id):
+        """
+        Returns a customer's team as a DataFrame, including a save still waiting to be written.
+        """
+        if self._writer is not None:
+            team_rows = self._writer.pending_value('team', customer_id)
+            if team_rows is not None:
+                return pd.DataFrame([(customer_id, *row) for row in team_rows], columns=TEAM_COLUMNS)
+        return self.team_store().load_team(customer_id)
+
+    def derived(self, name, builder, version=None):
+        """
+        Returns builder(roster), computed once per roster version and shared by all callers.
+        After a roster change, a value with an apply_delta(roster, delta) method is updated
+        from the previous version's instead of being rebuilt.
+        """
+        if version is None:
+            version = self._get_entry("team_roster_df")[2]
+        value = self._derived.get((name, version))
+        if value is not None:
+            return value
+        with self._lock:
+            self._builders.setdefault(name, builder)
+            value = self._derived.get((name, version))
+            if value is None:
+                roster = self._rosters.get(version)
+                if roster is None:
+                    roster = self._get_entry("team_roster_df")[1]
+                previous = self._derived.get((name, version - 1))
+                delta = self._roster_deltas.get(version)
+                if previous is not None and delta is not None and delta.is_empty():
+                    value = previous
+                elif previous is not None and delta is not None and hasattr(previous, 'apply_delta'):
+                    value = previous.apply_delta(roster, delta)
+                else:
+                    value = self._build(name, builder, roster, version)
+                self._derived[(name, version)] = value
+                # Keep the values of the current and previous roster versions only
+                for key in [key for key in self._derived if key[1] < version - 1]:
+                    del self._derived[key]
+            return value
+
+    def refresh_roster(self):
+        """
+        Reloads the roster if its file changed and brings every derived index up to date,
+        so the next session request finds them ready. Returns True if the roster changed.
+        """
+        entry = self._entries.get("team_roster_df")
+        if entry is not None and entry[0] == self._signature("team_roster_df"):
+            return False
+        version = self._get_entry("team_roster_df")[2]
+        for name, builder in list(self._builders.items()):
+            if (name, version - 1) in self._derived:
+                self.derived(name, builder, version)
+        return True
+
+    def watch_roster(self, interval=ROSTER_POLL_INTERVAL):
+        """
+        Starts a background thread that polls the roster file and applies changes as they land,
+        and rescores the leaderboard (once it is in use) after another process rewrote the teams.
+        """
+        def watch():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.refresh_roster()
+                    if self._leaderboard is not None:
+                        self.leaderboard()
+                except Exception as error:
+                    print(f"Error: Could not refresh the roster: {error}")
+
+        with self._lock:
+            if self._watcher is None:
+                self._watcher = threading.Thread(target=watch, name='roster-watcher', daemon=True)
+                self._watcher.start()
+
+
+_DATA_STORE = None
+_DATA_STORE_LOCK = threading.Lock()
+
+def roster_derived(name, builder, team_roster_df=None):
+    """
+    Returns builder(roster): shared through the data store for the live roster,
+    built on the spot for any other roster DataFrame.
+    """
+    store = get_data_store()
+    if team_roster_df is None:
+        return store.derived(name, builder)
+    version = store.roster_version(team_roster_df)
+    if version is not None:
+        return store.derived(name, builder, version)
+    return builder(team_roster_df)
+
+def get_data_store():
+    """
+    Returns the process-wide DataStore, creating it on first use.
+    """
+    global _DATA_STORE
+    if _DATA_STORE is None:
+        with _DATA_STORE_LOCK:
+            if _DATA_STORE is None:
+                _DATA_STORE = DataStore()
+    return _DATA_STORE
+
+# Main data-loading function.
+# Aggregates static dictionaries and the cached CSV data into a single
+# cohesive dictionary for centralized access by other functions.
+@timed('import_files')
+def import_files():
+    # Datasets come from the shared store, so repeated calls do not touch the CSVs
+    store = get_data_store()
 
     return {
-        "teams_dict": TEAMS_DICT,             # Static team ID-to-name mapping
-        "teams_info": TEAMS_INFO,             # Rich team metadata
-        "team_roster_df": team_roster_df,     # Players and their details
-        "account_dict": account_dict,         # User account info (dict form)
-        "created_teams_df": created_teams_df  # Fantasy team creations
+        "teams_dict": TEAMS_DICT,                      # Static team ID-to-name mapping
+        "teams_info": TEAMS_INFO,                      # Rich team metadata
+        "team_roster_df": store.roster(),              # Players and their details
+        "account_dict": store.accounts()               # User account info (read-only dict view)
     }
 
+# %%
+# Optional compiled snapshot of the datasets for fast warm starts.
+# Each table (and each roster-derived matrix, such as the recommender's bitmasks)
+# is written once as NumPy .npy files in a folder named after the SHA-1 of its
+# source files, so a changed CSV simply misses the snapshot and is re-read with
+# read_csv_safe(). Numeric columns and matrices are memory-mapped on load, so
+# worker processes share their pages. Create the folder (or run --build-snapshot)
+# to turn it on; delete it to turn it off.
+
+# Bumped whenever the on-disk layout changes; older snapshots are then ignored
+SNAPSHOT_FORMAT = 1
+
+def file_digest(paths):
+    """
+    Returns the SHA-1 hex digest of the contents of one or more files, or None if one is missing.
+    """
+    digest = hashlib.sha1()
+    try:
+        for path in paths:
+            with open(path, 'rb') as infile:
+                for block in iter(lambda: infile.read(1 << 20), b''):
+                    digest.update(block)
+            digest.update(b'\0')
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+class Snapshot:
+    """
+    A folder of compiled tables and arrays, one sub-folder per dataset and source digest.
+    Writes go to a temporary folder renamed into place, so concurrent writers are safe
+    and readers never see a half-written snapshot.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._digests_path = os.path.join(directory, 'digests.json')
+        self._lock = threading.Lock()
+
+    def digest(self, paths):
+        """
+        Returns the content digest of source files. The last digest of each file set is
+        remembered with the files' (mtime, size) so unchanged files are not re-hashed.
+        """
+        paths = tuple(paths)
+        signatures = [file_signature(path) for path in paths]
+        if None in signatures:
+            return None
+        key = '\n'.join(os.path.abspath(path) for path in paths)
+        with self._lock:
+            try:
+                with open(self._digests_path, encoding='utf-8') as infile:
+                    digests = json.load(infile)
+            except (OSError, ValueError):
+                digests = {}
+            cached = digests.get(key)
+            if cached is not None and cached[0] == [list(signature) for signature in signatures]:
+                return cached[1]
+            digest = file_digest(paths)
+            if digest is None or [file_signature(path) for path in paths] != signatures:
+                # A file changed while it was hashed; do not remember this digest
+                return digest
+            digests[key] = [[list(signature) for signature in signatures], digest]
+            try:
+                temp_filename = f"{self._digests_path}.{os.getpid()}.tmp"
+                with open(temp_filename, 'w', encoding='utf-8') as outfile:
+                    json.dump(digests, outfile)
+                os.replace(temp_filename, self._digests_path)
+            except OSError:
+                pass
+            return digest
+
+    def _folder(self, name, digest):
+        return os.path.join(self.directory, f"{name}-{digest}")
+
+    def _write(self, name, digest, write):
+        """
+        Runs write(folder) on a temporary folder, then publishes it and drops older versions of name.
+        """
+        temp_folder = tempfile.mkdtemp(prefix='.tmp-', dir=self.directory)
+        try:
+            write(temp_folder)
+            os.rename(temp_folder, self._folder(name, digest))
+        except OSError:
+            # Another process published the same snapshot first (or the disk is full)
+            shutil.rmtree(temp_folder, ignore_errors=True)
+            return
+        fsync_directory(self.directory)
+        current = os.path.basename(self._folder(name, digest))
+        for entry in os.listdir(self.directory):
+            if entry.startswith(f"{name}-") and entry != current:
+                # Processes still reading an old version keep their open and mapped files
+                shutil.rmtree(os.path.join(self.directory, entry), ignore_errors=True)
+
+    def _read_meta(self, name, digest):
+        try:
+            with open(os.path.join(self._folder(name, digest), 'meta.json'), encoding='utf-8') as infile:
+                meta = json.load(infile)
+        except (OSError, ValueError):
+            return None
+        return meta if meta.get('format') == SNAPSHOT_FORMAT else None
+
+    @timed('snapshot.save_table')
+    def save_table(self, name, digest, df, schema):
+        """
+        Writes a DataFrame column by column: nullable ints as values + mask, categoricals
+        as codes + labels, and text as one UTF-8 buffer + character offsets.
+        """
+        def write(folder):
+            columns = []
+            for number, column in enumerate(df.columns):
+                series = df[column]
+                path = os.path.join(folder, str(number))
+                if isinstance(series.dtype, pd.CategoricalDtype):
+                    np.save(f"{path}.codes.npy", series.cat.codes.to_numpy())
+                    columns.append({'name': column, 'kind': 'category',
+                                    'categories': series.cat.categories.tolist()})
+                elif series.dtype == 'Int64':
+                    np.save(f"{path}.values.npy", series.to_numpy(dtype=np.int64, na_value=0))
+                    np.save(f"{path}.missing.npy", series.isna().to_numpy())
+                    columns.append({'name': column, 'kind': 'int'})
+                else:
+                    texts = series.astype(object).where(series.notna(), '').astype(str).tolist()
+                    offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+                    np.cumsum([len(text) for text in texts], out=offsets[1:])
+                    np.save(f"{path}.text.npy", np.frombuffer(''.join(texts).encode('utf-8'), dtype=np.uint8))
+                    np.save(f"{path}.offsets.npy", offsets)
+                    np.save(f"{path}.missing.npy", series.isna().to_numpy())
+                    columns.append({'name': column, 'kind': 'str'})
+            with open(os.path.join(folder, 'meta.json'), 'w', encoding='utf-8') as outfile:
+                json.dump({'format': SNAPSHOT_FORMAT, 'schema': schema, 'rows': len(df), 'columns': columns}, outfile)
+
+        self._write(name, digest, write)
+
+    @timed('snapshot.load_table')
+    def load_table(self, name, digest, schema):
+        """
+        Returns the DataFrame saved for these source files and schema, or None if there is none.
+        """
+        meta = self._read_meta(name, digest)
+        if meta is None or meta['schema'] != schema:
+            return None
+        folder = self._folder(name, digest)
+        try:
+            data = {}
+            for number, column in enumerate(meta['columns']):
+                path = os.path.join(folder, str(number))
+                if column['kind'] == 'category':
+                    data[column['name']] = pd.Categorical.from_codes(
+                        np.load(f"{path}.codes.npy", mmap_mode='r'), categories=column['categories'])
+                elif column['kind'] == 'int':
+                    data[column['name']] = pd.arrays.IntegerArray(
+                        np.load(f"{path}.values.npy", mmap_mode='r'), np.load(f"{path}.missing.npy"))
+                else:
+                    # Text has to become Python strings anyway: decode the buffer once, then slice it
+                    text = np.load(f"{path}.text.npy", mmap_mode='r').tobytes().decode('utf-8')
+                    offsets = np.load(f"{path}.offsets.npy").tolist()
+                    values = np.array([text[start:end] for start, end in zip(offsets[:-1], offsets[1:])],
+                                      dtype=object)
+                    values[np.load(f"{path}.missing.npy")] = None
+                    data[column['name']] = pd.Series(values, dtype=str)
+        except (OSError, ValueError):
+            # Removed or damaged underneath us: fall back to the CSV
+            return None
+        table = pd.DataFrame(data, copy=False)
+        return table if len(table) == meta['rows'] else None
+
+    @timed('snapshot.save_arrays')
+    def save_arrays(self, name, digest, arrays, meta):
+        """
+        Writes named NumPy arrays plus a JSON-serialisable dict of metadata.
+        """
+        def write(folder):
+            for key, array in arrays.items():
+                np.save(os.path.join(folder, f"{key}.npy"), array)
+            with open(os.path.join(folder, 'meta.json'), 'w', encoding='utf-8') as outfile:
+                json.dump({'format': SNAPSHOT_FORMAT, 'arrays': list(arrays), 'meta': meta}, outfile)
+
+        self._write(name, digest, write)
+
+    @timed('snapshot.load_arrays')
+    def load_arrays(self, name, digest):
+        """
+        Returns the memory-mapped (read-only) arrays and metadata saved under name, or None.
+        """
+        saved = self._read_meta(name, digest)
+        if saved is None:
+            return None
+        try:
+            arrays = {key: np.load(os.path.join(self._folder(name, digest), f"{key}.npy"), mmap_mode='r')
+                      for key in saved['arrays']}
+        except (OSError, ValueError):
+            return None
+        return arrays, saved['meta']
+
+
+def snapshot_dir():
+    """
+    Returns the snapshot folder: NSL_SNAPSHOT_DIR if set, otherwise 'snapshot' in the data directory.
+    """
+    return os.environ.get("NSL_SNAPSHOT_DIR") or data_path("snapshot")
+
+
+def build_snapshot():
+    """
+    Creates the snapshot folder and compiles every dataset, the recommender and the
+    similar-players table into it.
+    Returns the folder.
+    """
+    global _DATA_STORE
+    directory = snapshot_dir()
+    os.makedirs(directory, exist_ok=True)
+    with _DATA_STORE_LOCK:
+        _DATA_STORE = None
+    import_files()
+    get_recommender()
+    get_similar_players()
+    return directory
+
 # %% [markdown]
 # # 2. Main Chatbot Application Flow
 # 
 
 # %%
-def welcome_phase():
+# Every prompt and message of the dialogue goes through say()/ask()/ask_secret().
+# On a terminal they behave like print()/input()/getpass(); inside a chat server
+# session they are routed to that session's channel instead, so the same dialogue
+# logic can serve many users concurrently.
+_CHAT_CHANNEL = contextvars.ContextVar('chat_channel', default=None)
+
+
+class ChatSessionClosed(Exception):
+    """
+    Raised inside a dialogue when the remote user disconnects.
+    """
+
+
+def current_channel():
+    """
+    Returns the channel of the chat session running in this context, or None on a terminal.
+    """
+    return _CHAT_CHANNEL.get()
+
+
+def say(*values, sep=' ', end='\n'):
+    channel = _CHAT_CHANNEL.get()
+    if channel is None:
+        print(*values, sep=sep, end=end)
+    else:
+        channel.write(sep.join(str(value) for value in values) + end)
+
+
+def wait_for_reply(read, prompt):
+    """
+    Reads the user's reply, booking the time spent waiting for it as input wait, not work.
+    """
+    if not METRICS.enabled:
+        return read(prompt)
+    start = time.perf_counter()
+    try:
+        return read(prompt)
+    finally:
+        METRICS.add_wait(time.perf_counter() - start)
+
+
+def ask(prompt=''):
+    channel = _CHAT_CHANNEL.get()
+    if channel is None:
+        return wait_for_reply(input, prompt)
+    return wait_for_reply(channel.read_line, prompt)
+
+
+def ask_secret(prompt=''):
+    channel = _CHAT_CHANNEL.get()
+    if channel is None:
+        return wait_for_reply(getpass.getpass, prompt)
+    return wait_for_reply(channel.read_line, prompt)
+
+# %%
+# The conversation is a flat state machine: every phase function returns the
+# name of the next phase and run_session() loops over them, so the call stack
+# stays the same depth however many times the user goes back to the main menu.
+# All a session needs to resume elsewhere is the small ChatSession record.
+_CHAT_SESSION = contextvars.ContextVar('chat_session', default=None)
+
+
+class ChatSession:
+    """
+    Serializable state of one conversation: current phase, user name, customer_id and team draft.
+    """
+    __slots__ = ('phase', 'user_name', 'customer_id', 'team_draft')
+
+    def __init__(self, phase='welcome', user_name='', customer_id=None, team_draft=None):
+        self.phase = phase
+        self.user_name = user_name
+        self.customer_id = customer_id
+        self.team_draft = team_draft  # TeamDraft of the team being built, or None
+
+    def snapshot(self):
+        """
+        Returns a JSON-serializable dict from which the session can be resumed in another worker.
+        """
+        return {
+            'phase': self.phase,
+            'user_name': self.user_name,
+            'customer_id': self.customer_id,
+            'team_draft': self.team_draft.snapshot() if self.team_draft is not None else None
+        }
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        snapshot = dict(snapshot)
+        if snapshot.get('team_draft') is not None:
+            snapshot['team_draft'] = TeamDraft.from_snapshot(snapshot['team_draft'], get_data_store().roster())
+        return cls(**snapshot)
+
+
+def current_session():
+    """
+    Returns the ChatSession running in this context, or None outside run_session().
+    """
+    return _CHAT_SESSION.get()
+
+
+def run_session(session=None):
+    """
+    Iterative dispatcher: runs phases until the user exits and returns the final session.
+    """
+    if session is None:
+        session = ChatSession()
+    token = _CHAT_SESSION.set(session)
+    trace = SessionTrace() if METRICS.enabled else None
+    trace_token = _SESSION_TRACE.set(trace)
+    try:
+        while session.phase != 'exit':
+            if trace is not None:
+                trace.add_phase(session.phase)
+            # One span per phase rather than per printed line: the time spent in the phase's
+            # own work, with the user's typing left out
+            with span(f'phase.{session.phase}'):
+                session.phase = PHASES[session.phase](session)
+    finally:
+        _SESSION_TRACE.reset(trace_token)
+        _CHAT_SESSION.reset(token)
+        if trace is not None:
+            finish_session_trace(trace, session)
+    return session
+
+
+# Numbers the trace files written by this process
+_TRACE_NUMBERS = itertools.count(1)
+
+def finish_session_trace(trace, session):
+    """
+    Dumps a finished session's trace to the trace directory and refreshes the metrics file.
+    """
+    METRICS.count('sessions')
+    if METRICS.trace_dir:
+        os.makedirs(METRICS.trace_dir, exist_ok=True)
+        filename = f"trace-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(_TRACE_NUMBERS)}.json"
+        trace.dump(os.path.join(METRICS.trace_dir, filename), session)
+    METRICS.write_prometheus()
+
+
+def welcome_phase(session):
     """
-    Greet the user, and routing them to a primary feature based on their main menu selection.
+    Greet the user and ask for their name before moving on to the main menu.
     """
 
     # Welcome
     print_welcome_message()
 
     # Get user name
-    user_name = input('Enter your name here: ').strip()
-    print(f"\nFantastic {user_name}! I'm so glad to meet you!\n" + "-"*54)
-    first_phase(user_name)
-
-def first_phase(user_name):
-
-    # Load all datasets once
-    my_datasets = import_files()
-    teams_dict = my_datasets.get('teams_dict', {})
-    teams_info = my_datasets.get('teams_info', {})
-    team_roster_df = my_datasets.get('team_roster_df', pd.DataFrame())
-    account_dict = my_datasets.get('account_dict', {})
+    user_name = ask('Enter your name here: ').strip()
+    say(f"\nFantastic {user_name}! I'm so glad to meet you!\n" + "-"*54)
+    session.user_name = user_name
+    return 'main_menu'
 
+def first_phase(session):
+    """
+    Routes the user to a primary feature based on their main menu selection.
+    """
 
-    # Menu options mapped to functions (no lambda)
+    # Menu options mapped to the next phase
     menu_actions = {
-        '1': discover_teams_players,
-        '2': start_fantasy_team
+        '1': 'discover',
+        '2': 'fantasy'
     }
 
     print_menu()
 
     while True:
-        choice = input('Input the number corresponding to your choice: ').strip()
+        choice = ask('Input the number corresponding to your choice: ').strip()
         if choice in menu_actions:
-            menu_actions[choice](user_name, teams_dict, teams_info, team_roster_df, account_dict)
-            break
+            return menu_actions[choice]
         else:
-            print('Please enter a valid choice.')
+            say('Please enter a valid choice.')
 
 
 def print_welcome_message():
-    print("""Hello! Welcome to the NSL Stats Chatbot!
+    say("""Hello! Welcome to the NSL Stats Chatbot!
 -------------------------------------------------------
 I am here to help you learn more about the players and teams of the Northern Super League.
 Tell me your name first so I can get to know you better!
@@ -174,19 +1671,41 @@ Tell me your name first so I can get to know you better!
 
 
 def print_menu():
-    print("""
+    say("""
 What can I help you with today?
 1. Discover the teams and players
 2. Start a Fantasy Team
 """)
 
 
-def discover_teams_players(user_name, teams_dict, teams_info, team_roster_df, account_dict):
-    discover_phase(user_name, teams_dict, teams_info, team_roster_df)
+def discover_teams_players(session):
+    my_datasets = import_files()
+    return discover_phase(session.user_name, my_datasets['teams_dict'], my_datasets['teams_info'],
+                          my_datasets['team_roster_df'])
+
+
+def start_fantasy_team(session):
+    return fantasy_phase(session.user_name)
 
 
-def start_fantasy_team(user_name, teams_dict, teams_info, team_roster_df, account_dict):
-    fantasy_phase(user_name, account_dict, team_roster_df)
+def team_builder_phase(session):
+    """
+    Resumes the team builder for a logged-in customer, starting from their draft if they have one.
+    """
+    if session.team_draft is None:
+        return instructions(session.user_name, session.customer_id)
+    return recommendation(session.user_name, session.customer_id, session.team_draft,
+                          session.team_draft.team_roster_df)
+
+
+# Phase name -> handler; each handler returns the next phase name
+PHASES = {
+    'welcome': welcome_phase,
+    'main_menu': first_phase,
+    'discover': discover_teams_players,
+    'fantasy': start_fantasy_team,
+    'team_builder': team_builder_phase
+}
 
 # %% [markdown]
 # # 3. Feature: NSL Information Discovery
@@ -201,8 +1720,8 @@ def discover_phase(user_name, teams_dict, teams_info, team_roster_df):
     Routes the user to either the team discovery or player discovery function based on their selection from a sub-menu.
     """
     # Greet the user and explain the discovery options
-    print(f"Okay {user_name} let's help you get to know more about the players and teams!")
-    print(f"""What would you like to discover?
+    say(f"Okay {user_name} let's help you get to know more about the players and teams!")
+    say(f"""What would you like to discover?
 1. Teams
 2. Players""")
 
@@ -212,34 +1731,30 @@ def discover_phase(user_name, teams_dict, teams_info, team_roster_df):
 
     while True:
         # Ask the user for their choice
-        user_choice = input('Input the number corresponding to your choice. I want to know more about:')
+        user_choice = ask('Input the number corresponding to your choice. I want to know more about:')
 
         # If the choice is valid, call the appropriate function
         if user_choice in dic.keys():
             if user_choice == '1':
-                favourite_team(user_name, teams_dict, teams_info, team_roster_df)  # Explore teams
-                break
+                return favourite_team(user_name, teams_dict, teams_info, team_roster_df)  # Explore teams
             else:
-                favourite_players(user_name, team_roster_df)  # Explore players
-                break
+                return favourite_players(user_name, team_roster_df)  # Explore players
         else:
             # Invalid input → prompt again
-            print('Please enter a valid choice')
+            say('Please enter a valid choice')
 
 # %%
 def post_search_menu(user_name):
-    """Handles the menu after a search to return to main menu or exit."""
+    """Handles the menu after a search and returns the next phase: main menu or exit."""
     while True:
-        menu_choice = input("Would you like to return to the main menu (1) or exit (2)? ")
+        menu_choice = ask("Would you like to return to the main menu (1) or exit (2)? ")
         if menu_choice == '1':
-            first_phase(user_name)
-            return True  # Signal to exit current function
+            return 'main_menu'  # The dispatcher shows the main menu again
         elif menu_choice == '2':
-            print("\n Thank you, Goodbye!")
-            return True  # Signal to exit current function
+            say("\n Thank you, Goodbye!")
+            return 'exit'
         else:
-            print("Invalid choice. Please enter 1 or 2.")
-    return False
+            say("Invalid choice. Please enter 1 or 2.")
 
 # %%
 def favourite_team(user_name, teams_dict, teams_info, team_roster_df):
@@ -249,146 +1764,946 @@ def favourite_team(user_name, teams_dict, teams_info, team_roster_df):
     """
     # This loop allows the user to look up multiple teams until they choose to stop.
     while True:
-        print("\n---------------------------------------------------")
+        say("\n---------------------------------------------------")
         # Dynamically generate the team list from the dictionary.
         for team_id, team_name in teams_dict.items():
-            print(f"{team_id}. {team_name.split(' FC')[0]}")
-        print("---------------------------------------------------")
+            say(f"{team_id}. {team_name.split(' FC')[0]}")
+        say("---------------------------------------------------")
 
-        user_favourite_team = input("What is your favourite team? (Insert the corresponding number):").strip()
+        user_favourite_team = ask("What is your favourite team? (Insert the corresponding number):").strip()
 
         # Check if the user's input is a valid team ID.
         if user_favourite_team in teams_dict:
             team_name = teams_dict[user_favourite_team]
+            METRICS.count('team_searches')
+
+            #Print the team profile
+            say(f"\nTeam profile of {team_name}:\n")
+            for key, value in teams_info[team_name].items():
+                say(f"{key}: {value}")
+            another_search = ask("\nWould you like to look up another team? (yes/no): ").strip().lower()
+            while another_search not in ['yes','no']:
+                say("\nInvalid choice. Please enter 'yes' or 'no'.")
+                another_search = ask("\nWould you like to look up another team? (yes/no): ").strip().lower()
+            if another_search == "no":
+                say("\nThank you for using the team information tool!")
+                # Give the option to go to the main menu or exit the program entirely.
+                return post_search_menu(user_name) # The return exits the favourite_team function.
+            else:
+                continue
+
+
+        else:
+            say("Invalid team selection. Please choose a valid team number.")
+
+# %% [markdown]
+# ## 3.2 Player Discovery Functions
+
+# %%
+def fold_text(text):
+    """
+    Folds a name for matching: accents removed, case-folded, dashes unified,
+    other punctuation dropped and whitespace collapsed ("Noémi  PAQUIN" -> "noemi paquin").
+    """
+    folded = []
+    for char in unicodedata.normalize('NFKD', str(text)):
+        category = unicodedata.category(char)
+        if unicodedata.combining(char) or category == 'Cc':
+            continue
+        if category == 'Pd':
+            folded.append('-')
+        elif category.startswith('P'):
+            continue
+        else:
+            folded.append(char)
+    return ' '.join(''.join(folded).casefold().split())
+
+
+def edit_distance(a, b, limit):
+    """
+    Levenshtein distance between two strings, giving up early once it exceeds limit.
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+# Names shortlisted by trigram overlap before fuzzy matching computes edit distances
+FUZZY_CANDIDATES = 50
+
+
+class PlayerNameIndex:
+    """
+    Player-name search over folded names: exact lookup, prefix autocomplete on the full
+    name or any later word (surnames), and typo-tolerant matching through trigrams.
+    """
+
+    def __init__(self, team_roster_df):
+        names = team_roster_df['name'].fillna('') if 'name' in team_roster_df.columns else []
+        self.folded_names = [fold_text(name) for name in names]
+        prefix_keys = []
+        self.trigrams = defaultdict(list)
+        for row, folded in enumerate(self.folded_names):
+            self._index_name(row, folded, prefix_keys)
+        self._finish(prefix_keys)
+
+    def _index_name(self, row, folded, prefix_keys):
+        words = folded.split()
+        for start in range(len(words)):
+            prefix_keys.append((' '.join(words[start:]), row))
+        for gram in self._grams(folded):
+            self.trigrams[gram].append(row)
+
+    def _finish(self, prefix_keys):
+        # First row wins for duplicate names
+        self.exact = {}
+        for row, folded in enumerate(self.folded_names):
+            self.exact.setdefault(folded, row)
+        # Sorted array of (suffix of words, row) for bisect-based prefix search
+        prefix_keys.sort()
+        self.prefix_keys = [key for key, _ in prefix_keys]
+        self.prefix_rows = [row for _, row in prefix_keys]
+        self.name_lengths = np.fromiter(map(len, self.folded_names), dtype=np.intp, count=len(self.folded_names))
+        # The same keys split by rank (full name before surname, then name length), so a
+        # prefix search can stop as soon as it has enough rows instead of walking every match
+        buckets = defaultdict(lambda: ([], []))
+        for key, row in zip(self.prefix_keys, self.prefix_rows):
+            name = self.folded_names[row]
+            keys, rows = buckets[(0 if key == name else 1, len(name))]
+            keys.append(key)
+            rows.append(row)
+        self.prefix_buckets = [buckets[rank] for rank in sorted(buckets)]
+
+    @staticmethod
+    def _grams(folded):
+        padded = f"  {folded} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    @timed('discover.names_apply_delta')
+    def apply_delta(self, team_roster_df, delta):
+        """
+        Returns the index of an updated roster: kept names move to their new rows and only
+        added or changed names are folded and indexed again.
+        """
+        index = object.__new__(PlayerNameIndex)
+        remap = delta.remap.copy()
+        remap[delta.stale_rows] = -1
+        names = team_roster_df['name'].fillna('').to_numpy() if 'name' in team_roster_df.columns else []
+
+        index.folded_names = [''] * len(team_roster_df)
+        for old_row, folded in enumerate(self.folded_names):
+            if remap[old_row] >= 0:
+                index.folded_names[remap[old_row]] = folded
+
+        # Move the surviving entries to their new rows, then index the dirty rows
+        new_rows = remap[np.array(self.prefix_rows, dtype=np.intp)] if self.prefix_rows else np.empty(0, dtype=np.intp)
+        prefix_keys = [(key, row) for key, row in zip(self.prefix_keys, new_rows.tolist()) if row >= 0]
+        index.trigrams = defaultdict(list)
+        for gram, rows in self.trigrams.items():
+            rows = remap[rows]
+            rows = rows[rows >= 0].tolist()
+            if rows:
+                index.trigrams[gram] = rows
+        for row in delta.dirty_rows.tolist():
+            index.folded_names[row] = fold_text(names[row])
+            index._index_name(row, index.folded_names[row], prefix_keys)
+            for gram in index._grams(index.folded_names[row]):
+                index.trigrams[gram].sort()
+        index._finish(prefix_keys)
+        return index
+
+    def lookup(self, query):
+        """
+        Returns the row of the player whose folded name equals the query, or None.
+        """
+        return self.exact.get(fold_text(query))
+
+    def prefix(self, query, limit=5):
+        """
+        Rows whose full name or surname starts with the query: full-name matches first,
+        then shorter names, then alphabetical.
+        """
+        folded = fold_text(query)
+        if not folded:
+            return []
+        ranked = []
+        seen = set()
+        for keys, rows in self.prefix_buckets:
+            position = bisect_left(keys, folded)
+            while position < len(keys) and keys[position].startswith(folded):
+                row = rows[position]
+                if row not in seen:
+                    seen.add(row)
+                    ranked.append(row)
+                    if len(ranked) == limit:
+                        return ranked
+                position += 1
+        return ranked
+
+    def fuzzy(self, query, limit=5, max_distance=None, candidates=FUZZY_CANDIDATES):
+        """
+        Rows whose name (or one of its words) is within max_distance edits of the query
+        (by default about one edit per four characters, at most three).
+        """
+        folded = fold_text(query)
+        if not folded:
+            return []
+        if max_distance is None:
+            max_distance = min(3, max(1, len(folded) // 4))
+        # Shortlist by the share of trigrams in common (Dice coefficient, name length standing in
+        # for its trigram count), so short close names beat long names that merely contain the
+        # query; then rank the shortlist by edit distance
+        grams = self._grams(folded)
+        overlap = Counter()
+        for gram in grams:
+            overlap.update(self.trigrams.get(gram, ()))
+        rows = np.fromiter(overlap.keys(), dtype=np.intp, count=len(overlap))
+        shared = np.fromiter(overlap.values(), dtype=np.float64, count=len(overlap))
+        ratio = 2 * shared / (len(grams) + self.name_lengths[rows] + 1)
+        shortlist = rows[np.lexsort((rows, -ratio))[:candidates]]
+        scored = []
+        for row in shortlist.tolist():
+            name = self.folded_names[row]
+            distance = min([edit_distance(folded, name, max_distance)] +
+                           [edit_distance(folded, word, max_distance) for word in name.split()])
+            if distance <= max_distance:
+                scored.append((distance, -overlap[row], row))
+        scored.sort()
+        return [row for _, _, row in scored[:limit]]
+
+    @timed('discover.player_search')
+    def search(self, query, limit=5):
+        """
+        Ranked matches for a query: exact name, then prefix completions, then close spellings.
+        """
+        exact = self.lookup(query)
+        results = [] if exact is None else [exact]
+        for row in self.prefix(query, limit):
+            if row not in results:
+                results.append(row)
+        # Only pay for typo-tolerant matching when completions did not fill the list
+        if len(results) < limit:
+            for row in self.fuzzy(query, limit):
+                if row not in results:
+                    results.append(row)
+        return results[:limit]
+
+
+def get_player_name_index(team_roster_df=None):
+    """
+    Returns the name index of a roster, built once per roster version for the live roster.
+    """
+    return roster_derived('player_names', PlayerNameIndex, team_roster_df)
+
+
+def print_player_card(player_data):
+    say(f""" | Player Profile |
+==========================================================
+- Name: {player_data['name']}
+- Team: {player_data['team']}
+- Position: {player_data['position']}
+- Nationality: {player_data['nationality']}""")
+
+
+def choose_player_match(name_index, player_choice, team_roster_df):
+    """
+    Offers the closest names for an unknown player and returns the chosen row, or None to search again.
+    """
+    matches = name_index.search(player_choice)
+    if not matches:
+        say("\nSorry, that's not a valid player name or position.")
+        return None
+    if len(matches) == 1:
+        return matches[0]
+
+    say("\nDid you mean one of these players?")
+    for number, row in enumerate(matches, 1):
+        say(f"{number}. {team_roster_df.iloc[row]['name']} ({team_roster_df.iloc[row]['team']})")
+    choice = ask("Enter the number of the player (or press Enter to search again): ").strip()
+    if choice.isdigit() and 1 <= int(choice) <= len(matches):
+        return matches[int(choice) - 1]
+    return None
+
+# %%
+# plotly is only needed for the country map, so it is imported when the map is first drawn
+px = LazyModule('plotly.express', 'px')
+pio = LazyModule('plotly.io', 'pio')
+
+# Nationality adjectives fans type instead of the country ("Canadian forwards"), folded,
+# mapped to the country as the roster spells it (also folded)
+COUNTRY_DEMONYMS = {
+    'canadian': 'canada', 'american': 'usa', 'united states': 'usa', 'new zealander': 'new zealand',
+    'kiwi': 'new zealand', 'welsh': 'wales', 'japanese': 'japan', 'korean': 'south korea',
+    'south korean': 'south korea', 'swedish': 'sweden', 'filipino': 'philippines', 'filipina': 'philippines',
+    'norwegian': 'norway', 'german': 'germany', 'jamaican': 'jamaica', 'algerian': 'algeria',
+    'australian': 'australia', 'venezuelan': 'venezuela', 'afghan': 'afghanistan', 'dutch': 'netherlands',
+    'croatian': 'croatia', 'northern irish': 'northern ireland', 'finnish': 'finland', 'icelandic': 'iceland',
+    'irish': 'ireland', 'nigerian': 'nigeria', 'polish': 'poland', 'english': 'england', 'scottish': 'scotland',
+    'french': 'france', 'spanish': 'spain', 'italian': 'italy', 'mexican': 'mexico', 'brazilian': 'brazil',
+    'colombian': 'colombia', 'danish': 'denmark', 'haitian': 'haiti', 'ghanaian': 'ghana', 'chinese': 'china',
+}
+
+def country_key(folded):
+    """
+    Returns the folded country a folded nationality or country name refers to ("canadian" -> "canada").
+    """
+    return COUNTRY_DEMONYMS.get(folded, folded)
+
+def normalize_country(country):
+    """
+    Key of a country in the nationality index: folded, with demonyms mapped to their country.
+    """
+    return country_key(fold_text(country))
+
+
+class NationalityIndex:
+    """
+    Inverted index from country (see normalize_country()) to roster row ids, with precomputed
+    player counts. "Japan" and "Japanese" in the roster are the same country.
+    """
+
+    def __init__(self, team_roster_df):
+        if 'nationality' in team_roster_df.columns:
+            # Normalise each distinct nationality once, then map the players' codes to it
+            codes, values = pd.factorize(team_roster_df['nationality'])
+            keys = np.array([normalize_country(value) for value in values] + [''], dtype=object)
+            normalized = keys[codes]
+        else:
+            normalized = np.empty(0, dtype=object)
+
+        # Group row ids by country with one stable sort instead of a scan per country
+        codes, countries = pd.factorize(normalized)
+        counts = np.bincount(codes, minlength=len(countries))
+        groups = np.split(np.argsort(codes, kind='stable'), np.cumsum(counts)[:-1]) if len(countries) else []
+        self.rows = {country: rows for country, rows in zip(countries, groups) if country}
+        self._count_players()
+
+    def _count_players(self):
+        # Same table as value_counts(): most represented countries first
+        self.counts = pd.DataFrame({
+            'country': list(self.rows),
+            'count': [len(rows) for rows in self.rows.values()]
+        }).sort_values('count', ascending=False, kind='stable').reset_index(drop=True)
+
+    def apply_delta(self, team_roster_df, delta):
+        """
+        Returns the index of an updated roster, regrouping only the added or changed players.
+        """
+        index = object.__new__(NationalityIndex)
+        remap = delta.remap.copy()
+        remap[delta.stale_rows] = -1
+        nationalities = team_roster_df['nationality'].astype(object).fillna('').to_numpy() \
+            if 'nationality' in team_roster_df.columns else np.full(len(team_roster_df), '', dtype=object)
+
+        groups = {}
+        for country, rows in self.rows.items():
+            rows = remap[rows]
+            groups[country] = [rows[rows >= 0]]
+        for row in delta.dirty_rows.tolist():
+            country = normalize_country(nationalities[row])
+            if country:
+                groups.setdefault(country, []).append(np.array([row], dtype=np.intp))
+
+        # Countries stay in order of their first player, as when built from scratch
+        rows_by_country = {country: np.sort(np.concatenate(parts)) for country, parts in groups.items()}
+        index.rows = {country: rows for country, rows in
+                      sorted(rows_by_country.items(), key=lambda item: item[1][0] if len(item[1]) else -1)
+                      if len(rows)}
+        index._count_players()
+        return index
+
+    def players(self, country):
+        """
+        Returns the roster row ids of the players from a country, also given as its
+        nationality ("Canadian"); empty if none.
+        """
+        return self.rows.get(normalize_country(country), np.empty(0, dtype=np.intp))
+
+
+def get_nationality_index(team_roster_df=None):
+    return roster_derived('nationalities', NationalityIndex, team_roster_df)
+
+
+def build_country_map_json(nationality_index):
+    """
+    Returns the choropleth of players per country as plotly JSON. The figure only depends
+    on the country counts, so it is cached on disk under a hash of them and reused by
+    every session and worker process.
+    """
+    country_counts = nationality_index.counts
+    counts_hash = hashlib.sha1(country_counts.to_json().encode('utf-8')).hexdigest()[:16]
+    cache_path = data_path(os.path.join('cache', f'country_map-{counts_hash}.json'))
+    if os.path.exists(cache_path):
+        with open(cache_path, encoding='utf-8') as cached:
+            return cached.read()
+
+    fig = px.choropleth(
+        country_counts,
+        locations="country",
+        locationmode="country names",
+        color="count",
+        hover_name="country",
+        color_continuous_scale=px.colors.sequential.Plasma,
+        title="Spread of NSL Players by Country"
+    )
+    fig_json = fig.to_json()
+
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path + '.tmp', mode='w', encoding='utf-8') as cached:
+            cached.write(fig_json)
+        os.replace(cache_path + '.tmp', cache_path)
+    except OSError as error:
+        print(f"Error: Could not cache the country map: {error}")
+    return fig_json
+
+
+def get_country_map_json(team_roster_df=None):
+    """
+    Returns the country map JSON, built once per roster version.
+    """
+    return roster_derived('country_map', lambda roster: build_country_map_json(get_nationality_index(roster)),
+                          team_roster_df)
+
+def group_rows(keys):
+    """
+    Groups row ids by key: {key: sorted row ids}, keys in order of their first row; '' keys are dropped.
+    """
+    codes, uniques = pd.factorize(np.asarray(keys, dtype=object))
+    counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+    order = np.argsort(codes, kind='stable')
+    order = order[codes[order] >= 0]
+    groups = np.split(order, np.cumsum(counts)[:-1]) if len(uniques) else []
+    return {key: rows for key, rows in zip(uniques, groups) if key != ''}
+
+
+class RosterQueryIndex:
+    """
+    Precomputed posting lists for combined roster filters: sorted row ids per team,
+    position, nationality and attribute, plus the rows ordered by jersey number.
+    A query intersects the lists of its filters, smallest first, instead of scanning
+    the roster once per filter.
+    """
+    FIELDS = ('team', 'position', 'nationality')
+
+    def __init__(self, team_roster_df):
+        self.size = len(team_roster_df)
+        self.postings = {}  # field -> {folded value: sorted row ids}
+        self.labels = {}    # field -> {folded value: value as written in the roster}
+        for field in self.FIELDS:
+            keys = np.full(self.size, '', dtype=object)
+            self.labels[field] = {}
+            if field in team_roster_df.columns:
+                # Fold each distinct value once, then map the players' codes to it
+                codes, values = pd.factorize(team_roster_df[field])
+                folded = np.array([fold_text(value) for value in values] + [''], dtype=object)
+                keys = folded[codes]
+                for key, value in zip(folded, values):
+                    self.labels[field].setdefault(key, str(value))
+            self.postings[field] = group_rows(keys)
+
+        # Attributes: each distinct attribute string is parsed once and its rows shared
+        self.attributes = {}
+        if 'attributes' in team_roster_df.columns:
+            string_codes, strings = pd.factorize(team_roster_df['attributes'].fillna(''))
+            parts = defaultdict(list)
+            for code, rows in group_rows(string_codes).items():
+                for attribute in split_attributes(strings[code]):
+                    parts[attribute].append(rows)
+            self.attributes = {attribute: np.sort(np.concatenate(rows)) for attribute, rows in parts.items()}
+        self._index_jerseys(team_roster_df)
+
+    def _index_jerseys(self, team_roster_df):
+        if 'jersey' in team_roster_df.columns:
+            jerseys = pd.to_numeric(team_roster_df['jersey'], errors='coerce')
+            rows = np.flatnonzero(jerseys.notna().to_numpy())
+            values = jerseys.to_numpy(dtype=np.float64, na_value=np.nan)[rows]
+            order = np.argsort(values, kind='stable')
+            self.jersey_values, self.jersey_rows = values[order], rows[order]
+        else:
+            self.jersey_values, self.jersey_rows = np.empty(0), np.empty(0, dtype=np.intp)
+
+    @timed('discover.query_index_delta')
+    def apply_delta(self, team_roster_df, delta):
+        """
+        Returns the index of an updated roster: kept players' row ids are remapped and only
+        the added or changed players are indexed again.
+        """
+        index = object.__new__(RosterQueryIndex)
+        index.size = len(team_roster_df)
+        remap = delta.remap.copy()
+        remap[delta.stale_rows] = -1
+        dirty = delta.dirty_rows
+
+        def remapped(postings, dirty_keys):
+            groups = {}
+            for key, rows in postings.items():
+                rows = remap[rows]
+                groups[key] = [rows[rows >= 0]]
+            for key, rows in dirty_keys.items():
+                groups.setdefault(key, []).append(dirty[rows])
+            merged = {key: np.sort(np.concatenate(parts)) for key, parts in groups.items()}
+            return {key: rows for key, rows in merged.items() if len(rows)}
+
+        index.postings, index.labels = {}, {}
+        for field in self.FIELDS:
+            index.labels[field] = dict(self.labels[field])
+            values = team_roster_df[field].to_numpy()[dirty] if field in team_roster_df.columns \
+                else np.full(len(dirty), '', dtype=object)
+            keys = []
+            for value in values:
+                key = '' if pd.isna(value) else fold_text(value)
+                index.labels[field].setdefault(key, str(value))
+                keys.append(key)
+            index.postings[field] = remapped(self.postings[field], group_rows(keys))
+
+        dirty_attributes = defaultdict(list)
+        if 'attributes' in team_roster_df.columns:
+            for position, text in enumerate(team_roster_df['attributes'].fillna('').to_numpy()[dirty]):
+                for attribute in split_attributes(text):
+                    dirty_attributes[attribute].append(position)
+        index.attributes = remapped(self.attributes, {attribute: np.array(positions, dtype=np.intp)
+                                                      for attribute, positions in dirty_attributes.items()})
+        # One vectorized sort: cheaper than patching the jersey order row by row
+        index._index_jerseys(team_roster_df)
+        return index
+
+    def resolve(self, field, value):
+        """
+        Returns the folded values of a field matching the user's text: the exact value
+        if there is one, otherwise every value with a word starting with it ("rapid" ->
+        "ottawa rapid fc"). Nationalities match by country, whether the text or the roster
+        uses the country or its demonym ("Canadian" finds "Canada").
+        """
+        folded = fold_text(value)
+        postings = self.postings[field]
+        if not folded:
+            return []
+        if field == 'nationality':
+            country = country_key(folded)
+            same_country = [key for key in postings if country_key(key) == country]
+            if same_country:
+                return same_country
+        if folded in postings:
+            return [folded]
+        return [key for key in postings if f" {key}".find(f" {folded}") >= 0]
+
+    def rows_for(self, field, value):
+        """
+        Sorted row ids of the players whose field matches value (see resolve()).
+        """
+        keys = self.resolve(field, value)
+        if len(keys) == 1:
+            return self.postings[field][keys[0]]
+        if not keys:
+            return np.empty(0, dtype=np.intp)
+        return np.unique(np.concatenate([self.postings[field][key] for key in keys]))
+
+    def jersey_range(self, low, high):
+        """
+        Sorted row ids of the players whose jersey number is between low and high (inclusive).
+        """
+        start = np.searchsorted(self.jersey_values, low, side='left')
+        stop = np.searchsorted(self.jersey_values, high, side='right')
+        return np.sort(self.jersey_rows[start:stop])
+
+    @timed('discover.roster_query')
+    def query(self, team=None, position=None, nationality=None, jersey=None, attributes=None):
+        """
+        Returns the sorted row ids of the players matching every given filter. jersey is a
+        (low, high) range and attributes an "A | B" string (or list) of attributes all required.
+        """
+        candidates = []
+        for field, value in (('team', team), ('position', position), ('nationality', nationality)):
+            if value:
+                candidates.append(self.rows_for(field, value))
+        if jersey is not None:
+            candidates.append(self.jersey_range(*jersey))
+        if attributes:
+            texts = [attributes] if isinstance(attributes, str) else attributes
+            for attribute in [attribute for text in texts for attribute in split_attributes(text)]:
+                candidates.append(self.attributes.get(attribute, np.empty(0, dtype=np.intp)))
+        if not candidates:
+            return np.arange(self.size)
+
+        # Intersect from the most selective list, stopping as soon as nothing is left
+        candidates.sort(key=len)
+        rows = candidates[0]
+        for other in candidates[1:]:
+            if not len(rows):
+                break
+            rows = np.intersect1d(rows, other, assume_unique=True)
+        return rows
+
+
+def get_roster_query_index(team_roster_df=None):
+    """
+    Returns the query index of a roster, built once per roster version for the live roster.
+    """
+    return roster_derived('roster_query', RosterQueryIndex, team_roster_df)
+
+
+def player_lines(team_roster_df, rows, columns=('name', 'team')):
+    """
+    "Name: ..., Team: ..." lines for the given roster rows, read column by column
+    instead of with iterrows(). Missing values are shown as '-'.
+    """
+    values = [team_roster_df[column].iloc[rows].tolist() for column in columns]
+    return [', '.join(f"{column.title()}: {'-' if pd.isna(value) else value}" for column, value in zip(columns, row))
+            for row in zip(*values)]
+
+
+# Results shown per page by the multi-filter player search
+QUERY_PAGE_SIZE = 10
+
+def parse_jersey_range(text):
+    """
+    Parses "9" or "1-11" into an inclusive (low, high) range; None if the text is not one.
+    """
+    bounds = text.replace(' ', '').split('-')
+    if len(bounds) not in (1, 2) or not all(bound.isdigit() for bound in bounds):
+        return None
+    low, high = int(bounds[0]), int(bounds[-1])
+    return (low, high) if low <= high else (high, low)
+
+
+def ask_query_filter(prompt, check):
+    """
+    Asks for one optional filter until the answer is blank or check(answer) accepts it.
+    check returns the value to filter on, or None after explaining what was wrong.
+    """
+    while True:
+        answer = ask(prompt).strip()
+        if not answer:
+            return None
+        value = check(answer)
+        if value is not None:
+            return value
+
+
+def roster_query_search(user_name, team_roster_df):
+    """
+    Multi-filter player search: asks for a team, position, country, jersey range and
+    required attributes (each optional), then pages through the matching players.
+    """
+    query_index = get_roster_query_index(team_roster_df)
+    teams = [query_index.labels['team'][key] for key in query_index.postings['team']]
+
+    def check_field(field, description):
+        def check(answer):
+            if not query_index.resolve(field, answer):
+                say(f"Sorry, there is no {description} matching '{answer}'.")
+                return None
+            return answer
+        return check
+
+    def check_team(answer):
+        if answer.isdigit() and 1 <= int(answer) <= len(teams):
+            return teams[int(answer) - 1]
+        return check_field('team', 'team')(answer)
+
+    def check_jersey(answer):
+        jersey = parse_jersey_range(answer)
+        if jersey is None:
+            say("Please enter a jersey number (e.g. 9) or a range (e.g. 1-11).")
+        return jersey
+
+    def check_attributes(answer):
+        unknown = [attribute for attribute in split_attributes(answer) if attribute not in query_index.attributes]
+        if unknown:
+            say(f"Sorry, no player has the attribute(s): {', '.join(unknown)}.")
+            return None
+        return answer
+
+    while True:
+        say("\nLeave a filter blank to skip it.")
+        for number, team in enumerate(teams, 1):
+            say(f"{number}. {team}")
+        filters = {
+            'team': ask_query_filter("Team (number or name): ", check_team),
+            'position': ask_query_filter("Position (Goalkeeper, Defender, Midfielder, Forward): ",
+                                         check_field('position', 'position')),
+            'nationality': ask_query_filter("Country or nationality (e.g. Canada or Canadian): ",
+                                            check_field('nationality', 'country')),
+            'jersey': ask_query_filter("Jersey number or range (e.g. 1-11): ", check_jersey),
+            'attributes': ask_query_filter("Required attributes, separated by '|' (e.g. Finishing | Speed): ",
+                                           check_attributes),
+        }
+        METRICS.count('roster_queries')
+        rows = query_index.query(**filters)
+
+        say(f"\n| {len(rows)} players found |")
+        say("==========================================================")
+        for start in range(0, len(rows), QUERY_PAGE_SIZE):
+            for line in player_lines(team_roster_df, rows[start:start + QUERY_PAGE_SIZE],
+                                     ('name', 'team', 'position', 'jersey')):
+                say(line)
+            remaining = len(rows) - start - QUERY_PAGE_SIZE
+            if remaining > 0:
+                more = ask(f"\nShow the next {min(remaining, QUERY_PAGE_SIZE)} of {remaining} remaining players? (yes/no): ").strip().lower()
+                if more != 'yes':
+                    break
+
+        another_search = ask("\nWould you like to run another search? (yes/no): ").strip().lower()
+        while another_search not in ['yes', 'no']:
+            say("Please enter 'yes' or 'no'.")
+            another_search = ask("Would you like to run another search? (yes/no): ").strip().lower()
+        if another_search == 'no':
+            return post_search_menu(user_name)
+
+
+# "Players like X": similarity is the attribute cosine (0 to 1) plus these bonuses for
+# sharing a position, nationality or club with X (0 leaves a criterion out)
+SIMILARITY_WEIGHTS = {'position': 0.5, 'nationality': 0.0, 'team': 0.0}
+SIMILAR_PLAYERS_K = 10
+# Similarities computed per block (profiles x profiles): about 16 MB of float32
+NEIGHBOUR_BLOCK_CELLS = 4_000_000
+
+def similarity_features(engine, weights):
+    """
+    Returns (features, categories, keys) of every roster row: the attribute bitmask as a
+    unit-length float32 vector (so a dot product is the attribute cosine), the
+    (codes, weight) pair of each weighted column, and keys that are equal for rows with
+    the same attributes and weighted categories.
+    """
+    n = len(engine.team_roster_df)
+    if engine.masks is None:
+        features = np.zeros((n, 0), dtype=np.float32)
+        keys = [np.zeros((n, 1), dtype=np.int64)]
+    else:
+        bits = np.unpackbits(np.ascontiguousarray(engine.masks).view(np.uint8), axis=1, bitorder='little')
+        features = bits[:, :len(engine.vocabulary)].astype(np.float32)
+        sizes = engine.sizes.astype(np.float32)
+        features /= np.sqrt(np.where(sizes > 0, sizes, 1))[:, None]
+        keys = [engine.masks.view(np.int64)]
+    categories = [(engine.codes[column], weight) for column, weight in weights.items()
+                  if weight and column in engine.codes]
+    keys += [codes.astype(np.int64)[:, None] for codes, _ in categories]
+    return features, categories, np.hstack(keys)
+
+
+class NeighbourTable:
+    """
+    The K most similar players of every player, computed once per roster version.
+    rows[i] are the roster rows of player i's neighbours, best first (ties by row,
+    -1 pads rosters with fewer players), and scores[i] their similarity; stored as
+    int32 / float32 so a lookup is a slice.
+
+    Players with the same attributes and weighted categories share one profile, and
+    similarities are computed between profiles, a block of them at a time (one matrix
+    product per block for the attributes, plus the category bonuses): no roster x
+    roster matrix is ever held in memory.
+    """
 
-            #Print the team profile
-            print(f"\nTeam profile of {team_name}:\n")
-            for key, value in teams_info[team_name].items():
-                print(f"{key}: {value}")
-            another_search = input("\nWould you like to look up another team? (yes/no): ").strip().lower()
-            while another_search not in ['yes','no']:
-                print("\nInvalid choice. Please enter 'yes' or 'no'.")
-                another_search = input("\nWould you like to look up another team? (yes/no): ").strip().lower()
-            if another_search == "no":
-                print("\nThank you for using the team information tool!")
-                # Give the option to go to the main menu or exit the program entirely.
-                if post_search_menu(user_name):
-                    return # The return exits the favourite_team function.
-                break # This break exits the main 'while' loop, also ending the function.
+    def __init__(self, team_roster_df, k=SIMILAR_PLAYERS_K, weights=None):
+        self.team_roster_df = team_roster_df
+        self.k = k
+        self.weights = dict(SIMILARITY_WEIGHTS if weights is None else weights)
+        self.rows = np.full((len(team_roster_df), k), -1, dtype=np.int32)
+        self.scores = np.zeros((len(team_roster_df), k), dtype=np.float32)
+        if len(team_roster_df) > 1:
+            self._fill(get_recommender(team_roster_df))
+
+    @timed('neighbours.build')
+    def _fill(self, engine):
+        features, categories, keys = similarity_features(engine, self.weights)
+        _, first, profile_of = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+        profile_of = profile_of.ravel()
+        features = features[first]
+        categories = [(codes[first], weight) for codes, weight in categories]
+        n_profiles, width = len(first), self.k + 1
+
+        # A player's k neighbours are among the first k + 1 rows of the best k + 1 profiles
+        # (counting their own): heads[p] holds those rows of profile p, padded with -1
+        order = np.argsort(profile_of, kind='stable')
+        rank = np.arange(len(order)) - np.searchsorted(profile_of[order], profile_of[order])
+        heads = np.full((n_profiles, width), -1, dtype=np.int32)
+        kept = rank < width
+        heads[profile_of[order][kept], rank[kept]] = order[kept]
+
+        # The best k + 1 candidate rows of every profile, best first and ties by row
+        ranked_rows = np.empty((n_profiles, width), dtype=np.int32)
+        ranked_scores = np.empty((n_profiles, width), dtype=np.float32)
+        top = min(width, n_profiles)
+        block = max(1, NEIGHBOUR_BLOCK_CELLS // n_profiles)
+        for start in range(0, n_profiles, block):
+            similarities = features[start:start + block] @ features.T
+            for codes, weight in categories:
+                # Unknown categories (-1) get -2 on this side so they never match
+                block_codes = np.where(codes[start:start + block] >= 0, codes[start:start + block], -2)
+                np.add(similarities, weight, out=similarities, where=block_codes[:, None] == codes[None, :])
+            if top < n_profiles:
+                best = np.argpartition(-similarities, top - 1, axis=1)[:, :top]
             else:
-                continue
-
+                best = np.broadcast_to(np.arange(n_profiles), similarities.shape)
+            rows = heads[best].reshape(len(best), -1)
+            scores = np.repeat(np.take_along_axis(similarities, best, axis=1), width, axis=1)
+            scores[rows < 0] = -np.inf
+            ranking = np.lexsort((rows, -scores))[:, :width]
+            ranked_rows[start:start + block] = np.take_along_axis(rows, ranking, axis=1)
+            ranked_scores[start:start + block] = np.take_along_axis(scores, ranking, axis=1)
+
+        # Every player gets their profile's list without themselves, or else without its last entry
+        rows = ranked_rows[profile_of]
+        keep = rows != np.arange(len(rows))[:, None]
+        keep[keep.all(axis=1), -1] = False
+        self.rows = rows[keep].reshape(-1, self.k)
+        self.scores = np.where(self.rows >= 0, ranked_scores[profile_of][keep].reshape(-1, self.k), 0).astype(np.float32)
+
+    def similar(self, row, limit=None):
+        """
+        Returns (rows, scores) of the players most similar to a roster row, best first.
+        """
+        count = int(np.count_nonzero(self.rows[row] >= 0))
+        if limit is not None:
+            count = min(count, limit)
+        return self.rows[row, :count], self.scores[row, :count]
+
+    def to_snapshot(self):
+        """
+        Returns (arrays, metadata) to save the table in the data snapshot.
+        """
+        return {'rows': self.rows, 'scores': self.scores}, \
+            {'rows': len(self.rows), 'k': self.k, 'weights': self.weights}
+
+    @classmethod
+    def from_snapshot(cls, team_roster_df, arrays, meta):
+        """
+        Rebuilds a table from to_snapshot() output, or returns None if it was computed
+        for another roster size, K or weights.
+        """
+        if meta['rows'] != len(team_roster_df) or meta['k'] != SIMILAR_PLAYERS_K or \
+                meta['weights'] != SIMILARITY_WEIGHTS:
+            return None
+        table = object.__new__(cls)
+        table.team_roster_df = team_roster_df
+        table.k, table.weights = meta['k'], dict(meta['weights'])
+        table.rows, table.scores = arrays['rows'], arrays['scores']
+        return table
+
+
+def get_similar_players(team_roster_df=None):
+    """
+    Returns the neighbour table of a roster, built once per roster version for the live roster.
+    """
+    return roster_derived('neighbours', NeighbourTable, team_roster_df)
 
-        else:
-            print("Invalid team selection. Please choose a valid team number.")
 
-# %% [markdown]
-# ## 3.2 Player Discovery Functions
+def print_similar_players(team_roster_df, player_row, limit=5):
+    """
+    Lists the players most similar to the one whose card was just shown.
+    """
+    with span('discover.similar_players'):
+        rows, _ = get_similar_players(team_roster_df).similar(player_row, limit)
+    if len(rows):
+        say(f"\nPlayers like {team_roster_df['name'].iloc[player_row]}:")
+        for line in player_lines(team_roster_df, rows, ('name', 'team', 'position')):
+            say(f"- {line}")
 
-# %%
-import plotly.express as px
-from IPython.display import display  # for inline, non-blocking map in Colab
 
 def favourite_players(user_name, team_roster_df):
     """
     Handles the main menu and logic for searching players from the roster.
-    Works with input() for all interactions.
+    Works with ask() for all interactions.
     """
     while True:
         # Show the main menu
-        print(f"""\nGreat option! How would you like to know more about the NSL league players?
+        say(f"""\nGreat option! How would you like to know more about the NSL league players?
 1. Search by player name or position (Goalkeeper, Defender, Midfielder, Forward)
-2. Find a player from my favourite country""")
+2. Find a player from my favourite country
+3. Search with several filters (team, position, country, jersey, attributes)""")
 
-        input_choice = input('Input the number corresponding to your choice here:').strip()
+        input_choice = ask('Input the number corresponding to your choice here:').strip()
 
         # ---------------------- OPTION 1 ----------------------
         if input_choice == '1':
             while True:
-                player_choice = input('Enter the full player name or position: ').title().strip()
+                player_choice = ask('Enter the full player name or position: ').strip()
+                METRICS.count('player_searches')
+                with span('discover.player_lookup'):
+                    name_index = get_player_name_index(team_roster_df)
+                    player_row = name_index.lookup(player_choice)
+                query_index = get_roster_query_index(team_roster_df)
+                position_key = fold_text(player_choice)
           #check if the name entered is in the dataset of players and print the player profile card
-                if player_choice in team_roster_df['name'].values:
-                    player_data = team_roster_df.loc[team_roster_df['name'] == player_choice].iloc[0]
-                    print(f""" | Player Profile |
-==========================================================
-- Name: {player_data['name']}
-- Team: {player_data['team']}
-- Position: {player_data['position']}
-- Nationality: {player_data['nationality']}""")
+                if player_row is not None:
+                    print_player_card(team_roster_df.iloc[player_row])
+                    print_similar_players(team_roster_df, player_row)
                 #repeat the same process but with the position
-                elif player_choice in team_roster_df['position'].values:
-                    filtered_players = team_roster_df[team_roster_df['position'] == player_choice]
-                    print(f"\n| All Players with the position: {player_choice} |")
-                    print("==========================================================")
-                    for _, row in filtered_players.iterrows():
-                        print(f"Name: {row['name']}, Team: {row['team']}")
-              #error handling if the player is not in the dataset
+                elif position_key in query_index.postings['position']:
+                    player_choice = query_index.labels['position'][position_key]
+                    position_rows = query_index.postings['position'][position_key]
+                    say(f"\n| All Players with the position: {player_choice} |")
+                    say("==========================================================")
+                    for line in player_lines(team_roster_df, position_rows):
+                        say(line)
+              #otherwise suggest the closest names (prefix first, then typo-tolerant matches)
                 else:
-                    print("\nSorry, that's not a valid player name or position.")
-                    continue
+                    player_row = choose_player_match(name_index, player_choice, team_roster_df)
+                    if player_row is None:
+                        continue
+                    print_player_card(team_roster_df.iloc[player_row])
+                    print_similar_players(team_roster_df, player_row)
 
-                another_search = input("\nWould you like to look up another player or position? (yes/no): ").strip().lower()
+                another_search = ask("\nWould you like to look up another player or position? (yes/no): ").strip().lower()
                 while another_search not in ['yes', 'no']:
-                    print("Please enter 'yes' or 'no'.")
-                    another_search = input("Would you like to look up another player or position? (yes/no): ").strip().lower()
+                    say("Please enter 'yes' or 'no'.")
+                    another_search = ask("Would you like to look up another player or position? (yes/no): ").strip().lower()
                 if another_search == 'no':
-                    if post_search_menu(user_name):
-                        return
-                    break
+                    return post_search_menu(user_name)
             continue
 
         # ---------------------- OPTION 2 ----------------------
         elif input_choice == '2':
-            # ---- Clean the nationality column first ----
-            team_roster_df['nationality'] = team_roster_df['nationality'].str.strip().str.lower()
-
-            # ---- Show world map ----
-            country_counts = team_roster_df['nationality'].value_counts().reset_index()
-            country_counts.columns = ['country', 'count']
-
-            fig = px.choropleth(
-                country_counts,
-                locations="country",
-                locationmode="country names",
-                color="count",
-                hover_name="country",
-                color_continuous_scale=px.colors.sequential.Plasma,
-                title="Spread of NSL Players by Country"
-            )
-
-            # Use Colab-friendly renderer so input() function works after the map appears
-            fig.show(renderer="colab")
+            # ---- Nationalities are normalised and grouped once per roster version ----
+            nationality_index = get_nationality_index(team_roster_df)
+
+            # ---- Show world map (built once, then served from its cached JSON) ----
+            # Use Colab-friendly renderer so input() works after the map appears
+            # (remote chat sessions only get text, so the map is skipped for them)
+            if current_channel() is None:
+                with span('render.country_map'):
+                    pio.from_json(get_country_map_json(team_roster_df)).show(renderer="colab")
 
             # ---- Ask user for country ----
             while True:
-                input_country_clean = input('Enter the full country name you are interested in: ').strip().lower()
+                input_country_clean = ask('Enter the full country name you are interested in: ').strip().lower()
 
-                filtered_players = team_roster_df[
-                    team_roster_df['nationality'] == input_country_clean
-                ]
+                METRICS.count('country_searches')
+                country_rows = nationality_index.players(input_country_clean)
 
-                if not filtered_players.empty:
-                    print(f"\n| All Players from {input_country_clean.title()} |")
-                    print("==========================================================")
-                    for _, row in filtered_players.iterrows():
-                        print(f"Name: {row['name']}, Team: {row['team']}")
+                if len(country_rows):
+                    say(f"\n| All Players from {input_country_clean.title()} |")
+                    say("==========================================================")
+                    for line in player_lines(team_roster_df, country_rows):
+                        say(line)
                 else:
-                    print(f"\nNo players found from '{input_country_clean.title()}'. Please enter the full country name.")
+                    say(f"\nNo players found from '{input_country_clean.title()}'. Please enter the full country name.")
                     continue
                 #ask if user want to ask another question in the country option
-                another_search = input("\nWould you like to search for another country? (yes/no): ").strip().lower()
+                another_search = ask("\nWould you like to search for another country? (yes/no): ").strip().lower()
                 while another_search not in ['yes', 'no']:
-                    print("Please enter 'yes' or 'no'.")
-                    another_search = input("Would you like to search for another country? (yes/no): ").strip().lower()
+                    say("Please enter 'yes' or 'no'.")
+                    another_search = ask("Would you like to search for another country? (yes/no): ").strip().lower()
                 if another_search == 'no':
-                    if post_search_menu(user_name):
-                        return
-                    break
+                    return post_search_menu(user_name)
             continue
 
+        # ---------------------- OPTION 3 ----------------------
+        elif input_choice == '3':
+            return roster_query_search(user_name, team_roster_df)
+
         # ---------------------- Invalid Menu Choice ----------------------
         else:
-            print("\nThat’s not a valid choice. Please enter 1 or 2.")
+            say("\nThat’s not a valid choice. Please enter 1, 2 or 3.")
             continue
 
 # %% [markdown]
@@ -399,53 +2714,51 @@ def favourite_players(user_name, team_roster_df):
 # ## 4.1 User Authentication Functions
 
 # %%
-def fantasy_phase(user_name, account_dict, team_roster_df):
+def fantasy_phase(user_name):
   """
   Initiates the fantasy team workflow by prompting the user for their email to either log in or create a new account.
   """
   # Display welcome message fo Fantasy phase
-  print(f"Okay {user_name}  let's help you start a Fantasy Team! First, let's log in or create an account")
+  say(f"Okay {user_name}  let's help you start a Fantasy Team! First, let's log in or create an account")
   # Ask user to input email address and check if it exists or not
-  email_address = input("Enter your email address: ")
-
-  # Pass created_teams_df to check_identifier
-  my_datasets = import_files()
-  created_teams_df = my_datasets.get('created_teams_df', pd.DataFrame())
-  check_identifier(user_name, email_address, account_dict, created_teams_df) # Pass created_teams_df
+  email_address = ask("Enter your email address: ")
+  return check_identifier(user_name, email_address)
 
 # %%
-def check_identifier(user_name, identifier, customer_database, created_teams_df): # Accept created_teams_df
+@timed('check_identifier')
+def check_identifier(user_name, identifier):
   """
   Checks if a user's email exists in the database, triggering a login for an existing user or creating a new account for a new user.
   """
-  while True:
-      # Create a copy to iterate over
-      for key, value in list(customer_database.items()):
-          if value['email'].lower() == identifier.lower() :
-              pin = value['pin']
-              name = value['name']
-              customer_id = key
-              login_account_with_pin(user_name, pin, name, customer_id, created_teams_df) # Pass created_teams_df
-              return # Exit the function after finding the identifier
-      # If the loop finishes without finding the identifier, create a new customer
-      pin = create_pin(identifier, user_name)
-      customer_id = f"customer{len(customer_database)+1}"
-      customer_database[customer_id] = {}
-      customer_database[customer_id]['name'] = user_name
-      customer_database[customer_id]['email'] = identifier
-      customer_database[customer_id]['pin'] = pin
-      save_customer_database(customer_database) # Save the updated database
-      instructions(user_name, customer_id, created_teams_df) # Pass created_teams_df
-      return # Exit the function after creating a new customer
-
-# %%
-def login_account_with_pin(user_name, correct_pin, name, customer_id, created_teams_df): # Accept created_teams_df
+  store = get_data_store()
+
+  # Case-insensitive O(1) lookup in the email index
+  account = store.account_index().find_by_email(identifier)
+  if account is not None:
+      customer_id, value = account
+      pin = value['pin']
+      name = value['name']
+      # Exit the function after finding the identifier
+      return login_account_with_pin(user_name, pin, name, customer_id)
+
+  # If the identifier is not registered, create a new customer
+  pin = create_pin(identifier, user_name)
+  customer_id = store.new_customer_id()
+  # Keep the same column order as customer_database.csv (email, name, pin)
+  store.add_account(customer_id, {
+      'email': identifier,
+      'name': user_name,
+      'pin': pin
+  })
+  # add_account() has queued the new account for the background writer
+  METRICS.count('registrations')
+  return start_team_builder(customer_id) # Exit the function after creating a new customer
+
+# %%
+def login_account_with_pin(user_name, correct_pin, name, customer_id):
   """
   Authenticates an existing user by verifying their entered PIN against the correct one, granting access upon success or redirecting after multiple failures.
   """
-  import getpass
-
-
     # turn pin into a string to match with input
   correct_pin_str = str(correct_pin)
 
@@ -457,48 +2770,59 @@ def login_account_with_pin(user_name, correct_pin, name, customer_id, created_te
           attempts = 0
           while attempts < max_attempts:
               # Prompt user to input 4 digit pin securely (with hash)
-              # getpass is used to hide the input for security
-              pin_input = getpass.getpass(f"{name}, please enter your 4-digit pin to enter your account: ")
+              # ask_secret hides the input for security (getpass on a terminal)
+              pin_input = ask_secret(f"{name}, please enter your 4-digit pin to enter your account: ")
 
               # 4 digit pin must match the correct_pin
               if pin_input == correct_pin_str:
-                  print(f"Welcome, {name}!")
-                  instructions(user_name, customer_id, created_teams_df)
+                  say(f"Welcome, {name}!")
+                  METRICS.count('logins')
 
-                  return True  # Login successful, exit the function
+                  return start_team_builder(customer_id)  # Login successful, exit the function
               else:
                   attempts += 1
                   if attempts < max_attempts:
-                    print("Invalid PIN. Please try again or contact customer service for assistance.")
+                    say("Invalid PIN. Please try again or contact customer service for assistance.")
                   else:
-                      print(f"You have have reached the maximum number of attemps ({max_attempts}) and are locked out.Please try again or contact customer service for assistance.")
-                      return False
+                      say(f"You have have reached the maximum number of attemps ({max_attempts}) and are locked out.Please try again or contact customer service for assistance.")
+                      METRICS.count('login_lockouts')
+                      return 'exit'
+
+# %%
+def start_team_builder(customer_id):
+  """
+  Records the logged-in customer on the session and hands over to the team builder phase.
+  """
+  session = current_session()
+  if session is not None:
+      session.customer_id = customer_id
+      session.team_draft = None
+  return 'team_builder'
 
 # %%
 def create_pin(email_address, name):
   """
   Prompts a new user to create and confirm a 4-digit numerical PIN, validating the input before returning the successfully created PIN.
   """
-  import getpass
       # prompt identifier until identifier is in customer_database
   while True:
-        pin = getpass.getpass(f"{name.title()}, please enter a 4 digit pin to complete your registration: ")
+        pin = ask_secret(f"{name.title()}, please enter a 4 digit pin to complete your registration: ")
         if pin.isdigit() and len(pin) == 4:
-            print(f'Your pin has been created. Thank you')
+            say(f'Your pin has been created. Thank you')
             return pin  # valid, exit loop
         else:
-            print("Invalid PIN. Please enter a 4 digit pin.")
+            say("Invalid PIN. Please enter a 4 digit pin.")
 
 
 # %% [markdown]
 # ## 4.2 Team Creation & Recommendation Functions
 
 # %%
-def instructions(user_name, customer_id,created_teams_df):
+def instructions(user_name, customer_id):
   """
   Guides the user into the team creation process by displaying instructions and then calling the recommendation function.
   """
-  print(f"""
+  say(f"""
   ===================================
           WELCOME TO TEAM BUILDER!
   ===================================
@@ -510,6 +2834,7 @@ def instructions(user_name, customer_id,created_teams_df):
   How it works:
   - Team size: 11 players total
   - Formation: 1 Goalkeeper, 4 Defenders, 3 Midfielders, 3 Forwards
+  - Club limit: at most {MAX_PLAYERS_PER_CLUB} players from the same club
   - Player attributes: Each player has unique strengths based on their stats.
   - Your role: Enter your top desired attributes, and we'll suggest
     players who match your preferences.
@@ -521,71 +2846,190 @@ def instructions(user_name, customer_id,created_teams_df):
   customer_id = customer_id
 
   # Calling the function to display the current team, or fill/modify the current team
-  display_team(user_name,customer_id,created_teams_df)
+  return display_team(user_name,customer_id)
 
 
 # %%
-def display_team(user_name, customer_id, created_teams_df):
-
-    import pandas as pd
-    import json
-
-    # Call the import function once to get all the data
-    my_datasets_created_teams = import_files()
-    # Get team roster data
-    team_roster_df = my_datasets_created_teams.get('team_roster_df', pd.DataFrame())
+def display_team(user_name, customer_id):
 
+    # Get team roster data from the shared data store
+    team_roster_df = get_data_store().roster()
 
-    # Check if the customerid exists as a key in the created_teams_df
 
-    if 'customer_id' in created_teams_df.columns and customer_id not in created_teams_df['customer_id'].values:
-        customer_team_df = pd.DataFrame(columns=["customer_id", "position", "playername", "qualities"]) # Initialize empty DataFrame
+    # Read only this customer's rows from the team store (indexed on customer_id)
+    customer_team_df = get_data_store().load_team(customer_id)
 
+    # Check if the customer already has a team
+    if customer_team_df.empty:
 
         # Call for the recommendation function for new team creation
-        recommendation(user_name,customer_id,customer_team_df, team_roster_df, created_teams_df) # Pass created_teams_df
+        return recommendation(user_name,customer_id,None, team_roster_df)
 
     else:
-        print("\nCurrent Team:")
-        # Print created teams df
-        # Filter the DataFrame to show only the current customer's team
-        if 'customer_id' in created_teams_df.columns:
-             customer_team_df = created_teams_df[created_teams_df['customer_id'] == customer_id].copy() # Create a copy to avoid SettingWithCopyWarning
-
-
-             # If customer has an existing team
-             if not customer_team_df.empty:
-              with pd.option_context('display.max_rows', None, 'display.max_columns', None):
-                display_df = customer_team_df.drop(columns='customer_id').set_index('position')
-                # Rename columns and index
-                display_df = display_df.rename(columns={
-                    'playername': 'Player Name',
-                    'qualities': 'Qualities'
-                      })
-                display_df.index.name = 'Position'
-                print(display_df.to_string())
-
-                # Start recommendation function to allow the modification
-                recommendation(user_name,customer_id,customer_team_df, team_roster_df, created_teams_df) # Pass created_teams_df
-             else:
-                # Customer ID exists in column but has no team rows
-                 message = "\nLooks like you don't have a team yet, please create one"
-                 print(message)
-                 customer_team_df = pd.DataFrame(columns=["customer_id", "position", "playername", "qualities"]) # Initialize empty DataFrame
-                 recommendation(user_name,customer_id,customer_team_df, team_roster_df, created_teams_df) # Pass created_teams_df
-        else:
-             print("Error: 'customer_id' column not found in created_teams_df")
+        say("\nCurrent Team:")
+        # Print the customer's team
+        say_team(customer_team_df)
+
+        # Start recommendation function to allow the modification
+        team_draft = TeamDraft.from_team(
+            customer_team_df[["position", "playername", "qualities"]].itertuples(index=False, name=None), team_roster_df)
+        return recommendation(user_name,customer_id,team_draft, team_roster_df)
+
+
+def say_team(customer_team_df):
+    """
+    Shows a team DataFrame as a Position / Player Name / Qualities table.
+    """
+    with pd.option_context('display.max_rows', None, 'display.max_columns', None):
+        display_df = customer_team_df.drop(columns='customer_id').set_index('position')
+        # Rename columns and index
+        display_df = display_df.rename(columns={
+            'playername': 'Player Name',
+            'qualities': 'Qualities'
+              })
+        display_df.index.name = 'Position'
+        say(display_df.to_string())
+
+
+def remember_team_draft(team_draft):
+    """
+    Stores the in-progress team on the current session (None clears it).
+    """
+    session = current_session()
+    if session is not None:
+        session.team_draft = team_draft
+
+
+# Key qualities for each player position
+POSITION_QUALITIES = {
+    "Goalkeeper": ['Shot-Stopping','Handling','Commanding the Box','Distrbution','Resilience','Decision-Making'],
+    "Defender": ["Tackling", "Interception", "Marking", "Clearances", "Positioning", "Communication"],
+    "Midfielder": ["Passing", "Dribbling", "Ball control", "Shooting", "Tackling & Interceptions", "Crossing"],
+    "Forward": ["Finishing", "Ball Control", "Dribbling", "Shooting Power", "Movement Off the Ball", "Stamina"]
+}
+
+# Number of players per position in the 1-4-3-3 formation
+POSITION_COUNTS = {
+    "Goalkeeper": 1,
+    "Defender": 4,
+    "Midfielder": 3,
+    "Forward": 3
+}
+
+def formation_slots(position_counts):
+    """
+    Returns {position: slice of squad slots} for a formation, positions in order.
+    """
+    slots, start = {}, 0
+    for position, count in position_counts.items():
+        slots[position] = slice(start, start + count)
+        start += count
+    return slots
 
+# Squad slots of the formation: goalkeeper 0, defenders 1-4, midfielders 5-7, forwards 8-10
+DRAFT_SLOTS = formation_slots(POSITION_COUNTS)
+SQUAD_SIZE = sum(POSITION_COUNTS.values())
 
-def recommendation(user_name, customer_id,customer_team_df, team_roster_df, created_teams_df): # Accept created_teams_df
+
+class TeamDraft:
+    """
+    The team being built in recommendation(): one slot per squad place holding the
+    roster row of its player (-1 while empty) and the qualities it was picked for.
+    Qualities are kept per slot because a saved team may mix several sets within a
+    position. Changing a position overwrites its slots in place, so a draft keeps the
+    same size however many edits are made; DataFrames are only built to show or save
+    the team.
+    """
+    __slots__ = ('team_roster_df', 'rows', 'qualities')
+
+    def __init__(self, team_roster_df):
+        self.team_roster_df = team_roster_df
+        self.rows = np.full(SQUAD_SIZE, -1, dtype=np.int32)
+        self.qualities = [None] * SQUAD_SIZE
+
+    def set_position(self, position, rows, qualities):
+        """
+        Replaces the players of a position with the given roster rows, all picked for qualities.
+        """
+        self._fill_position(position, [(row, qualities) for row in rows])
+
+    def _fill_position(self, position, picks):
+        """
+        Fills a position's slots with (roster row, qualities) picks, emptying the rest.
+        """
+        slots = DRAFT_SLOTS[position]
+        picks = list(picks)[:slots.stop - slots.start]
+        self.rows[slots] = -1
+        self.qualities[slots] = [None] * (slots.stop - slots.start)
+        for slot, (row, qualities) in enumerate(picks, slots.start):
+            self.rows[slot] = row
+            self.qualities[slot] = qualities
+
+    def is_empty(self):
+        return not (self.rows >= 0).any()
+
+    def player_names(self, exclude_position=None):
+        """
+        Names of the drafted players, leaving out those of exclude_position.
+        """
+        names = self.team_roster_df['name']
+        return [names.iat[row] for position, slots in DRAFT_SLOTS.items() if position != exclude_position
+                for row in self.rows[slots] if row >= 0]
+
+    def team_rows(self):
+        """
+        Returns the drafted players as (position, playername, qualities) rows, in formation order.
+        """
+        names = self.team_roster_df['name']
+        return [(position, names.iat[self.rows[slot]], self.qualities[slot])
+                for position, slots in DRAFT_SLOTS.items()
+                for slot in range(slots.start, slots.stop) if self.rows[slot] >= 0]
+
+    def to_frame(self, customer_id):
+        """
+        Returns the draft as a team DataFrame with the created_teams.csv columns.
+        """
+        return pd.DataFrame([(customer_id, *row) for row in self.team_rows()], columns=TEAM_COLUMNS)
+
+    @classmethod
+    def from_team(cls, team_rows, team_roster_df):
+        """
+        Builds a draft from saved (position, playername, qualities) rows. Players no longer
+        on the roster, and any beyond a position's slots, are left out.
+        """
+        draft = cls(team_roster_df)
+        name_index = get_player_name_index(team_roster_df)
+        picks = defaultdict(list)
+        for position, playername, qualities in team_rows:
+            row = name_index.lookup(playername) if isinstance(playername, str) else None
+            if position in DRAFT_SLOTS and row is not None:
+                picks[position].append((row, qualities))
+        for position, position_picks in picks.items():
+            draft._fill_position(position, position_picks)
+        return draft
+
+    def snapshot(self):
+        """
+        Returns a JSON-serializable dict: the player name and the qualities of each slot (None if empty).
+        """
+        names = self.team_roster_df['name']
+        return {
+            'players': [names.iat[row] if row >= 0 else None for row in self.rows.tolist()],
+            'qualities': list(self.qualities)
+        }
+
+    @classmethod
+    def from_snapshot(cls, snapshot, team_roster_df):
+        team_rows = [(position, snapshot['players'][slot], snapshot['qualities'][slot])
+                     for position, slots in DRAFT_SLOTS.items()
+                     for slot in range(slots.start, slots.stop) if snapshot['players'][slot] is not None]
+        return cls.from_team(team_rows, team_roster_df)
+
+
+def recommendation(user_name, customer_id, team_draft, team_roster_df):
 
     # Define key qualities for each player position
-    qualities = {
-        "Goalkeeper": ['Shot-Stopping','Handling','Commanding the Box','Distrbution','Resilience','Decision-Making'],
-        "Defender": ["Tackling", "Interception", "Marking", "Clearances", "Positioning", "Communication"],
-        "Midfielder": ["Passing", "Dribbling", "Ball control", "Shooting", "Tackling & Interceptions", "Crossing"],
-        "Forward": ["Finishing", "Ball Control", "Dribbling", "Shooting Power", "Movement Off the Ball", "Stamina"]
-    }
+    qualities = POSITION_QUALITIES
 
     # Map user input numbers to positions
     positions = {
@@ -596,200 +3040,1105 @@ def recommendation(user_name, customer_id,customer_team_df, team_roster_df, crea
         "5": "Exit"
     }
 
-    if customer_team_df is None:
-        customer_team_df = pd.DataFrame(columns=["customer_id", "position", "playername", "qualities"])
+    if team_draft is None:
+        team_draft = TeamDraft(team_roster_df)
 
     # Begin team modification loop
     while True:
 
         # Ask user which position to modify
-        print("\nWhich position would you like to fill / modify?")
-        print("\n1. Goalkeeper\n2. Defender\n3. Midfielder\n4. Forward\n5. I'm happy with my team")
-        user_input = input("Enter your choice: ").strip()
+        say("\nWhich position would you like to fill / modify?")
+        say("\n1. Goalkeeper\n2. Defender\n3. Midfielder\n4. Forward\n5. I'm happy with my team")
+        user_input = ask("Enter your choice: ").strip()
 
         if user_input in positions:
             if user_input == "5":
               # If user is done editing
-              print("\nTeam finalized:\n")
-              if customer_team_df is not None and not customer_team_df.empty:
-                with pd.option_context('display.max_rows', None, 'display.max_columns', None):
-                  display_df = customer_team_df.drop(columns='customer_id').set_index('position')
-                # Rename columns and index
-                  display_df = display_df.rename(columns={
-                    'playername': 'Player Name',
-                    'qualities': 'Qualities'
-                      })
-                  display_df.index.name = 'Position'
-                  print(display_df.to_string())
+              say("\nTeam finalized:\n")
+              if not team_draft.is_empty():
+                customer_team_df = team_draft.to_frame(customer_id)
+                say_team(customer_team_df)
               else:
-                print("Looks like you don't have a team yet, please create one")
+                say("Looks like you don't have a team yet, please create one")
                 continue
               break
             else:
                 # Ask for quality selection for the chosen position
                 position = positions[user_input].strip()
-                print(f"\nWhat is the most desirable quality you would like your {position}s to possess?")
+                say(f"\nWhat is the most desirable quality you would like your {position}s to possess?")
 
                 # List available qualities for that position
                 for i, q in enumerate(qualities[position], 1):
-                    print(f"{i}. {q}")
+                    say(f"{i}. {q}")
 
                 # Handle user input for quality selection
                 while True:
                     try:
-                        choice = int(input("\nEnter the number of your chosen quality: "))
+                        choice = int(ask("\nEnter the number of your chosen quality: "))
                         if 1 <= choice <= len(qualities[position]):
                             chosen_quality = qualities[position][choice - 1]  # Get the quality from the list
                             break
                         else:
-                            print("\nInvalid selection. Try again.")
+                            say("\nInvalid selection. Try again.")
                     except ValueError:
-                        print("\nPlease enter a number.")
+                        say("\nPlease enter a number.")
 
                 # Ask for a second quality selection for the chosen position
-                print(f"\nWhat is the other quality you would like your {position}s to possess?")
+                say(f"\nWhat is the other quality you would like your {position}s to possess?")
 
                 # List available qualities for that position
                 for i, q in enumerate(qualities[position], 1):
-                    print(f"{i}. {q}")
+                    say(f"{i}. {q}")
 
                 # Handle user input for quality selection
                 while True:
                     try:
-                        choice2 = int(input("\nEnter the number of your chosen quality: "))
+                        choice2 = int(ask("\nEnter the number of your chosen quality: "))
                         if 1 <= choice2 <= len(qualities[position]):
                             chosen_quality2 = qualities[position][choice2 - 1]  # Get the quality from the list
                             break
                         else:
-                            print("\nInvalid selection. Try again.")
+                            say("\nInvalid selection. Try again.")
                     except ValueError:
-                        print("\nPlease enter a number.")
+                        say("\nPlease enter a number.")
 
                 # Combine qualities with pipe separator
                 combined_qualities = f"{chosen_quality} | {chosen_quality2}"
 
-                position_counts = {
-                    "Goalkeeper": 1,
-                    "Defender": 4,
-                    "Midfielder": 3,
-                    "Forward": 3
-                    }
-
-                required_count = position_counts.get(position, 1)
-                # Get top N players matching the selected qualities
-                top_players = get_top_players(position, combined_qualities, team_roster_df, top_n=required_count)
+                # Pick the best players for the selected qualities, keeping the rest of the
+                # squad as it is: no player twice and at most MAX_PLAYERS_PER_CLUB per club
+                try:
+                    picks = optimize_squad_picks({position: combined_qualities}, team_draft.team_roster_df,
+                                                 max_per_club=MAX_PLAYERS_PER_CLUB,
+                                                 fixed_players=team_draft.player_names(exclude_position=position))
+                except ValueError as error:
+                    say(f"No {position}s could be picked for qualities: {combined_qualities}. {error}")
+                    continue
 
-                if top_players.empty:
-                  print(f"No matching players found for position {position} with qualities: {combined_qualities}")
+                if not picks or not len(picks[0][1]):
+                  say(f"No matching players found for position {position} with qualities: {combined_qualities}")
                   continue
-                # Remove existing players for this position and customer
-                if customer_team_df is None:
-                    customer_team_df = pd.DataFrame()
-                else:
-                    customer_team_df = customer_team_df[~(
-                        (customer_team_df["customer_id"] == customer_id) &
-                        (customer_team_df["position"] == position)
-                    )].copy() # Create a copy to avoid SettingWithCopyWarning
-
-
-                # Create new rows for the selected top players
-                new_rows = []
-                for _, row in top_players.iterrows():
-                    new_rows.append({
-                        "customer_id": customer_id,
-                        "position": position,
-                        "playername": row["name"],
-                        "qualities": combined_qualities
-                    })
+                # Replace this position's players in their slots
+                team_draft.set_position(position, picks[0][1], combined_qualities)
 
-                # Append the new players
-                customer_team_df = pd.concat([customer_team_df, pd.DataFrame(new_rows)], ignore_index=True)
-
-                # Get top players
-                top_players = get_top_players(position, combined_qualities, team_roster_df, top_n=required_count)
-
-                if top_players.empty:
-                  print(f"No matching players found for position {position} with qualities: {combined_qualities}")
-                  continue  # Skip to next loop
-
-                # Remove existing players for this customer and position (in case they’re updating)
-                if customer_team_df is not None and not customer_team_df.empty:
-                  customer_team_df = customer_team_df[~((customer_team_df['customer_id'] == customer_id) &
-                          (customer_team_df['position'] == position))].copy() # Create a copy to avoid SettingWithCopyWarning
-
-                # Create new rows for each selected player
-                new_rows = []
-                for _, row in top_players.iterrows():
-                  new_row = {
-                      "customer_id": customer_id,
-                      "position": position,
-                      "playername": row['name'],  # Uses 'name' from team_roster_df
-                      "qualities": combined_qualities
-                      }
-                  new_rows.append(new_row)
-
-                # Append to or create customer_team_df
-                new_rows_df = pd.DataFrame(new_rows)
-                if customer_team_df is None or customer_team_df.empty:
-                  customer_team_df = new_rows_df
-                else:
-                  customer_team_df = pd.concat([customer_team_df, new_rows_df], ignore_index=True)
+                # Keep the session's draft up to date so it can be snapshotted mid-build
+                remember_team_draft(team_draft)
 
         else:
-            print("\nInvalid input. Please choose a number from 1 to 5.")
+            say("\nInvalid input. Please choose a number from 1 to 5.")
 
     # Offer next action after team is finalized
     save_created_teams(customer_team_df)
-    print("\n")
-    post_search_menu(user_name)
+    remember_team_draft(None)
+    show_leaderboard(customer_id)
+    say("\n")
+    return post_search_menu(user_name)
+
+# %%
+def split_attributes(text):
+    """
+    Splits an "A | B | C" attribute string into canonical attribute names:
+    surrounding spaces trimmed and case-folded, so "Ball control" and "Ball Control " match.
+    """
+    attributes = []
+    for attribute in str(text).split('|'):
+        attribute = ' '.join(attribute.split()).casefold()
+        if attribute:
+            attributes.append(attribute)
+    return attributes
 
 
-    return customer_team_df
+# Roster columns kept as categorical codes by the recommender
+CATEGORY_COLUMNS = ('position', 'team', 'nationality')
 
-# %%
-from sklearn.feature_extraction.text import CountVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+def compact_codes(codes, n_labels):
+    """
+    Stores categorical codes in the smallest integer type that fits them.
+    """
+    return codes.astype(np.int16 if n_labels < 2 ** 15 else np.int32)
+
+
+# Number of set bits in each byte value, for NumPy versions without bitwise_count()
+_POPCOUNT_TABLE = None
+
+def popcount(words):
+    """
+    Returns the number of set bits of every element of a uint64 array.
+    """
+    global _POPCOUNT_TABLE
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words)
+    if _POPCOUNT_TABLE is None:
+        _POPCOUNT_TABLE = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint8)
+    counts = _POPCOUNT_TABLE[np.ascontiguousarray(words).view(np.uint8)]
+    return counts.reshape(words.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+
+class RecommenderEngine:
+    """
+    The roster compiled once per roster version for similarity scoring: every player's
+    attributes are a row of uint64 bitmask words over a canonical attribute vocabulary,
+    and positions, teams and nationalities are categorical codes. The cosine similarity
+    of two attribute sets is |A & B| / sqrt(|A| * |B|), so scoring a query against a
+    whole position is one vectorized AND + popcount.
+    """
+
+    @timed('recommender.fit')
+    def __init__(self, team_roster_df):
+        self.team_roster_df = team_roster_df
+        self.position_rows = {}
+        self.position_masks = {}
+        self.position_sizes = {}
+        self.vocabulary = {}  # canonical attribute -> bit number
+
+        # Categorical codes (-1 = missing) and their labels
+        self.categories = {}
+        self.codes = {}
+        for column in CATEGORY_COLUMNS:
+            if column in team_roster_df.columns:
+                codes, labels = pd.factorize(team_roster_df[column])
+                self.codes[column] = compact_codes(codes, len(labels))
+                self.categories[column] = labels
+
+        if team_roster_df.empty or 'attributes' not in team_roster_df.columns:
+            self.masks = None
+            return
+
+        # Canonical vocabulary in first-seen order, then one bitmask row per player
+        # (each distinct attribute string is parsed once, players share its mask)
+        string_codes, attribute_strings = pd.factorize(team_roster_df['attributes'].fillna(''))
+        attribute_sets = [split_attributes(text) for text in attribute_strings]
+        for attributes in attribute_sets:
+            for attribute in attributes:
+                self.vocabulary.setdefault(attribute, len(self.vocabulary))
+        self.masks = self.encode_sets(attribute_sets)[string_codes]
+        self.sizes = popcount(self.masks).sum(axis=1, dtype=np.int32)
+        self.slice_positions()
+
+    def slice_positions(self):
+        """
+        Slices the masks per position, remembering which roster rows each slice holds.
+        """
+        self.position_rows, self.position_masks, self.position_sizes = {}, {}, {}
+        position_codes = self.codes['position']
+        for code, position in enumerate(self.categories['position']):
+            rows = np.flatnonzero(position_codes == code)
+            if len(rows):
+                self.position_rows[position] = rows
+                self.position_masks[position] = self.masks[rows]
+                self.position_sizes[position] = self.sizes[rows]
+
+    @timed('recommender.apply_delta')
+    def apply_delta(self, team_roster_df, delta):
+        """
+        Returns the engine of an updated roster: kept players' masks and codes are moved to
+        their new rows and only the added or changed players are encoded. The engine itself
+        is left untouched for the sessions still using the previous roster.
+        """
+        if self.masks is None or 'position' not in self.codes:
+            return RecommenderEngine(team_roster_df)
+        engine = object.__new__(RecommenderEngine)
+        engine.team_roster_df = team_roster_df
+        dirty = delta.dirty_rows
+        kept_old = np.flatnonzero(delta.remap >= 0)
+        kept_new = delta.remap[kept_old]
+
+        # New categories are appended, so the codes of the kept players stay valid
+        engine.categories, engine.codes = {}, {}
+        for column, labels in self.categories.items():
+            label_codes = {label: code for code, label in enumerate(labels)}
+            codes = np.full(len(team_roster_df), -1, dtype=np.int32)
+            codes[kept_new] = self.codes[column][kept_old]
+            for row, value in zip(dirty, team_roster_df[column].to_numpy()[dirty]):
+                codes[row] = -1 if pd.isna(value) else label_codes.setdefault(value, len(label_codes))
+            engine.categories[column] = pd.Index(list(label_codes))
+            engine.codes[column] = compact_codes(codes, len(label_codes))
+
+        # Same for the vocabulary; the masks gain a word if it outgrows the current width
+        engine.vocabulary = dict(self.vocabulary)
+        attribute_sets = [split_attributes(text) for text in team_roster_df['attributes'].fillna('').to_numpy()[dirty]]
+        for attributes in attribute_sets:
+            for attribute in attributes:
+                engine.vocabulary.setdefault(attribute, len(engine.vocabulary))
+        dirty_masks = engine.encode_sets(attribute_sets)
+        engine.masks = np.zeros((len(team_roster_df), dirty_masks.shape[1]), dtype=np.uint64)
+        engine.masks[kept_new, :self.masks.shape[1]] = self.masks[kept_old]
+        engine.masks[dirty] = dirty_masks
+        engine.sizes = np.zeros(len(team_roster_df), dtype=np.int32)
+        engine.sizes[kept_new] = self.sizes[kept_old]
+        engine.sizes[dirty] = popcount(dirty_masks).sum(axis=1, dtype=np.int32)
+        engine.slice_positions()
+        return engine
+
+    def to_snapshot(self):
+        """
+        Returns (arrays, metadata) to save the compiled engine in the data snapshot, or None.
+        """
+        if self.masks is None or 'position' not in self.codes:
+            return None
+        arrays = {'masks': self.masks, 'sizes': self.sizes}
+        for column, codes in self.codes.items():
+            arrays[f"codes.{column}"] = codes
+        meta = {
+            'rows': len(self.masks),
+            'vocabulary': list(self.vocabulary),
+            'categories': {column: [str(label) for label in labels] for column, labels in self.categories.items()},
+        }
+        return arrays, meta
+
+    @classmethod
+    def from_snapshot(cls, team_roster_df, arrays, meta):
+        """
+        Rebuilds an engine from to_snapshot() output (memory-mapped arrays), or returns None
+        if it does not match the roster.
+        """
+        if meta['rows'] != len(team_roster_df):
+            return None
+        engine = object.__new__(cls)
+        engine.team_roster_df = team_roster_df
+        engine.masks = arrays['masks']
+        engine.sizes = arrays['sizes']
+        engine.vocabulary = {attribute: bit for bit, attribute in enumerate(meta['vocabulary'])}
+        engine.categories = {column: pd.Index(labels) for column, labels in meta['categories'].items()}
+        engine.codes = {column: arrays[f"codes.{column}"] for column in meta['categories']}
+        engine.slice_positions()
+        return engine
+
+    def encode_sets(self, attribute_sets):
+        """
+        Returns a (len(attribute_sets), n_words) uint64 array of bitmasks; unknown attributes are ignored.
+        """
+        n_words = max(1, -(-len(self.vocabulary) // 64))
+        masks = np.zeros((len(attribute_sets), n_words), dtype=np.uint64)
+        for row, attributes in enumerate(attribute_sets):
+            for attribute in attributes:
+                bit = self.vocabulary.get(attribute)
+                if bit is not None:
+                    masks[row, bit >> 6] |= np.uint64(1 << (bit & 63))
+        return masks
+
+    def encode_queries(self, queries):
+        """
+        Bitmasks of "A | B" quality strings.
+        """
+        return self.encode_sets([split_attributes(query) for query in queries])
+
+    @timed('recommender.score')
+    def score(self, position, queries):
+        """
+        Returns a (len(queries), n_position_players) array of cosine similarities.
+        """
+        query_masks = self.encode_queries(queries)
+        query_sizes = popcount(query_masks).sum(axis=1, dtype=np.int32)
+        player_masks = self.position_masks[position]
+
+        # Shared attributes of every (query, player) pair in one vectorized AND + popcount
+        shared = popcount(query_masks[:, None, :] & player_masks[None, :, :]).sum(axis=2, dtype=np.int32)
+        norms = np.sqrt(np.outer(query_sizes, self.position_sizes[position]).astype(np.float64))
+        return np.divide(shared, norms, out=np.zeros(shared.shape), where=norms > 0)
+
+    def top_rows(self, position, queries, top_n=1):
+        """
+        Returns (row_ids, scores) arrays of shape (len(queries), N): the roster rows and
+        similarities of the top N players of a position for each query, best first.
+        """
+        if self.masks is None or position not in self.position_rows:
+            return np.empty((len(queries), 0), dtype=np.intp), np.empty((len(queries), 0))
+
+        rows = self.position_rows[position]
+        scores = self.score(position, queries)
+        top_n = min(top_n, len(rows))
+
+        # Partial selection of the N best per query, then order only those N (ties keep roster order)
+        if top_n < len(rows):
+            best = np.argpartition(-scores, top_n - 1, axis=1)[:, :top_n]
+        else:
+            best = np.tile(np.arange(len(rows)), (len(queries), 1))
+        best_scores = np.take_along_axis(scores, best, axis=1)
+        order = np.lexsort((best, -best_scores))
+        return rows[np.take_along_axis(best, order, axis=1)], np.take_along_axis(best_scores, order, axis=1)
+
+    def top_players(self, position, queries, top_n=1):
+        """
+        Batch version of get_top_players(): one DataFrame of top N players per query.
+        """
+        frames = []
+        for rows, scores in zip(*self.top_rows(position, queries, top_n)):
+            top_players = self.team_roster_df.iloc[rows][['name', 'position', 'attributes']].copy()
+            top_players['similarity'] = scores
+            frames.append(top_players)
+        return frames
+
+
+def get_recommender(team_roster_df=None):
+    """
+    Returns the recommender for a roster, shared through the data store for the live roster.
+    """
+    return roster_derived('recommender', RecommenderEngine, team_roster_df)
 
-def get_top_players(position, desired_qualities, team_roster_df, top_n=1):
-    # Filter only for relevant position
-    position_players = team_roster_df[team_roster_df['position'] == position].copy()
 
-    # Check if position_players is empty or if 'attributes' column exists
-    if position_players.empty or 'attributes' not in position_players.columns:
-        print(f"No players found for position: {position} or 'attributes' column is missing.")
+@timed('get_top_players')
+def get_top_players(position, desired_qualities, team_roster_df, top_n=1):
+    METRICS.count('recommendations')
+    # Check if the roster has players for the position and an 'attributes' column
+    if team_roster_df.empty or 'attributes' not in team_roster_df.columns or \
+            position not in team_roster_df['position'].values:
+        say(f"No players found for position: {position} or 'attributes' column is missing.")
         return pd.DataFrame() # Return empty DataFrame
 
-    # Vectorize the qualities with | as a separator
-    vectorizer = CountVectorizer(tokenizer=lambda x: x.split('|'), token_pattern=None)
-    qualities_matrix = vectorizer.fit_transform(position_players['attributes'].dropna()) # Handle potential NaN values
+    # Score the qualities against the precomputed position matrix and keep the top N
+    return get_recommender(team_roster_df).top_players(position, [desired_qualities], top_n)[0]
+
+# %%
+def format_qualities(qualities):
+    """
+    Accepts either an "A | B" string or a list of qualities and returns the "A | B" form.
+    """
+    if isinstance(qualities, str):
+        return qualities
+    return " | ".join(qualities)
+
+
+@timed('recommend_squads')
+def recommend_squads(preferences_list, customer_ids=None, team_roster_df=None, chunk_size=None):
+    """
+    Builds full 1-4-3-3 squads for many users without any terminal I/O.
+
+    preferences_list holds one {position: qualities} dict per user, covering Goalkeeper,
+    Defender, Midfielder and Forward. Each position is scored for a whole block of users
+    with one bitmask AND + popcount against every player, and a single DataFrame is built at the end.
+    """
+    METRICS.count('recommendations', len(preferences_list))
+    engine = get_recommender(team_roster_df)
+    roster_names = engine.team_roster_df['name'].to_numpy() if 'name' in engine.team_roster_df.columns else np.empty(0)
+    n_users = len(preferences_list)
+    if customer_ids is None:
+        customer_ids = [None] * n_users
+
+    # Validate and normalise every user's preferences up front
+    position_queries = {position: [] for position in POSITION_COUNTS}
+    for preferences in preferences_list:
+        missing = [position for position in POSITION_COUNTS if position not in preferences]
+        if missing:
+            raise ValueError(f"Missing preferences for: {', '.join(missing)}")
+        for position in POSITION_COUNTS:
+            position_queries[position].append(format_qualities(preferences[position]))
+
+    row_blocks, position_blocks, quality_blocks = [], [], []
+    for position, required_count in POSITION_COUNTS.items():
+        queries = position_queries[position]
+        n_players = len(engine.position_rows.get(position, ()))
+        # Bound the dense score block to roughly 4M floats
+        block = chunk_size or max(1, (1 << 22) // max(n_players, 1))
+        rows = [engine.top_rows(position, queries[i:i + block], required_count)[0]
+                for i in range(0, n_users, block)]
+        rows = np.concatenate(rows) if rows else np.empty((0, 0), dtype=np.intp)
+        row_blocks.append(rows)
+        position_blocks.append(np.full(rows.shape, position, dtype=object))
+        quality_blocks.append(np.repeat(np.array(queries, dtype=object)[:, None], rows.shape[1], axis=1))
+
+    # One (n_users, 11) array per column, flattened user by user
+    row_ids = np.concatenate(row_blocks, axis=1).ravel()
+    picks_per_user = row_ids.size // n_users if n_users else 0
+    return pd.DataFrame({
+        "customer_id": np.repeat(np.array(customer_ids, dtype=object), picks_per_user),
+        "position": np.concatenate(position_blocks, axis=1).ravel(),
+        "playername": roster_names[row_ids],
+        "qualities": np.concatenate(quality_blocks, axis=1).ravel()
+    })
+
+
+def recommend_squad(preferences, customer_id=None, team_roster_df=None):
+    """
+    Returns the 11 recommended players for one user's {position: qualities} preferences.
+    """
+    return recommend_squads([preferences], [customer_id], team_roster_df)
+
+# %%
+# Most players from one club allowed in a squad built by optimize_squad()
+MAX_PLAYERS_PER_CLUB = 3
+
+def squad_candidates(scores, clubs, costs, keep_per_club, keep_per_position, shared_names=None):
+    """
+    Indices of the players of one position that can be part of an optimal squad, best first.
+
+    A player is dropped once keep_per_club players of the same club, or keep_per_position
+    players of the position overall (counting at most keep_per_club per club), score at
+    least as well for no higher cost: a squad using it could always swap in one of them
+    instead. Players flagged in shared_names (a name another roster player has too) never
+    count as stand-ins, since a namesake elsewhere in the squad may rule them out.
+    """
+    order = np.lexsort((np.arange(len(scores)), -scores))
+    stand_in = np.ones(len(scores), dtype=bool) if shared_names is None else ~np.asarray(shared_names, dtype=bool)
+    if costs is None:
+        # Without a budget that keeps the best players of each club, then the best of those
+        by_club = np.argsort(clubs[order], kind='stable')
+        sorted_clubs = clubs[order][by_club]
+        group_starts = np.flatnonzero(np.r_[True, sorted_clubs[1:] != sorted_clubs[:-1]])
+        group_sizes = np.diff(np.r_[group_starts, len(order)])
+        club_stand_ins = stand_in[order][by_club].astype(np.int64)
+        before = np.cumsum(club_stand_ins) - club_stand_ins
+        club_rank = before - np.repeat(before[group_starts], group_sizes)
+        kept = np.zeros(len(order), dtype=bool)
+        kept[by_club[club_rank < keep_per_club]] = True
+        position_stand_ins = (kept & stand_in[order]).astype(np.int64)
+        kept &= np.cumsum(position_stand_ins) - position_stand_ins < keep_per_position
+        return order[kept]
+
+    # With a budget, keep the players not dominated (better and cheaper) often enough.
+    # Each club heap holds the smallest costs among the better stand-ins of that club;
+    # stand_in_costs holds all of them, sorted, for the position-wide count
+    kept = []
+    club_heaps = defaultdict(list)
+    stand_in_costs = []
+    for i in order:
+        cost = costs[i]
+        club_heap = club_heaps[clubs[i]]
+        if not ((len(club_heap) >= keep_per_club and -club_heap[0] <= cost) or
+                bisect_right(stand_in_costs, cost) >= keep_per_position):
+            kept.append(i)
+        if not stand_in[i]:
+            continue
+        if len(club_heap) < keep_per_club:
+            heapq.heappush(club_heap, -cost)
+            insort(stand_in_costs, cost)
+        elif -club_heap[0] > cost:
+            stand_in_costs.remove(-heapq.heapreplace(club_heap, -cost))
+            insort(stand_in_costs, cost)
+    return np.array(kept, dtype=np.intp)
+
+
+def shared_name_rows(team_roster_df):
+    """
+    Boolean array over the roster: True for players whose name another player has too
+    (legal, as players are keyed by team and name).
+    """
+    if 'name' not in team_roster_df.columns:
+        return np.zeros(len(team_roster_df), dtype=bool)
+    return team_roster_df['name'].duplicated(keep=False).to_numpy()
+
+
+def squad_infeasible_reason(available, max_per_club=None, budget=None):
+    """
+    Explains why no squad satisfies the constraints, given the number of distinct
+    players still available per position.
+    """
+    short = [f"only {count} {position.lower()}{'' if count == 1 else 's'} available for "
+             f"{POSITION_COUNTS.get(position, 1)} places"
+             for position, count in available.items() if count < POSITION_COUNTS.get(position, 1)]
+    if short:
+        return f"Not enough players: {', '.join(short)}."
+    limits = []
+    if max_per_club:
+        limits.append(f"at most {max_per_club} players from the same club")
+    if budget is not None:
+        limits.append(f"a total cost within {budget:g}")
+    if not limits:
+        return "No squad satisfies the requested constraints."
+    return f"No squad can keep to {' and '.join(limits)} together with the players already in your team."
+
+
+class SquadPool:
+    """
+    Candidates for one position of the squad, best first, with the prefix sums the bounds use.
+    """
+
+    def __init__(self, position, count, rows, scores, clubs, costs):
+        self.position = position
+        self.count = count
+        self.rows = rows.tolist()
+        self.scores = scores.tolist()
+        self.clubs = clubs.tolist()
+        self.costs = costs.tolist()
+        self.score_prefix = [0.0] + np.cumsum(scores).tolist()
+        self.cheapest = [0.0] + np.cumsum(np.sort(costs)).tolist()
+
+    def best_total(self):
+        return self.score_prefix[self.count] if len(self.rows) >= self.count else None
+
+
+def solve_squad(pools, names, max_per_club=None, budget=None, club_counts=None, spent=0.0, used_names=()):
+    """
+    Branch and bound over the position pools: picks count players from every pool with the
+    highest total score, at most max_per_club players per club and a total cost within budget.
+    Returns one list of roster rows per pool, or None if no squad satisfies the constraints.
+    Among squads with the same total, the one listing better-ranked candidates first wins.
+    """
+    if not pools:
+        return []
+    if any(pool.best_total() is None for pool in pools):
+        return None
+    club_counts = Counter(club_counts or {})
+    used_names = set(used_names)
+
+    # Best score and lowest cost still reachable from pool k onwards
+    best_rest = [0.0] * (len(pools) + 1)
+    cheapest_rest = [0.0] * (len(pools) + 1)
+    for k in range(len(pools) - 1, -1, -1):
+        best_rest[k] = best_rest[k + 1] + pools[k].best_total()
+        cheapest_rest[k] = cheapest_rest[k + 1] + pools[k].cheapest[pools[k].count]
+
+    best_total, best_picks = -np.inf, None
+    picks = [[] for _ in pools]
+
+    def search(k, start, need, total, cost):
+        nonlocal best_total, best_picks
+        if need == 0:
+            if k + 1 < len(pools):
+                return search(k + 1, 0, pools[k + 1].count, total, cost)
+            if total > best_total + 1e-12:
+                best_total, best_picks = total, [list(rows) for rows in picks]
+            return
+        pool = pools[k]
+        for i in range(start, len(pool.rows) - need + 1):
+            # Candidates are sorted, so once the bound fails it fails for every later i
+            if total + pool.score_prefix[i + need] - pool.score_prefix[i] + best_rest[k + 1] <= best_total + 1e-12:
+                break
+            club = pool.clubs[i]
+            if max_per_club is not None and club_counts[club] >= max_per_club:
+                continue
+            new_cost = cost + pool.costs[i]
+            if budget is not None and new_cost + pool.cheapest[need - 1] + cheapest_rest[k + 1] > budget:
+                continue
+            name = names[pool.rows[i]]
+            if name in used_names:
+                continue
+
+            club_counts[club] += 1
+            used_names.add(name)
+            picks[k].append(pool.rows[i])
+            search(k, i + 1, need - 1, total + pool.scores[i], new_cost)
+            picks[k].pop()
+            used_names.discard(name)
+            club_counts[club] -= 1
+
+    search(0, 0, pools[0].count, 0.0, spent)
+    return best_picks
+
+
+@timed('optimize_squad')
+def optimize_squad(preferences, customer_id=None, team_roster_df=None, max_per_club=None,
+                   budget=None, cost_column=None, fixed_players=()):
+    """
+    Picks the players of every position in preferences together, maximising their total
+    similarity to the preferred qualities: no player twice, at most max_per_club per club
+    (counting fixed_players, the squad members kept as they are) and, with a budget, a
+    total cost_column within it. Returns the same columns as recommend_squad().
+    Raises ValueError when no squad satisfies the constraints.
+    """
+    team_rows = optimize_squad_rows(preferences, team_roster_df, max_per_club, budget, cost_column, fixed_players)
+    return pd.DataFrame([(customer_id,) + row for row in team_rows], columns=TEAM_COLUMNS)
+
+
+def optimize_squad_rows(preferences, team_roster_df=None, max_per_club=None, budget=None, cost_column=None,
+                        fixed_players=()):
+    """
+    optimize_squad() as a list of (position, playername, qualities) rows.
+    """
+    picks = optimize_squad_picks(preferences, team_roster_df, max_per_club, budget, cost_column, fixed_players)
+    roster = get_recommender(team_roster_df).team_roster_df
+    names = roster['name'].to_numpy() if 'name' in roster.columns else np.empty(0, dtype=object)
+    return [(position, names[row], format_qualities(preferences[position]))
+            for position, rows in picks for row in rows]
+
+
+def optimize_squad_picks(preferences, team_roster_df=None, max_per_club=None, budget=None, cost_column=None,
+                         fixed_players=(), counts=None):
+    """
+    optimize_squad() as (position, roster rows) pairs, in the order of preferences.
+    counts overrides how many players to pick for some positions (default: POSITION_COUNTS).
+    """
+    counts = {**POSITION_COUNTS, **(counts or {})}
+    engine = get_recommender(team_roster_df)
+    roster = engine.team_roster_df
+    if budget is not None and (cost_column is None or cost_column not in roster.columns):
+        raise ValueError(f"A budget needs a cost column from the roster, got: {cost_column}")
+    METRICS.count('recommendations')
+
+    names = roster['name'].to_numpy() if 'name' in roster.columns else np.empty(0, dtype=object)
+    clubs = engine.codes.get('team', np.zeros(len(roster), dtype=np.int16))
+    costs = roster[cost_column].fillna(0).to_numpy(dtype=np.float64) if budget is not None else None
+
+    # The kept squad members use up club places and budget; a kept name is taken to be
+    # its first roster row, and none of the players sharing it can be picked again
+    fixed_name_rows = np.flatnonzero(np.isin(names, list(fixed_players))) if len(fixed_players) \
+        else np.empty(0, dtype=np.intp)
+    fixed_rows = fixed_name_rows[np.unique(names[fixed_name_rows], return_index=True)[1]] if len(fixed_name_rows) \
+        else fixed_name_rows
+    club_counts = Counter(clubs[fixed_rows].tolist())
+    spent = float(costs[fixed_rows].sum()) if costs is not None else 0.0
+
+    # A club can only fill up if it holds max_per_club of the squad's players
+    squad_size = sum(counts.get(position, 1) for position in preferences) + len(fixed_rows)
+    full_clubs = squad_size // max_per_club if max_per_club else 0
+
+    shared_names = roster_derived('shared_names', shared_name_rows, roster)
+    pools, available = [], {}
+    for position in preferences:
+        count = counts.get(position, 1)
+        qualities = format_qualities(preferences[position])
+        if engine.masks is not None and position in engine.position_rows:
+            rows, scores = engine.position_rows[position], engine.score(position, [qualities])[0]
+        else:
+            rows, scores = np.empty(0, dtype=np.intp), np.empty(0)
+        if len(fixed_name_rows):
+            free = ~np.isin(rows, fixed_name_rows)
+            rows, scores = rows[free], scores[free]
+        available[position] = rows
+        keep_per_club = min(count, max_per_club) if max_per_club else count
+        candidates = squad_candidates(scores, clubs[rows], costs[rows] if costs is not None else None,
+                                      keep_per_club, count + full_clubs * keep_per_club, shared_names[rows])
+        pools.append(SquadPool(position, count, rows[candidates], scores[candidates], clubs[rows][candidates],
+                               costs[rows][candidates] if costs is not None else np.zeros(len(candidates))))
+
+    picks = solve_squad(pools, names, max_per_club, budget, club_counts, spent, names[fixed_rows].tolist())
+    if picks is None:
+        raise ValueError(squad_infeasible_reason({position: len(set(names[rows].tolist()))
+                                                  for position, rows in available.items()}, max_per_club, budget))
+
+    return [(pool.position, rows) for pool, rows in zip(pools, picks)]
+
+# %%
+# Batch re-recommendation: when the roster changes, saved squads can hold players who
+# are no longer in it. Those players are replaced the way recommendation() picks them,
+# with the rest of the squad kept as it is; every other player and every slot's qualities
+# stay as saved, so an unchanged roster leaves every team untouched. The teams to repair
+# are spread over a process pool and only they are rewritten.
+
+def departed_slots(team_rows, name_index):
+    """
+    Indexes of the rows of a saved team whose player is no longer on the roster.
+    """
+    return [slot for slot, (_, playername, _) in enumerate(team_rows)
+            if not isinstance(playername, str) or name_index.lookup(playername) is None]
+
+
+def repair_team(team_rows, team_roster_df=None, max_per_club=MAX_PLAYERS_PER_CLUB):
+    """
+    Returns a saved team's (position, playername, qualities) rows with the players no longer on
+    the roster replaced: per position and qualities, by the best players for the qualities of
+    their slots, the rest of the squad fixed as in recommendation(). Other rows are unchanged.
+    Raises ValueError when no replacement satisfies the constraints.
+    """
+    engine = get_recommender(team_roster_df)
+    roster = engine.team_roster_df
+    names = roster['name'].to_numpy() if 'name' in roster.columns else np.empty(0, dtype=object)
+    team_rows = list(team_rows)
+    vacant = departed_slots(team_rows, get_player_name_index(roster))
+    vacant_set = set(vacant)
+    players = [None if slot in vacant_set else playername for slot, (_, playername, _) in enumerate(team_rows)]
+
+    # Slots to refill, grouped by the position and qualities they were picked for
+    groups = defaultdict(list)
+    for slot in vacant:
+        position, _, qualities = team_rows[slot]
+        groups[(position, qualities or '')].append(slot)
+    for (position, qualities), slots in groups.items():
+        fixed_players = [playername for playername in players if playername is not None]
+        picks = optimize_squad_picks({position: qualities}, roster, max_per_club=max_per_club,
+                                     fixed_players=fixed_players, counts={position: len(slots)})
+        for slot, row in zip(slots, picks[0][1]):
+            players[slot] = names[row]
+    return [(position, players[slot], qualities) for slot, (position, _, qualities) in enumerate(team_rows)]
+
+
+def init_rebuild_worker(data_dir):
+    """
+    Process pool initializer: loads the roster and fits the recommender once per worker.
+    """
+    global DATA_DIR, _DATA_STORE
+    if DATA_DIR != data_dir:
+        DATA_DIR, _DATA_STORE = data_dir, None
+    get_recommender()
+
+
+def repair_teams(teams):
+    """
+    repair_team() for a list of saved teams; None where no replacement satisfies the constraints.
+    """
+    repaired = []
+    for team_rows in teams:
+        try:
+            repaired.append(repair_team(team_rows))
+        except ValueError:
+            repaired.append(None)
+    return repaired
+
+
+def rebuild_all_teams(workers=None, dry_run=False, chunk_size=None):
+    """
+    Brings every saved squad up to date with the current roster: players who left it are
+    replaced (see repair_team()) and only those teams are written back.
+    Returns a summary dict (teams, stale teams, changed, failed, seconds, teams per second).
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    start = time.perf_counter()
+    # Saves still queued by live sessions must be in the database before it is scanned
+    get_data_store().flush_writes()
+    team_store = get_data_store().team_store()
+
+    # One pass over the saved teams: only those with departed players need any work
+    name_index = get_player_name_index()
+    n_teams, stale = 0, {}
+    for customer_id, team_rows in team_store.iter_teams():
+        n_teams += 1
+        if departed_slots(team_rows, name_index):
+            stale[customer_id] = team_rows
+    customer_ids, teams = list(stale), list(stale.values())
+
+    # Repair them, in parallel when there is enough work
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(teams) < 2 * workers:
+        repaired = repair_teams(teams)
+    else:
+        chunk_size = chunk_size or max(1, min(1000, len(teams) // (workers * 8)))
+        chunks = [teams[i:i + chunk_size] for i in range(0, len(teams), chunk_size)]
+        # Compile the recommender here first, so the workers find it in the snapshot (if enabled)
+        get_recommender()
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_rebuild_worker,
+                                 initargs=(DATA_DIR,)) as executor:
+            repaired = [team for chunk_teams in executor.map(repair_teams, chunks) for team in chunk_teams]
+
+    changed_teams, failed = {}, 0
+    for customer_id, team_rows, new_rows in zip(customer_ids, teams, repaired):
+        if new_rows is None:
+            failed += 1
+        elif new_rows != list(team_rows):
+            changed_teams[customer_id] = new_rows
+    if not dry_run:
+        # Through the data store, so a leaderboard in this process sees the new squads;
+        # a server in another process notices the database changed when it next reads it
+        get_data_store().replace_teams(changed_teams)
+
+    elapsed = time.perf_counter() - start
+    return {
+        'teams': n_teams,
+        'stale': len(teams),
+        'changed': len(changed_teams),
+        'failed': failed,
+        'workers': workers,
+        'seconds': elapsed,
+        'teams_per_second': n_teams / elapsed if elapsed else 0.0,
+    }
+
+# %% [markdown]
+# ## 4.3 Fantasy Leaderboard
+
+# %%
+# Points a player earns when they have exactly the qualities their manager asked for
+LEADERBOARD_FIT_POINTS = 100
+# Squad points are rounded so that equal squads tie exactly, whatever order they were summed in
+LEADERBOARD_DECIMALS = 6
+# Entries per bucket of a RankedList: an insert or removal shifts at most about twice this many
+RANKED_LIST_LOAD = 1000
+
+def no_stats_points(playername):
+    """
+    Match-statistics points of a player. Placeholder hook until match data is loaded: always 0.
+    """
+    return 0.0
 
-    # Transform user-desired qualities
-    desired_vector = vectorizer.transform([desired_qualities])
 
-    # Compute cosine similarity
-    similarity_scores = cosine_similarity(desired_vector, qualities_matrix).flatten()
+class RankedList:
+    """
+    Sorted list kept as consecutive buckets of at most 2 x RANKED_LIST_LOAD entries.
+    add() and remove() cost O(load + log n) instead of the O(n) shift of one flat list
+    (plus O(n / load) on the rare add or remove that splits or drops a bucket), index()
+    (the rank of an entry) two bisects and a Fenwick-tree prefix sum of the bucket sizes,
+    and first(k) touches only the leading buckets.
+    """
+
+    def __init__(self, items=()):
+        items = sorted(items)
+        self._buckets = [items[start:start + RANKED_LIST_LOAD] for start in range(0, len(items), RANKED_LIST_LOAD)]
+        self._maxes = [bucket[-1] for bucket in self._buckets]
+        self._len = len(items)
+        self._index_buckets()
+
+    def _index_buckets(self):
+        # Fenwick tree of the bucket sizes (1-based): node i sums the i & -i buckets ending at bucket i
+        tree = [0] + [len(bucket) for bucket in self._buckets]
+        for node in range(1, len(tree)):
+            parent = node + (node & -node)
+            if parent < len(tree):
+                tree[parent] += tree[node]
+        self._sizes = tree
+
+    def _resize_bucket(self, position, change):
+        node = position + 1
+        while node < len(self._sizes):
+            self._sizes[node] += change
+            node += node & -node
+
+    def _entries_before(self, position):
+        """
+        Number of entries in the buckets before position.
+        """
+        total, node = 0, position
+        while node > 0:
+            total += self._sizes[node]
+            node -= node & -node
+        return total
+
+    def __len__(self):
+        return self._len
+
+    def add(self, item):
+        self._len += 1
+        if not self._buckets:
+            self._buckets.append([item])
+            self._maxes.append(item)
+            self._index_buckets()
+            return
+        position = min(bisect_left(self._maxes, item), len(self._buckets) - 1)
+        bucket = self._buckets[position]
+        insort(bucket, item)
+        self._maxes[position] = bucket[-1]
+        if len(bucket) > 2 * RANKED_LIST_LOAD:
+            self._buckets[position:position + 1] = [bucket[:RANKED_LIST_LOAD], bucket[RANKED_LIST_LOAD:]]
+            self._maxes[position:position + 1] = [bucket[RANKED_LIST_LOAD - 1], bucket[-1]]
+            self._index_buckets()
+        else:
+            self._resize_bucket(position, 1)
+
+    def remove(self, item):
+        """
+        Removes one entry equal to item; raises ValueError if there is none.
+        """
+        position = bisect_left(self._maxes, item)
+        bucket = self._buckets[position] if position < len(self._buckets) else []
+        index = bisect_left(bucket, item)
+        if index == len(bucket) or bucket[index] != item:
+            raise ValueError(f"{item!r} is not in the list")
+        del bucket[index]
+        self._len -= 1
+        if not bucket:
+            del self._buckets[position]
+            del self._maxes[position]
+            self._index_buckets()
+        else:
+            self._maxes[position] = bucket[-1]
+            self._resize_bucket(position, -1)
+
+    def index(self, item):
+        """
+        Number of entries smaller than item: its 0-based position when present.
+        """
+        position = bisect_left(self._maxes, item)
+        if position == len(self._buckets):
+            return self._len
+        return self._entries_before(position) + bisect_left(self._buckets[position], item)
+
+    def first(self, k):
+        """
+        Returns the k smallest entries, in order.
+        """
+        items = []
+        for bucket in self._buckets:
+            if len(items) >= k:
+                break
+            items.extend(bucket[:k - len(items)])
+        return items
 
-    # Add similarity scores to DataFrame
-    position_players['similarity'] = similarity_scores
 
-    # Sort and return top N
-    top_players = position_players.sort_values(by='similarity', ascending=False).head(top_n)
+class Leaderboard:
+    """
+    Ranking of every saved squad. Each player of a squad earns LEADERBOARD_FIT_POINTS x
+    the fit (cosine similarity) of their attributes to the qualities chosen for them, plus
+    stats_points(playername). Squads are kept in a RankedList sorted by (-points,
+    customer_id), so the top K is a slice and a customer's rank a binary search; a
+    reverse index from player to squads means a roster change only rescores the squads
+    it touches.
+    """
 
-    return top_players[['name', 'position', 'attributes', 'similarity']] # Use 'name' for team_roster_df
+    def __init__(self, team_roster_df, engine, teams, version=None, stats_points=no_stats_points):
+        self.version = version
+        self.stats_points = stats_points
+        self.squads = {}   # customer_id -> (playernames, qualities) tuples
+        self.points = {}   # customer_id -> points
+        self.ranking = RankedList()  # sorted (-points, customer_id)
+        self.squads_by_player = defaultdict(set)
+        self._lock = threading.RLock()
+        self._set_roster(team_roster_df, engine)
+
+        customer_ids, squads = [], []
+        for customer_id, team_rows in teams:
+            customer_ids.append(customer_id)
+            squads.append((tuple(row[1] for row in team_rows), tuple(row[2] for row in team_rows)))
+        self.squads = dict(zip(customer_ids, squads))
+        names = [playername for squad in squads for playername in squad[0]]
+        qualities = [text for squad in squads for text in squad[1]]
+        team_of_row = np.repeat(np.arange(len(squads)), [len(squad[0]) for squad in squads])
+
+        # Score every squad in one vectorized pass
+        points = np.bincount(team_of_row, weights=self._player_points(names, qualities), minlength=len(squads))
+        self.points = dict(zip(customer_ids, np.round(points, LEADERBOARD_DECIMALS).tolist()))
+        self.ranking = RankedList((-team_points, customer_id) for customer_id, team_points in self.points.items())
+
+        # Reverse index, from the squad rows grouped by player
+        owners = np.array(customer_ids, dtype=object)
+        for playername, rows in group_rows(names).items():
+            self.squads_by_player[playername] = set(owners[team_of_row[rows]].tolist())
+
+    def __len__(self):
+        return len(self.ranking)
+
+    def _set_roster(self, team_roster_df, engine):
+        self.team_roster_df = team_roster_df
+        self.engine = engine
+        # First roster row of each name, as the team builder picks them by name
+        names = team_roster_df['name'].tolist() if 'name' in team_roster_df.columns else []
+        self.player_rows = {name: row for row, name in reversed(list(enumerate(names)))}
+        self._query_masks = {}  # qualities -> (mask over this roster's vocabulary, number of qualities)
+
+    def _player_points(self, names, qualities):
+        """
+        Points of each (playername, qualities) pair; players no longer in the roster earn none.
+        """
+        # Look up each distinct name and qualities string once (code -1, i.e. missing, maps to the last entry)
+        name_codes, distinct_names = pd.factorize(pd.Series(names, dtype=object).fillna(''))
+        rows = np.array([self.player_rows.get(name, -1) for name in distinct_names] + [-1], dtype=np.intp)[name_codes]
+        points = np.zeros(len(rows))
+        if self.engine.masks is not None and len(rows):
+            query_codes, distinct_queries = pd.factorize(pd.Series(qualities, dtype=object).fillna(''))
+            new_queries = [text for text in distinct_queries if text not in self._query_masks]
+            if new_queries:
+                masks = self.engine.encode_queries([str(text) for text in new_queries])
+                # The query side of the cosine counts every quality asked for, known to the
+                # roster or not, so a squad's points do not move when the vocabulary grows
+                sizes = [len(set(split_attributes(text))) for text in new_queries]
+                self._query_masks.update(zip(new_queries, zip(masks, sizes)))
+            query_masks = np.array([self._query_masks[text][0] for text in distinct_queries] +
+                                   [np.zeros(self.engine.masks.shape[1], dtype=np.uint64)])[query_codes]
+            query_sizes = np.array([self._query_masks[text][1] for text in distinct_queries] + [0])[query_codes]
+            known = rows >= 0
+            player_masks = self.engine.masks[rows[known]]
+            shared = popcount(player_masks & query_masks[known]).sum(axis=1, dtype=np.int32)
+            norms = np.sqrt(self.engine.sizes[rows[known]].astype(np.float64) * query_sizes[known])
+            points[known] = LEADERBOARD_FIT_POINTS * np.divide(shared, norms, out=np.zeros(len(shared)),
+                                                                where=norms > 0)
+        if self.stats_points is not no_stats_points:
+            points += [self.stats_points(name) for name in names]
+        return points
+
+    def _remove(self, customer_id):
+        squad = self.squads.pop(customer_id, None)
+        if squad is None:
+            return
+        entry = (-self.points.pop(customer_id), customer_id)
+        self.ranking.remove(entry)
+        for playername in squad[0]:
+            self.squads_by_player[playername].discard(customer_id)
+
+    def _add(self, customer_id, squad):
+        team_points = round(float(self._player_points(*squad).sum()), LEADERBOARD_DECIMALS)
+        self.squads[customer_id] = squad
+        self.points[customer_id] = team_points
+        self.ranking.add((-team_points, customer_id))
+        for playername in squad[0]:
+            self.squads_by_player[playername].add(customer_id)
+
+    @timed('leaderboard.update_team')
+    def update_team(self, customer_id, team_rows):
+        """
+        Rescores one customer's squad from its (position, playername, qualities) rows
+        (an empty list removes it).
+        """
+        team_rows = list(team_rows)
+        with self._lock:
+            self._remove(customer_id)
+            if team_rows:
+                self._add(customer_id, (tuple(row[1] for row in team_rows), tuple(row[2] for row in team_rows)))
+
+    @timed('leaderboard.apply_roster')
+    def apply_roster(self, team_roster_df, engine, version, delta=None):
+        """
+        Moves the leaderboard to a new roster version, rescoring only the squads of the
+        players the RosterDelta added, changed or removed (all squads without a delta).
+        """
+        with self._lock:
+            if delta is None:
+                affected = set(self.squads)
+            else:
+                names = self.team_roster_df['name'].to_numpy()[delta.stale_rows].tolist() + \
+                    team_roster_df['name'].to_numpy()[delta.dirty_rows].tolist()
+                affected = set().union(*[self.squads_by_player.get(name, ()) for name in names])
+            self._set_roster(team_roster_df, engine)
+            for customer_id in affected:
+                squad = self.squads[customer_id]
+                self._remove(customer_id)
+                self._add(customer_id, squad)
+            self.version = version
+            return len(affected)
+
+    def top(self, k=10):
+        """
+        Returns the best k squads as (customer_id, points), best first.
+        """
+        with self._lock:
+            return [(customer_id, -negative_points) for negative_points, customer_id in self.ranking.first(k)]
+
+    def rank(self, customer_id):
+        """
+        Returns (rank, points) of a customer's squad (1 = best), or None if they have none.
+        """
+        with self._lock:
+            team_points = self.points.get(customer_id)
+            if team_points is None:
+                return None
+            return self.ranking.index((-team_points, customer_id)) + 1, team_points
+
+
+def show_leaderboard(customer_id, top_k=5):
+    """
+    Prints the top squads of the league and where the customer's squad stands.
+    """
+    store = get_data_store()
+    board = store.leaderboard()
+    accounts = store.accounts()
+    say("\n| Fantasy Leaderboard |")
+    say("==========================================================")
+    for rank, (leader_id, team_points) in enumerate(board.top(top_k), 1):
+        manager = accounts.get(leader_id, {}).get('name') or leader_id
+        say(f"{rank}. {manager}: {team_points:.1f} points")
+    standing = board.rank(customer_id)
+    if standing is not None:
+        say(f"\nYour team: {standing[1]:.1f} points, rank {standing[0]} of {len(board)}.")
 
 # %% [markdown]
 # # 5. Data Persistence Utilities
 # 
 
 # %%
-def save_customer_database(customer_database, filename='/content/customer_database.csv'):
+def fsync_directory(path):
+    """
+    Flushes a directory entry so a rename inside it survives a crash (no-op where unsupported).
     """
-  Converts the provided customer database dictionary into a DataFrame and saves it to a specified CSV file.
+    try:
+        fd = os.open(path or '.', os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+@timed('persist.save_customer_database')
+def save_customer_database(customer_database, filename=None):
+    """
+  Writes the provided customer database dictionary to a CSV file, atomically replacing the previous file.
   """
     import csv
 
-    #Saves the customer database dictionary to a CSV file.
-    with open(filename, mode='w', newline='') as outfile:
+    filename = filename or data_path('customer_database.csv')
+    temp_filename = filename + '.tmp'
+
+    #Saves the customer database dictionary to a temporary CSV file first.
+    with open(temp_filename, mode='w', newline='', encoding='utf-8') as outfile:
         writer = csv.writer(outfile)
 
         # Write the header row
@@ -806,7 +4155,623 @@ def save_customer_database(customer_database, filename='/content/customer_databa
             # Write only the header if the database is empty
             writer.writerow(['customer_id', 'email', 'name', 'pin'])
 
+        # Make sure the data is on disk before it replaces the old file
+        outfile.flush()
+        os.fsync(outfile.fileno())
+
+    os.replace(temp_filename, filename)
+    fsync_directory(os.path.dirname(filename))
+
 # %%
+# Account changes are appended to a JSON-lines journal next to the CSV snapshot
+# instead of rewriting the whole file for every registration. A background
+# thread periodically folds the journal back into the CSV.
+JOURNAL_COMPACT_EVERY = 1000      # journal entries that trigger a compaction
+JOURNAL_COMPACT_INTERVAL = 300    # seconds between periodic compactions
 
+class AccountJournal:
+    """
+    Append-only journal of account inserts/updates on top of the customer_database.csv snapshot.
+    """
+
+    def __init__(self, snapshot_path, compact_every=JOURNAL_COMPACT_EVERY,
+                 compact_interval=JOURNAL_COMPACT_INTERVAL):
+        self.snapshot_path = snapshot_path
+        self.journal_path = snapshot_path + '.journal'
+        # Journal being folded into the snapshot; replayed too if a compaction was interrupted
+        self.compacting_path = snapshot_path + '.journal.compacting'
+        self.compact_every = compact_every
+        self.compact_interval = compact_interval
+        self.pending_entries = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._compactor = None
+
+    def paths(self):
+        return (self.snapshot_path, self.journal_path, self.compacting_path)
+
+    def append(self, customer_id, record, op='upsert'):
+        """
+        Durably appends one account change to the journal.
+        """
+        self.append_many([(customer_id, record)], op)
+
+    @timed('persist.journal_append')
+    def append_many(self, changes, op='upsert'):
+        """
+        Durably appends (customer_id, record) changes with a single write and fsync.
+        """
+        entries = ''.join(json.dumps({'op': op, 'customer_id': customer_id, 'record': dict(record)},
+                                     default=str) + '\n' for customer_id, record in changes)
+        with self._lock:
+            with open(self.journal_path, mode='a', encoding='utf-8') as journal:
+                journal.write(entries)
+                journal.flush()
+                os.fsync(journal.fileno())
+            self.pending_entries += len(changes)
+
+    def replay(self):
+        """
+        Yields (customer_id, record) for every journaled change, oldest first.
+        """
+        replayed = 0
+        for path in (self.compacting_path, self.journal_path):
+            if not os.path.exists(path):
+                continue
+            with open(path, encoding='utf-8') as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A crash mid-append can leave a torn last line; skip it
+                        continue
+                    if entry.get('op') == 'upsert':
+                        replayed += 1
+                        yield entry['customer_id'], entry['record']
+        # Entries left over from an earlier run still need compacting
+        self.pending_entries = replayed
+
+    def rotate(self):
+        """
+        Moves the live journal aside so the snapshot can be written while appends continue.
+        """
+        with self._lock:
+            if not os.path.exists(self.journal_path):
+                return
+            if os.path.exists(self.compacting_path):
+                # An earlier compaction did not finish: keep all of its entries
+                with open(self.journal_path, encoding='utf-8') as journal, \
+                        open(self.compacting_path, mode='a', encoding='utf-8') as compacting:
+                    compacting.write(journal.read())
+                    compacting.flush()
+                    os.fsync(compacting.fileno())
+                os.remove(self.journal_path)
+            else:
+                os.replace(self.journal_path, self.compacting_path)
+            fsync_directory(os.path.dirname(self.journal_path))
+            self.pending_entries = 0
+
+    def write_snapshot(self, account_dict):
+        """
+        Atomically replaces the CSV snapshot, then drops the journal it now contains.
+        """
+        save_customer_database(account_dict, self.snapshot_path)
+        if os.path.exists(self.compacting_path):
+            os.remove(self.compacting_path)
+            fsync_directory(os.path.dirname(self.compacting_path))
+
+    def request_compaction(self, compact):
+        """
+        Starts the background compactor on first use and wakes it once enough entries piled up.
+        """
+        if self._compactor is None:
+            with self._lock:
+                if self._compactor is None:
+                    self._compactor = threading.Thread(
+                        target=self._run_compactor, args=(compact,), name='account-journal-compactor', daemon=True)
+                    self._compactor.start()
+        if self.pending_entries >= self.compact_every:
+            self._wakeup.set()
+
+    def _run_compactor(self, compact):
+        while True:
+            self._wakeup.wait(self.compact_interval)
+            self._wakeup.clear()
+            if self.pending_entries:
+                try:
+                    compact()
+                except OSError as error:
+                    print(f"Error: Could not compact the account journal: {error}")
+
+# %%
+# Columns of created_teams.csv, one row per player of a customer's squad
+TEAM_COLUMNS = ["customer_id", "position", "playername", "qualities"]
+
+class TeamStore:
+    """
+    Created fantasy teams kept in SQLite (standard library only). The primary key
+    (customer_id, slot) doubles as the customer_id index, so reading or replacing one
+    customer's team does not depend on how many teams the league has.
+    """
+
+    def __init__(self, db_path, csv_path=None):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        is_new = not os.path.exists(db_path)
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS created_teams (
+                    customer_id TEXT NOT NULL,
+                    slot INTEGER NOT NULL,
+                    position TEXT NOT NULL,
+                    playername TEXT NOT NULL,
+                    qualities TEXT,
+                    PRIMARY KEY (customer_id, slot)
+                )""")
+
+        # First run: seed the database from the existing CSV export
+        if is_new and csv_path and os.path.exists(csv_path):
+            self.import_csv(csv_path)
+
+    @timed('persist.save_team')
+    def save_team(self, customer_id, team_rows):
+        """
+        Replaces a customer's team with the given (position, playername, qualities) rows in one transaction.
+        """
+        rows = [(customer_id, slot, position, playername, qualities)
+                for slot, (position, playername, qualities) in enumerate(team_rows)]
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM created_teams WHERE customer_id = ?", (customer_id,))
+            self._connection.executemany("INSERT INTO created_teams VALUES (?, ?, ?, ?, ?)", rows)
+
+    def data_version(self):
+        """
+        Returns SQLite's data_version: it changes whenever another connection, such as
+        another process, commits to the database, but not on this connection's own writes.
+        """
+        with self._lock:
+            return self._connection.execute("PRAGMA data_version").fetchone()[0]
+
+    def replace_teams(self, teams, batch_size=5000):
+        """
+        Bulk version of save_team() for {customer_id: rows}: one transaction per batch of customers,
+        so live sessions only wait for one batch at a time. Returns the number of teams written.
+        """
+        teams = list(teams.items())
+        for start in range(0, len(teams), batch_size):
+            batch = teams[start:start + batch_size]
+            rows = [(customer_id, slot, position, playername, qualities)
+                    for customer_id, team_rows in batch
+                    for slot, (position, playername, qualities) in enumerate(team_rows)]
+            with self._lock, self._connection:
+                self._connection.executemany("DELETE FROM created_teams WHERE customer_id = ?",
+                                             [(customer_id,) for customer_id, _ in batch])
+                self._connection.executemany("INSERT INTO created_teams VALUES (?, ?, ?, ?, ?)", rows)
+        return len(teams)
+
+    def iter_teams(self, batch_size=10000):
+        """
+        Yields (customer_id, [(position, playername, qualities), ...]) for every team. The scan
+        uses its own connection, so it reads a consistent snapshot while sessions keep writing.
+        """
+        connection = sqlite3.connect(self.db_path)
+        try:
+            cursor = connection.execute(
+                "SELECT customer_id, position, playername, qualities FROM created_teams ORDER BY customer_id, slot")
+            customer_id, team_rows = None, []
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row_customer_id, position, playername, qualities in rows:
+                    if row_customer_id != customer_id:
+                        if team_rows:
+                            yield customer_id, team_rows
+                        customer_id, team_rows = row_customer_id, []
+                    team_rows.append((position, playername, qualities))
+            if team_rows:
+                yield customer_id, team_rows
+        finally:
+            connection.close()
+
+    @timed('persist.load_team')
+    def load_team(self, customer_id):
+        """
+        Returns one customer's team as a DataFrame with the created_teams.csv columns.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT customer_id, position, playername, qualities FROM created_teams "
+                "WHERE customer_id = ? ORDER BY slot", (customer_id,)).fetchall()
+        return pd.DataFrame(rows, columns=TEAM_COLUMNS)
+
+    def import_csv(self, path):
+        """
+        Loads a created_teams.csv export, replacing the teams of every customer it contains.
+        The file is streamed chunk by chunk inside a single transaction, so memory stays
+        bounded however large the export is.
+        """
+        imported = 0
+        next_slot = {}  # customer_id -> next free slot, across chunks
+        with self._lock, self._connection:
+            for chunk in iter_csv_chunks(path, CREATED_TEAM_DTYPES, CREATED_TEAM_REQUIRED):
+                chunk = chunk.reindex(columns=TEAM_COLUMNS).astype(object)
+                chunk = chunk.where(chunk.notna(), None)
+                new_customers = [customer_id for customer_id in pd.unique(chunk['customer_id'])
+                                 if customer_id not in next_slot]
+                self._connection.executemany("DELETE FROM created_teams WHERE customer_id = ?",
+                                             [(customer_id,) for customer_id in new_customers])
+                for customer_id in new_customers:
+                    next_slot[customer_id] = 0
+                slots = chunk.groupby('customer_id', sort=False).cumcount() + \
+                    chunk['customer_id'].map(next_slot).astype(int)
+                for customer_id, size in chunk.groupby('customer_id', sort=False).size().items():
+                    next_slot[customer_id] += size
+                self._connection.executemany("INSERT INTO created_teams VALUES (?, ?, ?, ?, ?)", zip(
+                    chunk['customer_id'], slots.tolist(), chunk['position'], chunk['playername'], chunk['qualities']))
+                imported += len(chunk)
+        return imported
+
+    def export_csv(self, path):
+        """
+        Writes every team to a CSV file in the created_teams.csv format.
+        """
+        import csv
+
+        temp_path = path + '.tmp'
+        with self._lock, open(temp_path, mode='w', newline='', encoding='utf-8') as outfile:
+            writer = csv.writer(outfile)
+            writer.writerow(TEAM_COLUMNS)
+            writer.writerows(self._connection.execute(
+                "SELECT customer_id, position, playername, qualities FROM created_teams ORDER BY rowid"))
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(temp_path, path)
+
+
+@timed('persist.save_created_teams')
+def save_created_teams(customer_team_df):
+    """
+    Saves a finalized team (rows of one customer) to the created-teams store, in the background.
+    """
+    if customer_team_df is None or customer_team_df.empty:
+        return
+    customer_id = customer_team_df['customer_id'].iloc[0]
+    team_rows = customer_team_df[['position', 'playername', 'qualities']].itertuples(index=False, name=None)
+    get_data_store().save_team(customer_id, team_rows)
+
+# %%
+# Saves made during a conversation (registrations, finished teams) are handed to a
+# background writer instead of hitting the disk on the interaction path. Pending
+# writes to the same account or team are coalesced, and each flush writes a whole
+# batch at once: one journal append + fsync for accounts, one SQLite transaction
+# for teams. Everything is flushed on a clean exit.
+
+WRITE_BEHIND_BATCH = 500          # pending writes that trigger a flush straight away
+WRITE_BEHIND_DELAY = 0.05         # seconds a write may wait for others to share its flush
+WRITE_BEHIND_MAX_PENDING = 10000  # put() blocks while this many writes are waiting
+WRITE_BEHIND_CLOSE_TIMEOUT = 30   # seconds to wait for the final flush at exit
+
+class WriteBehindQueue:
+    """
+    Bounded, coalescing queue of pending writes drained by one daemon thread.
+    handlers maps each kind of write to a function taking a list of (key, value).
+    """
+
+    def __init__(self, handlers, batch_size=WRITE_BEHIND_BATCH, delay=WRITE_BEHIND_DELAY,
+                 max_pending=WRITE_BEHIND_MAX_PENDING):
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self.delay = delay
+        self.max_pending = max_pending
+        self._pending = {}    # (kind, key) -> latest value, in order of first write
+        self._in_flight = {}  # the batch being written right now
+        self._oldest = None   # when the oldest pending write was queued
+        self._queued = 0      # writes accepted so far
+        self._written = 0     # writes accepted before the last completed flush
+        self._flush_now = False
+        self._closed = False
+        self._thread = None
+        self._condition = threading.Condition()
+
+    def depth(self):
+        """
+        Number of writes waiting (coalesced ones count once).
+        """
+        return len(self._pending)
+
+    def put(self, kind, key, value):
+        """
+        Queues a write and returns at once, unless max_pending writes are already waiting.
+        """
+        if self._closed:
+            # After the final flush: write through so nothing is lost
+            self.handlers[kind]([(key, value)])
+            return
+        with self._condition:
+            while len(self._pending) >= self.max_pending and (kind, key) not in self._pending:
+                self._condition.wait()
+            if (kind, key) in self._pending:
+                METRICS.count('persist_coalesced')
+            elif not self._pending:
+                self._oldest = time.monotonic()
+            self._pending[(kind, key)] = value
+            self._queued += 1
+            METRICS.gauge('persist_queue_depth', len(self._pending))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+            if len(self._pending) >= self.batch_size:
+                self._condition.notify_all()
+
+    def pending(self, kind):
+        """
+        Returns the (key, value) writes of a kind not yet on disk, oldest first.
+        """
+        with self._condition:
+            merged = {**self._in_flight, **self._pending}
+        return [(key, value) for (pending_kind, key), value in merged.items() if pending_kind == kind]
+
+    def pending_value(self, kind, key):
+        """
+        Returns the value of a write not yet on disk, or None.
+        """
+        with self._condition:
+            value = self._pending.get((kind, key))
+            return self._in_flight.get((kind, key)) if value is None else value
+
+    def flush(self, timeout=None):
+        """
+        Blocks until every write queued before the call is on disk. Returns False on timeout.
+        """
+        with self._condition:
+            target = self._queued
+            self._flush_now = True
+            self._condition.notify_all()
+            return self._condition.wait_for(lambda: self._written >= target, timeout)
+
+    def close(self):
+        """
+        Flushes what is pending and stops the writer; later writes go straight to disk.
+        """
+        if self._thread is None or self._closed:
+            return
+        if not self.flush(WRITE_BEHIND_CLOSE_TIMEOUT):
+            print(f"Error: {self.depth()} saves could not be written before exit.")
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._due():
+                    if self._closed:
+                        return
+                    timeout = None if not self._pending else self._oldest + self.delay - time.monotonic()
+                    self._condition.wait(timeout)
+                batch, self._pending, self._oldest = self._pending, {}, None
+                self._in_flight, self._flush_now = batch, False
+                target = self._queued
+                METRICS.gauge('persist_queue_depth', 0)
+                # Writers blocked on a full queue can go on
+                self._condition.notify_all()
+            if self._write(batch):
+                with self._condition:
+                    self._in_flight = {}
+                    self._written = target
+                    self._condition.notify_all()
+            else:
+                # Put the batch back (newer writes win) and retry a second later
+                with self._condition:
+                    self._pending = {**batch, **self._pending}
+                    self._in_flight = {}
+                    self._oldest = time.monotonic()
+                    self._condition.wait(max(self.delay, 1.0))
+
+    def _due(self):
+        if not self._pending:
+            return False
+        return self._flush_now or len(self._pending) >= self.batch_size or \
+            time.monotonic() - self._oldest >= self.delay
+
+    @timed('persist.flush')
+    def _write(self, batch):
+        """
+        Hands each kind's writes to its handler in one call. Returns False if one failed.
+        """
+        by_kind = defaultdict(list)
+        for (kind, key), value in batch.items():
+            by_kind[kind].append((key, value))
+        try:
+            for kind, writes in by_kind.items():
+                self.handlers[kind](writes)
+        except Exception as error:
+            print(f"Error: Could not save {len(batch)} pending changes: {error}")
+            return False
+        METRICS.count('persist_flushes')
+        METRICS.count('persist_writes', len(batch))
+        return True
+
+# %% [markdown]
+# # 6. Multi-Session Chat Server
+# 
+
+# %%
+# asyncio is only imported when the server actually starts
+asyncio = LazyModule('asyncio', 'asyncio')
+
+# Line-based TCP transport: one connection is one chat session. The dialogue
+# functions stay synchronous, so each active session runs them on a worker
+# thread that blocks on its own reply queue while the event loop owns the socket.
+
+CHAT_IDLE_TIMEOUT = 600    # seconds a client may take to reply before its session is closed
+CHAT_BUSY_MESSAGE = "The NSL chatbot is busy right now. Please try again in a few minutes.\n"
+
+class LineChannel:
+    """
+    Connects one session's dialogue thread to its asyncio stream writer.
+    """
+
+    def __init__(self, loop, writer):
+        self._loop = loop
+        self._writer = writer
+        self._replies = queue.Queue()
+
+    def write(self, text):
+        self._loop.call_soon_threadsafe(self._writer.write, text.replace('\n', '\r\n').encode('utf-8'))
+
+    def read_line(self, prompt=''):
+        if prompt:
+            self.write(prompt)
+        line = self._replies.get()
+        if line is None:
+            raise ChatSessionClosed()
+        return line
+
+    def feed(self, line):
+        """
+        Called from the event loop with each line received from the client (None on disconnect).
+        """
+        self._replies.put(line)
+
+
+def run_channel_session(channel):
+    """
+    Runs one full chatbot conversation against a channel (on a worker thread).
+    """
+    _CHAT_CHANNEL.set(channel)
+    try:
+        run_session()
+    except ChatSessionClosed:
+        pass
+
+
+async def handle_chat_connection(reader, writer, executor, sessions, idle_timeout=CHAT_IDLE_TIMEOUT):
+    loop = asyncio.get_running_loop()
+    if sessions.locked():
+        # Every worker thread is taken: say so instead of queueing behind other users
+        METRICS.count('sessions_rejected')
+        writer.write(CHAT_BUSY_MESSAGE.replace('\n', '\r\n').encode('utf-8'))
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+        return
+
+    async with sessions:
+        channel = LineChannel(loop, writer)
+        # Each session gets its own context so the channel never leaks between threads
+        session = loop.run_in_executor(executor, contextvars.copy_context().run, run_channel_session, channel)
+
+        try:
+            while not session.done():
+                next_line = asyncio.ensure_future(reader.readline())
+                await asyncio.wait({next_line, session}, timeout=idle_timeout,
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if not next_line.done():
+                    next_line.cancel()
+                    if not session.done():
+                        # Idle client: free its worker thread
+                        METRICS.count('sessions_timed_out')
+                        channel.write(f"\nSession closed after {idle_timeout:.0f} seconds without a reply. Goodbye!\n")
+                        channel.feed(None)
+                    break
+                data = next_line.result()
+                if not data:
+                    # Client disconnected: unblock the dialogue thread
+                    channel.feed(None)
+                    break
+                channel.feed(data.decode('utf-8', errors='replace').rstrip('\r\n'))
+            await session
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            channel.feed(None)
+        finally:
+            writer.close()
+
+
+async def serve_chat(host='127.0.0.1', port=8765, max_sessions=256, idle_timeout=CHAT_IDLE_TIMEOUT):
+    """
+    Starts the chat server and serves connections until cancelled. Clients beyond max_sessions
+    are told the server is busy, and a session closes once its client is idle for idle_timeout seconds.
+    """
+    # Load the shared datasets, team store and recommender once, before the first user connects
+    get_data_store().accounts()
+    get_data_store().team_store()
+    get_recommender()
+    # Apply roster edits in the background instead of on a user's request
+    get_data_store().watch_roster()
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    executor = ThreadPoolExecutor(max_workers=max_sessions, thread_name_prefix='chat-session')
+    sessions = asyncio.Semaphore(max_sessions)
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_chat_connection(reader, writer, executor, sessions, idle_timeout), host, port)
+    print(f"NSL chatbot listening on {host}:{port} (up to {max_sessions} concurrent sessions)")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def run_chat_server(host='127.0.0.1', port=8765, max_sessions=256, idle_timeout=CHAT_IDLE_TIMEOUT):
+    try:
+        asyncio.run(serve_chat(host, port, max_sessions, idle_timeout))
+    except KeyboardInterrupt:
+        print("\nChat server stopped.")
+
+# %% [markdown]
+# # 7. Startup Profiling
+# 
 
+# %%
+# Heavy dependencies, grouped by what first needs them: loading the roster and accounts,
+# which every menu does, and the discovery menu's country map
+HEAVY_DEPENDENCIES = {
+    'data': ['numpy', 'pandas'],
+    'discovery': ['plotly.express', 'plotly.io'],
+}
+
+def profile_startup():
+    """
+    Prints how long the chatbot takes to be ready for the welcome prompt, what each
+    heavy dependency adds when it is first imported, and the cost of the first data load.
+    """
+    import sys
+
+    timings = [('module body (welcome prompt ready)', _MODULE_READY - _MODULE_START, '')]
+    for group, module_names in HEAVY_DEPENDENCIES.items():
+        for module_name in module_names:
+            note = 'already loaded' if module_name in sys.modules else ''
+            start = time.perf_counter()
+            importlib.import_module(module_name)
+            timings.append((f'import {module_name} ({group})', time.perf_counter() - start, note))
+
+    source = 'snapshot enabled' if get_data_store().snapshot is not None else ''
+    start = time.perf_counter()
+    import_files()
+    timings.append(('first load of the datasets', time.perf_counter() - start, source))
+    start = time.perf_counter()
+    get_recommender()
+    timings.append(('fit the recommender', time.perf_counter() - start, source))
+
+    print(f"{'Startup step':<45}{'ms':>10}")
+    print("-" * 55)
+    for label, seconds, note in timings:
+        print(f"{label:<45}{seconds * 1000:>10.1f}  {note}")
+    print("-" * 55)
+    print(f"{'total':<45}{sum(seconds for _, seconds, _ in timings) * 1000:>10.1f}")
+
+# Timestamp of the end of the module body, for --profile-startup
+_MODULE_READY = time.perf_counter()
 
+# %%
+if __name__ == '__main__':
+  main()
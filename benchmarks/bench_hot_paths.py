@@ -0,0 +1,254 @@
+# Headless benchmarks of the chatbot's hot paths against synthetic leagues.
+# Every path runs on generated data of each requested size; timings and peak
+# memory per (path, size) are written to a JSON file so runs can be compared.
+
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import NSL_Chatbot as chatbot
+from synthetic_league import SIZES, write_league
+
+
+class ScriptedChannel:
+    """
+    Chat channel that answers prompts from a list and discards the chatbot's output.
+    """
+
+    def __init__(self, replies):
+        self.replies = list(replies)
+
+    def write(self, text):
+        pass
+
+    def read_line(self, prompt=''):
+        return self.replies.pop(0)
+
+
+def run_scripted(replies, function, *args):
+    """
+    Runs a dialogue function with its prompts answered from replies.
+    """
+    token = chatbot._CHAT_CHANNEL.set(ScriptedChannel(replies))
+    try:
+        return function(*args)
+    finally:
+        chatbot._CHAT_CHANNEL.reset(token)
+
+
+def use_data_dir(directory):
+    """
+    Points the chatbot at a data directory with a fresh, empty data store.
+    """
+    chatbot.DATA_DIR = directory
+    chatbot._DATA_STORE = None
+
+
+def measure(function, min_time=0.2, min_repeats=3, max_repeats=1000):
+    """
+    Times function() repeatedly, then runs it once more under tracemalloc for its peak memory.
+    """
+    timings = []
+    started = time.perf_counter()
+    while len(timings) < min_repeats or (time.perf_counter() - started < min_time and len(timings) < max_repeats):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "repeats": len(timings),
+        "median_ms": statistics.median(timings) * 1000,
+        "mean_ms": statistics.fmean(timings) * 1000,
+        "min_ms": min(timings) * 1000,
+        "max_ms": max(timings) * 1000,
+        "peak_kib": peak / 1024,
+    }
+
+
+def hot_paths(directory, rng):
+    """
+    Returns {path name: zero-argument callable} for one generated league.
+    """
+    store = chatbot.get_data_store()
+    roster = store.roster()
+    accounts = store.accounts()
+    names = roster["name"].tolist()
+    emails = [record["email"] for record in list(accounts.values())[:1000]]
+    pins = {record["email"]: str(record["pin"]) for record in list(accounts.values())[:1000]}
+    positions = list(chatbot.POSITION_COUNTS)
+    teams = roster["team"].dropna().unique().tolist()
+    registrations = iter(range(10 ** 9))
+
+    def import_files_cold():
+        # Load through a throwaway store so the other paths keep their warm caches
+        use_data_dir(directory)
+        try:
+            chatbot.import_files()
+        finally:
+            chatbot._DATA_STORE = store
+
+    def import_files_warm():
+        chatbot.import_files()
+
+    def recommender_fit():
+        chatbot.RecommenderEngine(roster)
+
+    def get_top_players():
+        position = rng.choice(positions)
+        qualities = " | ".join(rng.sample(chatbot.POSITION_QUALITIES[position], 2))
+        chatbot.get_top_players(position, qualities, roster, chatbot.POSITION_COUNTS[position])
+
+    def recommend_squad():
+        chatbot.recommend_squad({position: rng.sample(chatbot.POSITION_QUALITIES[position], 2)
+                                 for position in positions})
+
+    def optimize_squad():
+        chatbot.optimize_squad({position: rng.sample(chatbot.POSITION_QUALITIES[position], 2)
+                                for position in positions}, max_per_club=chatbot.MAX_PLAYERS_PER_CLUB)
+
+    def player_name_lookup():
+        # Same steps as option 1 of favourite_players() for a known player
+        row = chatbot.get_player_name_index(roster).lookup(rng.choice(names).lower())
+        roster.iloc[row]
+
+    def position_lookup():
+        # Same steps as option 1 of favourite_players() for a position
+        query_index = chatbot.get_roster_query_index(roster)
+        chatbot.player_lines(roster, query_index.postings["position"][chatbot.fold_text(rng.choice(positions))])
+
+    def roster_query():
+        # A compound question from option 3: a club's players in one position with one attribute
+        position = rng.choice(positions)
+        chatbot.get_roster_query_index(roster).query(team=rng.choice(teams), position=position,
+                                                     attributes=rng.choice(chatbot.POSITION_QUALITIES[position]))
+
+    def similar_players_build():
+        chatbot.NeighbourTable(roster)
+
+    def similar_players():
+        # Same steps as option 1 of favourite_players() after a player card
+        chatbot.get_similar_players(roster).similar(rng.randrange(len(roster)), 5)
+
+    squad_owners = []
+
+    def leaderboard():
+        # Built on first use only, as scoring every saved squad takes a while on large leagues
+        board = store.leaderboard()
+        if not squad_owners:
+            squad_owners.extend(board.squads)
+        return board
+
+    def leaderboard_update():
+        # One saved squad rescored and re-ranked
+        board = leaderboard()
+        board.update_team(rng.choice(squad_owners),
+                          [(position, rng.choice(names), rng.choice(chatbot.POSITION_QUALITIES[position]))
+                           for position in positions for _ in range(chatbot.POSITION_COUNTS[position])])
+
+    def leaderboard_rank():
+        board = leaderboard()
+        board.rank(rng.choice(squad_owners))
+        board.top(10)
+
+    def check_identifier_login():
+        email = rng.choice(emails).upper()
+        run_scripted([pins[email.lower()]], chatbot.check_identifier, "Bench", email)
+
+    def check_identifier_register():
+        email = f"bench{next(registrations)}@example.com"
+        run_scripted(["1234"], chatbot.check_identifier, "Bench", email)
+
+    def save_customer_database():
+        chatbot.save_customer_database(store.accounts(), os.path.join(directory, "customer_database_copy.csv"))
+
+    return {
+        "import_files_cold": import_files_cold,
+        "import_files_warm": import_files_warm,
+        "recommender_fit": recommender_fit,
+        "get_top_players": get_top_players,
+        "recommend_squad": recommend_squad,
+        "optimize_squad": optimize_squad,
+        "player_name_lookup": player_name_lookup,
+        "position_lookup": position_lookup,
+        "roster_query": roster_query,
+        "similar_players_build": similar_players_build,
+        "similar_players": similar_players,
+        "leaderboard_update": leaderboard_update,
+        "leaderboard_rank": leaderboard_rank,
+        "check_identifier_login": check_identifier_login,
+        "check_identifier_register": check_identifier_register,
+        "save_customer_database": save_customer_database,
+    }
+
+
+def run_benchmarks(sizes, paths=None, min_time=0.2, seed=0, work_dir=None):
+    results = []
+    for size in sizes:
+        n_players, n_customers, n_teams = SIZES[size]
+        with tempfile.TemporaryDirectory(dir=work_dir) as directory:
+            print(f"[{size}] generating {n_players} players, {n_customers} customers, {n_teams} teams")
+            write_league(directory, n_players, n_customers, n_teams, seed)
+            use_data_dir(directory)
+
+            rng = random.Random(seed)
+            for path, function in hot_paths(directory, rng).items():
+                if paths and path not in paths:
+                    continue
+                timing = measure(function, min_time=min_time)
+                print(f"[{size}] {path:<28}{timing['median_ms']:>12.3f} ms{timing['peak_kib']:>14.1f} KiB")
+                results.append({"path": path, "size": size, "players": n_players,
+                                "customers": n_customers, "created_teams": n_teams, **timing})
+            # Saves are written in the background: finish them before the directory goes away
+            chatbot.get_data_store().flush_writes()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the NSL chatbot hot paths")
+    parser.add_argument("--sizes", default="current,small",
+                        help=f"comma-separated sizes from: {', '.join(SIZES)}")
+    parser.add_argument("--paths", help="comma-separated subset of paths to run")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds to spend timing each path")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--work-dir", help="where to generate the leagues (default: system temp)")
+    parser.add_argument("--output", default="bench_results.json")
+    args = parser.parse_args(argv)
+
+    sizes = args.sizes.split(",")
+    unknown = [size for size in sizes if size not in SIZES]
+    if unknown:
+        parser.error(f"unknown sizes: {', '.join(unknown)}")
+
+    results = run_benchmarks(sizes, args.paths.split(",") if args.paths else None,
+                             args.min_time, args.seed, args.work_dir)
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+    with open(args.output, mode="w", encoding="utf-8") as outfile:
+        json.dump(report, outfile, indent=2)
+    print(f"Wrote {len(results)} results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
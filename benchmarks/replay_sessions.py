@@ -0,0 +1,269 @@
+# Load generator: replays scripted conversations through the real chatbot flow
+# (run_session() with a channel per session, exactly as the chat server runs them)
+# on many concurrent sessions, and reports per-step latency percentiles and throughput.
+# It always runs offline on copies of the data files in a temporary data directory.
+
+import argparse
+import contextvars
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import NSL_Chatbot as chatbot
+from synthetic_league import SIZES, write_league
+
+DATA_FILES = ["all_players.csv", "customer_database.csv", "created_teams.csv"]
+
+
+class TranscriptChannel:
+    """
+    Chat channel that answers each prompt with the next recorded reply and times the
+    chatbot's work between a reply and the following prompt (one dialogue step).
+    """
+
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.position = 0
+        self.steps = []  # (step label, seconds)
+        self._label = "<start>"
+        self._answered_at = time.perf_counter()
+
+    def write(self, text):
+        pass
+
+    def read_line(self, prompt=''):
+        self._close_step()
+        if self.position >= len(self.replies):
+            raise chatbot.ChatSessionClosed()
+        reply = self.replies[self.position]
+        self.position += 1
+        self._label = step_label(prompt)
+        self._answered_at = time.perf_counter()
+        return reply
+
+    def finish(self):
+        self._close_step()
+
+    def _close_step(self):
+        if self._label is not None:
+            self.steps.append((self._label, time.perf_counter() - self._answered_at))
+        self._label = None
+
+
+def step_label(prompt):
+    """
+    Groups prompts into dialogue steps: personalised prefixes and trailing spaces are dropped.
+    """
+    prompt = re.sub(r"^.*?, please", "<name>, please", prompt.strip())
+    return prompt[:70]
+
+
+def prepare_data_dir(directory, source=None, size=None, seed=0):
+    """
+    Fills directory with copies of the source data files, or with a generated league.
+    """
+    if size:
+        write_league(directory, *SIZES[size], seed=seed)
+        return
+    source = source or os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for filename in DATA_FILES:
+        shutil.copy2(os.path.join(source, filename), os.path.join(directory, filename))
+
+
+def generate_transcripts(count, rng, mix=None):
+    """
+    Builds count reply lists for a mix of conversations over the loaded data:
+    team discovery, player, country and multi-filter discovery, registration and login to the team builder.
+    """
+    store = chatbot.get_data_store()
+    roster = store.roster()
+    accounts = list(store.accounts().values())
+    team_ids = list(chatbot.TEAMS_DICT)
+    names = roster["name"].tolist()
+    positions = list(chatbot.POSITION_COUNTS)
+    countries = list(chatbot.get_nationality_index(roster).rows)
+    query_index = chatbot.get_roster_query_index(roster)
+    registered = iter(range(10 ** 9))
+
+    def build_positions(choices):
+        replies = []
+        for number in choices:
+            qualities = chatbot.POSITION_QUALITIES[positions[number - 1]]
+            first, second = rng.sample(range(1, len(qualities) + 1), 2)
+            replies += [str(number), str(first), str(second)]
+        return replies
+
+    def discover_team(user):
+        return [user, "1", "1", rng.choice(team_ids), "no", "2"]
+
+    def discover_player(user):
+        return [user, "1", "2", "1", rng.choice(names), "yes", rng.choice(positions).lower(), "no", "2"]
+
+    def discover_country(user):
+        return [user, "1", "2", "2", rng.choice(countries).title(), "no", "2"]
+
+    def discover_query(user):
+        filters = {"position": rng.choice(positions), "jersey": (1, rng.randint(1, 30))}
+        teams = [query_index.labels["team"][key] for key in query_index.postings["team"]]
+        team = rng.randrange(len(teams))
+        filters["team"] = teams[team]
+        # Decline the second page if there is one, so the replies match the prompts
+        more = ["no"] if len(query_index.query(**filters)) > chatbot.QUERY_PAGE_SIZE else []
+        return [user, "1", "2", "3", str(team + 1), filters["position"].lower(), "",
+                f"1-{filters['jersey'][1]}", ""] + more + ["no", "2"]
+
+    def fantasy_register(user):
+        email = f"replay{next(registered)}-{rng.randrange(10 ** 9)}@example.com"
+        return [user, "2", email, "1234"] + build_positions([1, 2, 3, 4]) + ["5", "2"]
+
+    def fantasy_login(user):
+        account = rng.choice(accounts)
+        return [user, "2", account["email"], str(account["pin"])] + build_positions([rng.randint(1, 4)]) + ["5", "2"]
+
+    scenarios = {
+        "discover_team": discover_team,
+        "discover_player": discover_player,
+        "discover_country": discover_country,
+        "discover_query": discover_query,
+        "fantasy_register": fantasy_register,
+        "fantasy_login": fantasy_login,
+    }
+    mix = mix or list(scenarios)
+    transcripts = []
+    for number in range(count):
+        scenario = mix[number % len(mix)]
+        transcripts.append({"scenario": scenario, "replies": scenarios[scenario](f"Replay{number}")})
+    rng.shuffle(transcripts)
+    return transcripts
+
+
+def replay(transcript):
+    """
+    Runs one transcript through run_session() in its own context; returns its channel.
+    """
+    channel = TranscriptChannel(transcript["replies"])
+    chatbot.run_channel_session(channel)
+    channel.finish()
+    return channel
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(timings):
+    timings = sorted(timings)
+    return {
+        "count": len(timings),
+        "p50_ms": percentile(timings, 0.50) * 1000,
+        "p95_ms": percentile(timings, 0.95) * 1000,
+        "p99_ms": percentile(timings, 0.99) * 1000,
+        "max_ms": timings[-1] * 1000 if timings else 0.0,
+    }
+
+
+def run_load(transcripts, concurrency):
+    """
+    Replays all transcripts on a pool of concurrency sessions and collects their steps.
+    """
+    steps, sessions, incomplete = {}, [], []
+    lock = threading.Lock()
+
+    def run_one(transcript):
+        start = time.perf_counter()
+        channel = contextvars.copy_context().run(replay, transcript)
+        elapsed = time.perf_counter() - start
+        with lock:
+            sessions.append(elapsed)
+            if channel.position < len(channel.replies):
+                incomplete.append(transcript["scenario"])
+            for label, seconds in channel.steps:
+                steps.setdefault(label, []).append(seconds)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="replay") as executor:
+        list(executor.map(run_one, transcripts))
+    wall_time = time.perf_counter() - started
+
+    n_steps = sum(len(timings) for timings in steps.values())
+    return {
+        "sessions": len(sessions),
+        "concurrency": concurrency,
+        "wall_time_s": wall_time,
+        "sessions_per_s": len(sessions) / wall_time if wall_time else 0.0,
+        "steps_per_s": n_steps / wall_time if wall_time else 0.0,
+        "session_latency": summarize(sessions),
+        "all_steps": summarize([seconds for timings in steps.values() for seconds in timings]),
+        "steps": {label: summarize(timings) for label, timings in sorted(steps.items())},
+        "incomplete_sessions": len(incomplete),
+    }
+
+
+def print_report(report):
+    print(f"{report['sessions']} sessions at concurrency {report['concurrency']} in "
+          f"{report['wall_time_s']:.2f} s: {report['sessions_per_s']:.1f} sessions/s, "
+          f"{report['steps_per_s']:.1f} steps/s")
+    if report["incomplete_sessions"]:
+        print(f"WARNING: {report['incomplete_sessions']} sessions ended before their transcript did")
+    print(f"{'Step':<72}{'n':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    print("-" * 109)
+    rows = list(report["steps"].items()) + [("(all steps)", report["all_steps"]),
+                                             ("(whole session)", report["session_latency"])]
+    for label, stats in rows:
+        print(f"{label:<72}{stats['count']:>7}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay scripted chatbot sessions concurrently")
+    parser.add_argument("--sessions", type=int, default=200, help="number of generated sessions")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--transcripts", help="JSON file of recorded transcripts ({scenario, replies} objects)")
+    parser.add_argument("--save-transcripts", help="write the generated transcripts to this JSON file")
+    parser.add_argument("--scenarios", help="comma-separated subset of generated scenarios")
+    parser.add_argument("--data-dir", help="directory holding the CSVs to copy (default: the repository)")
+    parser.add_argument("--size", choices=list(SIZES), help="replay against a generated league instead")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the report as JSON")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        prepare_data_dir(directory, args.data_dir, args.size, args.seed)
+        chatbot.DATA_DIR = directory
+        chatbot._DATA_STORE = None
+        # Warm the shared data and recommender, as serve_chat() does before accepting users
+        chatbot.get_data_store().team_store()
+        chatbot.get_recommender()
+
+        if args.transcripts:
+            with open(args.transcripts, encoding="utf-8") as infile:
+                transcripts = json.load(infile)
+        else:
+            mix = args.scenarios.split(",") if args.scenarios else None
+            transcripts = generate_transcripts(args.sessions, random.Random(args.seed), mix)
+        if args.save_transcripts:
+            with open(args.save_transcripts, mode="w", encoding="utf-8") as outfile:
+                json.dump(transcripts, outfile, indent=1)
+
+        report = run_load(transcripts, args.concurrency)
+        # Saves are written in the background: finish them before the directory goes away
+        chatbot.get_data_store().flush_writes()
+
+    print_report(report)
+    if args.output:
+        with open(args.output, mode="w", encoding="utf-8") as outfile:
+            json.dump(report, outfile, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+# Synthetic league generator for the NSL chatbot benchmarks.
+# Produces all_players.csv, customer_database.csv and created_teams.csv with
+# the same columns (and encodings) as the real files, at any size.
+
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from NSL_Chatbot import POSITION_COUNTS, POSITION_QUALITIES
+
+# Named sizes: (players, customers, created teams)
+SIZES = {
+    "current": (132, 1_000, 100),
+    "small": (1_000, 10_000, 1_000),
+    "medium": (10_000, 100_000, 10_000),
+    "large": (100_000, 1_000_000, 100_000),
+}
+
+# Share of each position in a real NSL roster
+POSITION_SHARES = {"Goalkeeper": 0.12, "Defender": 0.31, "Midfielder": 0.36, "Forward": 0.21}
+
+FIRST_NAMES = ["Noémi", "Tanya", "Latifah", "Alexandria", "Desiree", "Stéphanie", "Hailey", "Meikayla",
+               "Shannon", "Kaylee", "Anna", "Jodi", "Miranda", "Chloé", "Sara", "Aoi", "Megumi",
+               "Björk", "Inès", "Zoë", "Maëlle", "Océane", "Jade", "Leah", "Florence"]
+LAST_NAMES = ["Paquin", "Boychuk", "Abdu", "Hess", "Scott", "Hill", "Whitaker", "Moore", "Woeller",
+              "Hunter", "Karpenko", "Smith", "Lachance", "Côté", "Gagné", "Bélanger", "Nakamura",
+              "Kizaki", "Pedersen", "Müller", "Lefèvre", "Søndergaard", "Okamoto", "Wulf", "Belzile"]
+COUNTRIES = ["Canada"] * 12 + ["USA"] * 3 + ["New Zealand", "Wales", "Japan", "South Korea", "Sweden",
+                                             "Norway", "Germany", "Jamaica", "Australia", "Iceland"]
+CITIES = ["Montreal", "Vancouver", "Calgary", "Toronto", "Halifax", "Ottawa", "Winnipeg", "Edmonton",
+          "Quebec City", "Victoria", "Regina", "Saskatoon", "Hamilton", "London", "Kitchener", "Moncton"]
+
+
+def generate_roster(n_players, rng):
+    """
+    Returns an all_players.csv-shaped DataFrame with n_players rows and unique names.
+    """
+    n_teams = max(6, n_players // 22)
+    team_ids = rng.integers(1, n_teams + 1, n_players)
+    team_names = np.array([f"{CITIES[i % len(CITIES)]} {'FC' if i < len(CITIES) else f'FC {i // len(CITIES) + 1}'}"
+                           for i in range(n_teams)], dtype=object)
+
+    positions = rng.choice(list(POSITION_SHARES), n_players, p=list(POSITION_SHARES.values()))
+    # Every (first, last) pair is used once before a numeric suffix is added, so names stay unique
+    ids = rng.permutation(n_players)
+    combos = len(FIRST_NAMES) * len(LAST_NAMES)
+    first = np.array(FIRST_NAMES, dtype=object)[ids % len(FIRST_NAMES)]
+    last = np.array(LAST_NAMES, dtype=object)[(ids // len(FIRST_NAMES)) % len(LAST_NAMES)]
+    suffix = np.where(ids < combos, "", " " + (ids // combos + 1).astype(str).astype(object))
+    names = first + " " + last + suffix
+
+    attributes = []
+    for position in positions:
+        qualities = POSITION_QUALITIES[position]
+        picks = rng.choice(len(qualities), 3, replace=False)
+        attributes.append(" | ".join(qualities[i] for i in picks))
+
+    return pd.DataFrame({
+        "team_id": team_ids,
+        "team": team_names[team_ids - 1],
+        "position": positions,
+        "jersey": rng.integers(1, 100, n_players),
+        "name": names,
+        "nationality": np.array(COUNTRIES, dtype=object)[rng.integers(0, len(COUNTRIES), n_players)],
+        "fact": "Former " + np.array(CITIES, dtype=object)[rng.integers(0, len(CITIES), n_players)] + " player",
+        "attributes": attributes,
+    })
+
+
+def generate_accounts(n_customers, rng):
+    """
+    Returns a customer_database.csv-shaped DataFrame (customer_id, email, name, pin).
+    """
+    numbers = np.arange(1, n_customers + 1).astype(str).astype(object)
+    first = np.array(FIRST_NAMES, dtype=object)[rng.integers(0, len(FIRST_NAMES), n_customers)]
+    last = np.array(LAST_NAMES, dtype=object)[rng.integers(0, len(LAST_NAMES), n_customers)]
+    return pd.DataFrame({
+        "customer_id": "customer" + numbers,
+        "email": "fan" + numbers + "@example.com",
+        "name": first + " " + last,
+        "pin": rng.integers(0, 10_000, n_customers).astype(str).astype(object),
+    })
+
+
+def generate_created_teams(n_teams, roster_df, rng):
+    """
+    Returns a created_teams.csv-shaped DataFrame: 11 rows (1-4-3-3) for each of n_teams customers.
+    """
+    frames = []
+    customer_ids = "customer" + np.arange(1, n_teams + 1).astype(str).astype(object)
+    for position, count in POSITION_COUNTS.items():
+        pool = roster_df.loc[roster_df["position"] == position, "name"].to_numpy()
+        qualities = np.array(POSITION_QUALITIES[position], dtype=object)
+        picks = pool[rng.integers(0, len(pool), (n_teams, count))]
+        # Two different qualities per position, as recommendation() asks for
+        first_choice = rng.integers(0, len(qualities), n_teams)
+        second_choice = (first_choice + rng.integers(1, len(qualities), n_teams)) % len(qualities)
+        combined = qualities[first_choice] + " | " + qualities[second_choice]
+        frames.append(pd.DataFrame({
+            "customer_id": np.repeat(customer_ids, count),
+            "position": position,
+            "playername": picks.ravel(),
+            "qualities": np.repeat(combined, count),
+            "_order": np.repeat(np.arange(n_teams), count),
+        }))
+    teams = pd.concat(frames, ignore_index=True).sort_values("_order", kind="stable")
+    return teams.drop(columns="_order").reset_index(drop=True)
+
+
+def write_league(directory, n_players, n_customers, n_teams, seed=0):
+    """
+    Writes the three CSVs into a directory and returns their paths.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    roster_df = generate_roster(n_players, rng)
+    paths = {
+        "roster": os.path.join(directory, "all_players.csv"),
+        "accounts": os.path.join(directory, "customer_database.csv"),
+        "created_teams": os.path.join(directory, "created_teams.csv"),
+    }
+    # Same encodings as the real files: latin-1 roster, UTF-8 accounts and teams
+    roster_df.to_csv(paths["roster"], index=False, encoding="latin-1")
+    generate_accounts(n_customers, rng).to_csv(paths["accounts"], index=False, encoding="utf-8")
+    generate_created_teams(n_teams, roster_df, rng).to_csv(paths["created_teams"], index=False, encoding="utf-8")
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic NSL league")
+    parser.add_argument("directory")
+    parser.add_argument("--size", choices=SIZES, default="current")
+    parser.add_argument("--players", type=int, help="override the number of players")
+    parser.add_argument("--customers", type=int, help="override the number of customers")
+    parser.add_argument("--teams", type=int, help="override the number of created teams")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    players, customers, teams = SIZES[args.size]
+    paths = write_league(args.directory, args.players or players, args.customers or customers,
+                         args.teams or teams, args.seed)
+    for label, path in paths.items():
+        print(f"{label}: {path}")
+
+
+if __name__ == "__main__":
+    main()
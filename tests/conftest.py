@@ -0,0 +1,66 @@
+# Shared fixtures: every test runs the chatbot against its own copy of the data files,
+# so saves and journals never touch the repository's CSVs.
+
+import os
+import shutil
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+import NSL_Chatbot as chatbot
+
+DATA_FILES = ["all_players.csv", "customer_database.csv", "created_teams.csv"]
+
+
+class ScriptedChannel:
+    """
+    Chat channel that answers prompts from a list and records the chatbot's output.
+    """
+
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.output = []
+
+    def write(self, text):
+        self.output.append(text)
+
+    def read_line(self, prompt=''):
+        if not self.replies:
+            raise chatbot.ChatSessionClosed()
+        return self.replies.pop(0)
+
+    def text(self):
+        return "".join(self.output)
+
+
+def use_data_dir(monkeypatch, directory):
+    """
+    Points the chatbot at directory with a fresh data store.
+    """
+    monkeypatch.setattr(chatbot, "DATA_DIR", str(directory))
+    monkeypatch.setattr(chatbot, "_DATA_STORE", None)
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    """
+    A copy of the repository's data files, loaded by a fresh data store.
+    """
+    for filename in DATA_FILES:
+        shutil.copy2(os.path.join(ROOT, filename), tmp_path / filename)
+    use_data_dir(monkeypatch, tmp_path)
+    yield tmp_path
+    if chatbot._DATA_STORE is not None:
+        chatbot._DATA_STORE.flush_writes()
+
+
+def run_script(replies):
+    """
+    Runs one conversation with scripted replies; returns its channel.
+    """
+    channel = ScriptedChannel(replies)
+    chatbot.run_channel_session(channel)
+    return channel
@@ -0,0 +1,44 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from conftest import chatbot
+
+
+async def read_all(reader):
+    return (await asyncio.wait_for(reader.read(), timeout=10)).decode("utf-8")
+
+
+async def busy_and_idle_sessions():
+    executor = ThreadPoolExecutor(max_workers=1)
+    sessions = asyncio.Semaphore(1)
+    server = await asyncio.start_server(
+        lambda reader, writer: chatbot.handle_chat_connection(reader, writer, executor, sessions, 0.5),
+        "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    try:
+        first_reader, first_writer = await asyncio.open_connection("127.0.0.1", port)
+        greeting = await asyncio.wait_for(first_reader.readuntil(b": "), timeout=10)
+        # The only session is taken, so a second client is turned away at once
+        second_reader, second_writer = await asyncio.open_connection("127.0.0.1", port)
+        busy = await read_all(second_reader)
+        # The first client never replies and is disconnected after the idle timeout
+        timed_out = await read_all(first_reader)
+        # Its worker is free again for the next client
+        third_reader, third_writer = await asyncio.open_connection("127.0.0.1", port)
+        third = await asyncio.wait_for(third_reader.readuntil(b": "), timeout=10)
+        for writer in (first_writer, second_writer, third_writer):
+            writer.close()
+        return greeting.decode("utf-8"), busy, timed_out, third.decode("utf-8")
+    finally:
+        server.close()
+        await server.wait_closed()
+        # Waits on another thread so the loop can still hand the last session its disconnect
+        await asyncio.get_running_loop().run_in_executor(None, executor.shutdown)
+
+
+def test_busy_notice_and_idle_timeout(data_dir):
+    greeting, busy, timed_out, third = asyncio.run(busy_and_idle_sessions())
+    assert greeting.strip()
+    assert busy == chatbot.CHAT_BUSY_MESSAGE.replace("\n", "\r\n")
+    assert "without a reply" in timed_out
+    assert third == greeting
@@ -0,0 +1,50 @@
+import pytest
+
+from conftest import chatbot
+from test_leaderboard import rewrite_roster
+
+
+def test_shared_roster_rejects_in_place_edits(data_dir):
+    store = chatbot.get_data_store()
+    roster = store.roster()
+    name = roster.loc[0, "name"]
+    edits = [
+        lambda: roster.loc.__setitem__((0, "name"), "Someone Else"),
+        lambda: roster.iat.__setitem__((0, 0), 0),
+        lambda: roster.__setitem__("cost", 1),
+        lambda: roster.drop(columns="fact", inplace=True),
+        lambda: roster.sort_values("name", inplace=True),
+    ]
+    for edit in edits:
+        with pytest.raises(TypeError):
+            edit()
+    assert store.roster().loc[0, "name"] == name
+
+    # Copies stay editable, and a reloaded roster is read-only too
+    changed = roster.copy()
+    changed.loc[0, "name"] = "Someone Else"
+    rewrite_roster(data_dir, changed)
+    assert store.refresh_roster()
+    reloaded = store.roster()
+    assert "Someone Else" in set(reloaded["name"])
+    with pytest.raises(TypeError):
+        reloaded.loc[0, "name"] = name
+
+
+def test_compacting_the_account_journal_does_not_reload_accounts(data_dir, monkeypatch):
+    store = chatbot.get_data_store()
+    store.add_account(store.new_customer_id(), {"email": "new.fan@example.com", "name": "New Fan", "pin": "4321"})
+    store.flush_writes()
+    version, index = store.version("account_dict"), store.account_index()
+
+    # A login while the snapshot is being written must find the accounts in sync
+    write_snapshot = store.account_journal.write_snapshot
+    def checked_write_snapshot(accounts):
+        assert store.version("account_dict") == version
+        write_snapshot(accounts)
+    monkeypatch.setattr(store.account_journal, "write_snapshot", checked_write_snapshot)
+
+    store.compact_accounts()
+    assert store.version("account_dict") == version
+    assert store.account_index() is index
+    assert "new.fan@example.com" in {record["email"] for record in store.accounts().values()}
@@ -0,0 +1,81 @@
+import os
+import random
+
+from conftest import chatbot
+
+
+def rewrite_roster(data_dir, roster):
+    path = os.path.join(data_dir, "all_players.csv")
+    roster.to_csv(path, index=False, encoding="utf-8")
+    # A later mtime, so the store sees the change even on coarse-grained clocks
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 5))
+
+
+def test_new_attribute_leaves_untouched_squads_scored_as_a_rebuild(data_dir):
+    store = chatbot.get_data_store()
+    roster = store.roster()
+    assert "vision" not in chatbot.get_recommender(roster).vocabulary
+    # A squad asking for a quality no player has yet
+    picks = chatbot.recommend_squad({position: chatbot.POSITION_QUALITIES[position][:2]
+                                     for position in chatbot.POSITION_COUNTS})
+    team_rows = [(position, playername, "Tackling | Vision")
+                 for position, playername in zip(picks["position"], picks["playername"])]
+    store.save_team("customer_vision", team_rows)
+    board = store.leaderboard()
+
+    # Another player gains the new attribute: only their squads are dirty
+    changed = roster.copy()
+    row = next(row for row, name in enumerate(changed["name"]) if name not in set(picks["playername"]))
+    changed.loc[row, "attributes"] = changed.loc[row, "attributes"] + " | Vision"
+    rewrite_roster(data_dir, changed)
+    assert store.refresh_roster()
+
+    updated = store.leaderboard()
+    assert updated is board
+    rebuilt = chatbot.Leaderboard(store.roster(), chatbot.get_recommender(), store.team_store().iter_teams())
+    assert updated.points == rebuilt.points
+    assert updated.top(len(updated)) == rebuilt.top(len(rebuilt))
+
+
+def test_ranked_list_matches_a_sorted_list(monkeypatch):
+    # Small buckets, so adds split them and removals empty them
+    monkeypatch.setattr(chatbot, "RANKED_LIST_LOAD", 16)
+    rng = random.Random(0)
+    items = [(rng.randint(-50, 0), f"customer{number}") for number in range(5000)]
+    ranked = chatbot.RankedList(items[:3000])
+    expected = sorted(items[:3000])
+    for item in items[3000:]:
+        ranked.add(item)
+        expected.append(item)
+    expected.sort()
+    for number, item in enumerate(rng.sample(expected, 2500)):
+        ranked.remove(item)
+        expected.remove(item)
+        if number % 250 == 0:
+            probe = rng.choice(items)
+            assert ranked.index(probe) == sum(other < probe for other in expected)
+    assert len(ranked) == len(expected)
+    assert ranked.first(len(expected) + 10) == expected
+    for item in rng.sample(items, 200):
+        assert ranked.index(item) == sum(other < item for other in expected)
+
+
+def test_teams_rewritten_by_another_process_are_rescored(data_dir):
+    store = chatbot.get_data_store()
+    board = store.leaderboard()
+    assert "customer_rebuilt" not in board.points
+    team_rows = next(store.team_store().iter_teams())[1]
+
+    # A second connection stands in for --rebuild-teams running as its own process
+    other = chatbot.TeamStore(store.team_store().db_path)
+    other.replace_teams({"customer_rebuilt": team_rows})
+    updated = store.leaderboard()
+    assert "customer_rebuilt" in updated.points
+    assert updated.points == chatbot.Leaderboard(
+        store.roster(), chatbot.get_recommender(), store.team_store().iter_teams()).points
+
+    # In-process bulk writes update the board without rescoring every team
+    store.replace_teams({"customer_bulk": team_rows})
+    assert store.leaderboard() is updated
+    assert updated.points["customer_bulk"] == updated.points["customer_rebuilt"]
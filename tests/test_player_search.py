@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from conftest import chatbot
+from synthetic_league import SIZES, generate_roster
+
+
+@pytest.fixture(scope="module")
+def large_index():
+    roster = generate_roster(SIZES["large"][0], np.random.default_rng(0))
+    return chatbot.PlayerNameIndex(roster)
+
+
+def brute_force_prefix(index, query, limit):
+    """
+    Every full-name or surname match ranked as prefix() promises, cut to limit.
+    """
+    folded = chatbot.fold_text(query)
+    best = {}
+    for row, name in enumerate(index.folded_names):
+        words = name.split()
+        for start in range(len(words)):
+            key = " ".join(words[start:])
+            if key.startswith(folded):
+                rank = (0 if start == 0 else 1, len(name), key, row)
+                best[row] = min(best.get(row, rank), rank)
+    return sorted(best, key=best.get)[:limit]
+
+
+@pytest.mark.parametrize("query", ["ch", "pa", "Noémi P", "hill 1", "zz"])
+def test_prefix_matches_brute_force_on_the_large_league(large_index, query):
+    assert large_index.prefix(query, 5) == brute_force_prefix(large_index, query, 5)
+
+
+def test_fuzzy_finds_the_unsuffixed_name_among_many_longer_ones(large_index):
+    rows = large_index.fuzzy("noemi paqin")
+    assert [large_index.folded_names[row] for row in rows] == ["noemi paquin"]
+    assert large_index.search("noemi paqin")[0] == large_index.lookup("Noémi Paquin")
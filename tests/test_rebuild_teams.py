@@ -0,0 +1,57 @@
+import random
+
+from conftest import chatbot
+from test_leaderboard import rewrite_roster
+
+
+def build_teams(store, count, seed=0):
+    """
+    Saves teams built as recommendation() builds them: positions filled in a random order,
+    some more than once, each with the rest of the squad fixed.
+    """
+    rng = random.Random(seed)
+    roster = store.roster()
+    for number in range(count):
+        draft = chatbot.TeamDraft(roster)
+        for position in rng.choices(list(chatbot.POSITION_COUNTS), k=6) + list(chatbot.POSITION_COUNTS):
+            qualities = " | ".join(rng.sample(chatbot.POSITION_QUALITIES[position], 2))
+            picks = chatbot.optimize_squad_picks({position: qualities}, roster,
+                                                 max_per_club=chatbot.MAX_PLAYERS_PER_CLUB,
+                                                 fixed_players=draft.player_names(exclude_position=position))
+            draft.set_position(position, picks[0][1], qualities)
+        store.save_team(f"built{number}", draft.team_rows())
+    store.flush_writes()
+
+
+def test_unchanged_roster_leaves_every_team_untouched(data_dir):
+    store = chatbot.get_data_store()
+    build_teams(store, 20)
+    before = list(store.team_store().iter_teams())
+    store.team_store().export_csv(str(data_dir / "before.csv"))
+
+    summary = chatbot.rebuild_all_teams(workers=1)
+    assert (summary["teams"], summary["stale"], summary["changed"], summary["failed"]) == (21, 0, 0, 0)
+    assert list(store.team_store().iter_teams()) == before
+    store.team_store().export_csv(str(data_dir / "after.csv"))
+    assert (data_dir / "after.csv").read_bytes() == (data_dir / "before.csv").read_bytes()
+
+
+def test_only_players_who_left_the_roster_are_replaced(data_dir):
+    store = chatbot.get_data_store()
+    before = list(store.team_store().load_team("customer1")[["position", "playername", "qualities"]]
+                  .itertuples(index=False, name=None))
+    slot = 3
+    position, departed, qualities = before[slot]
+    roster = store.roster()
+    rewrite_roster(data_dir, roster[roster["name"] != departed])
+    assert store.refresh_roster()
+
+    summary = chatbot.rebuild_all_teams(workers=1)
+    assert (summary["stale"], summary["changed"], summary["failed"]) == (1, 1, 0)
+    after = list(store.team_store().load_team("customer1")[["position", "playername", "qualities"]]
+                 .itertuples(index=False, name=None))
+    assert after[:slot] + after[slot + 1:] == before[:slot] + before[slot + 1:]
+    new_position, replacement, new_qualities = after[slot]
+    assert (new_position, new_qualities) == (position, qualities)
+    assert replacement != departed and replacement not in [row[1] for row in before]
+    assert store.roster().loc[store.roster()["name"] == replacement, "position"].iat[0] == position
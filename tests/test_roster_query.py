@@ -0,0 +1,26 @@
+from conftest import chatbot
+
+
+def test_nationality_matches_country_or_demonym(data_dir):
+    roster = chatbot.get_data_store().roster()
+    query_index = chatbot.get_roster_query_index(roster)
+    canadians = query_index.query(nationality="Canada")
+    assert len(canadians) and set(roster["nationality"].iloc[canadians]) == {"Canada"}
+    assert list(query_index.query(nationality="Canadian")) == list(canadians)
+    # The roster itself writes some nationalities as demonyms
+    assert set(roster["nationality"].iloc[query_index.query(nationality="Japan")]) == {"Japan", "Japanese"}
+    assert list(query_index.query(nationality="Canadian", position="Forward")) == \
+        [row for row in canadians if roster["position"].iloc[row] == "Forward"]
+    assert list(chatbot.get_nationality_index(roster).players("Canadian")) == list(canadians)
+
+
+def test_nationality_index_and_query_index_agree(data_dir):
+    roster = chatbot.get_data_store().roster()
+    query_index = chatbot.get_roster_query_index(roster)
+    nationality_index = chatbot.get_nationality_index(roster)
+    for country in ["Japan", "Japanese", "Sweden", "Swedish", "Canada", "Canadian"]:
+        assert list(nationality_index.players(country)) == list(query_index.query(nationality=country))
+    # The map counts each country once, under its country name
+    counts = dict(zip(nationality_index.counts["country"], nationality_index.counts["count"]))
+    assert "japanese" not in counts and "swedish" not in counts
+    assert counts["japan"] == len(query_index.query(nationality="Japan"))
@@ -0,0 +1,94 @@
+import itertools
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import chatbot
+
+POSITIONS = {"Goalkeeper": 4, "Defender": 6, "Forward": 6, "Midfielder": 3}
+
+
+def random_roster(rng, n_names):
+    rows = []
+    for position, size in POSITIONS.items():
+        for _ in range(size):
+            qualities = chatbot.POSITION_QUALITIES[position]
+            rows.append({"team_id": rng.randint(1, 3), "position": position,
+                         "name": f"Player {rng.randrange(n_names)}", "nationality": "Canada",
+                         "attributes": " | ".join(rng.sample(qualities, rng.randint(1, 4))),
+                         "cost": rng.randint(1, 9)})
+    roster = pd.DataFrame(rows)
+    roster["team"] = "Club " + roster["team_id"].astype(str)
+    return roster
+
+
+def brute_force(roster, preferences, max_per_club, budget, fixed_players):
+    """
+    Best total score over every combination of players, or None if none is allowed.
+    """
+    engine = chatbot.get_recommender(roster)
+    names = roster["name"].tolist()
+    fixed_rows = [names.index(name) for name in dict.fromkeys(fixed_players)]
+    choices = []
+    for position, qualities in preferences.items():
+        rows = engine.position_rows[position]
+        scores = engine.score(position, [qualities])[0]
+        choices.append([(tuple(rows[list(picked)]), scores[list(picked)].sum())
+                        for picked in itertools.combinations(range(len(rows)), chatbot.POSITION_COUNTS[position])])
+    best = None
+    for combination in itertools.product(*choices):
+        rows = [row for picked, _ in combination for row in picked]
+        squad = rows + fixed_rows
+        if len({names[row] for row in squad}) < len(squad):
+            continue
+        if max(np.bincount(roster["team_id"].to_numpy()[squad])) > max_per_club:
+            continue
+        if budget is not None and roster["cost"].to_numpy()[squad].sum() > budget:
+            continue
+        total = sum(score for _, score in combination)
+        best = total if best is None else max(best, total)
+    return best
+
+
+@pytest.mark.parametrize("n_names,with_budget", [(100, False), (100, True), (8, False), (8, True)])
+def test_optimize_squad_matches_brute_force(n_names, with_budget):
+    # n_names = 8 gives many players sharing a name, within and across positions
+    rng = random.Random(n_names * 2 + with_budget)
+    for _ in range(60):
+        roster = random_roster(rng, n_names)
+        preferences = {position: " | ".join(rng.sample(chatbot.POSITION_QUALITIES[position], 2))
+                       for position in ("Goalkeeper", "Defender", "Forward")}
+        max_per_club = rng.choice([2, 3, 4])
+        budget = rng.randint(30, 60) if with_budget else None
+        fixed_players = rng.sample(roster.loc[roster["position"] == "Midfielder", "name"].tolist(), rng.randint(0, 2))
+
+        expected = brute_force(roster, preferences, max_per_club, budget, fixed_players)
+        try:
+            picks = chatbot.optimize_squad_picks(preferences, roster, max_per_club, budget,
+                                                 "cost" if with_budget else None, fixed_players)
+        except ValueError:
+            picks = None
+        if expected is None:
+            assert picks is None
+            continue
+        assert picks is not None
+        engine = chatbot.get_recommender(roster)
+        total = 0.0
+        for position, rows in picks:
+            scores = engine.score(position, [preferences[position]])[0]
+            position_of_row = {row: index for index, row in enumerate(engine.position_rows[position])}
+            total += scores[[position_of_row[row] for row in rows]].sum()
+        assert total == pytest.approx(expected)
+
+
+def test_infeasible_squad_names_the_constraint():
+    roster = pd.DataFrame({"team_id": [1] * 5, "team": ["Club 1"] * 5, "position": ["Defender"] * 5,
+                           "name": [f"Defender {number}" for number in range(5)], "nationality": ["Canada"] * 5,
+                           "attributes": ["Tackling | Marking"] * 5})
+    with pytest.raises(ValueError, match="at most 3 players from the same club"):
+        chatbot.optimize_squad_picks({"Defender": "Tackling | Marking"}, roster, max_per_club=3)
+    with pytest.raises(ValueError, match="only 3 defenders available for 4 places"):
+        chatbot.optimize_squad_picks({"Defender": "Tackling | Marking"}, roster, max_per_club=3,
+                                     fixed_players=["Defender 0", "Defender 1"])
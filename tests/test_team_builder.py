@@ -0,0 +1,41 @@
+from conftest import chatbot, run_script
+
+
+def test_finalizing_an_unedited_team_keeps_mixed_qualities(data_dir):
+    store = chatbot.get_data_store()
+    # The shipped customer1 team mixes several quality sets within a position
+    saved = store.load_team("customer1")[["position", "playername", "qualities"]]
+    assert saved.groupby("position")["qualities"].nunique().max() > 1
+    before = list(saved.itertuples(index=False, name=None))
+
+    # Log in, finalize straight away (5), then leave (2)
+    run_script(["Tester", "2", "john.doe@gmail.com", "1234", "5", "2"])
+    store.flush_writes()
+
+    after = list(store.team_store().load_team("customer1")[["position", "playername", "qualities"]]
+                 .itertuples(index=False, name=None))
+    assert sorted(after) == sorted(before)
+
+
+def test_team_draft_snapshot_round_trip_keeps_slot_qualities(data_dir):
+    roster = chatbot.get_data_store().roster()
+    team_rows = list(chatbot.get_data_store().load_team("customer1")[["position", "playername", "qualities"]]
+                     .itertuples(index=False, name=None))
+    draft = chatbot.TeamDraft.from_team(team_rows, roster)
+    restored = chatbot.TeamDraft.from_snapshot(draft.snapshot(), roster)
+    assert restored.team_rows() == draft.team_rows()
+    assert sorted(draft.team_rows()) == sorted(team_rows)
+
+
+def test_editing_a_position_replaces_only_its_slots(data_dir):
+    roster = chatbot.get_data_store().roster()
+    team_rows = list(chatbot.get_data_store().load_team("customer1")[["position", "playername", "qualities"]]
+                     .itertuples(index=False, name=None))
+    draft = chatbot.TeamDraft.from_team(team_rows, roster)
+    forward_rows = chatbot.get_recommender(roster).position_rows["Forward"][:3]
+    draft.set_position("Forward", forward_rows, "Finishing | Stamina")
+
+    edited = draft.team_rows()
+    assert [row for row in edited if row[0] != "Forward"] == [row for row in team_rows if row[0] != "Forward"]
+    assert [row for row in edited if row[0] == "Forward"] == \
+        [("Forward", roster["name"].iat[row], "Finishing | Stamina") for row in forward_rows]